@@ -0,0 +1,748 @@
+#!usr/bin/python
+
+## @package HTTP--Chat.bench Benchmark module.
+## @file bench.py Implementation of @ref HTTP--Chat.bench
+#
+# Microbenchmarks of server internals, one sub command each.
+#
+
+import argparse
+import buffers
+import constants
+import events
+import executor
+import formats
+import history
+import httpparser
+import messagelog
+import multiprocessing
+import os
+import random
+import server
+import shutil
+import services
+import socket
+import tempfile
+import time
+import tools
+import urlparse
+import xml.etree.ElementTree as et
+
+
+## Typical browser request head.
+REQUEST = (
+    'GET /get-messages?room=lobby&wait=30 HTTP/1.1\r\n'
+    'Host: localhost:8080\r\n'
+    'Connection: keep-alive\r\n'
+    'User-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36\r\n'
+    'Accept: */*\r\n'
+    'Referer: http://localhost:8080/chat?room=lobby\r\n'
+    'Accept-Encoding: gzip, deflate, br\r\n'
+    'Accept-Language: en-US,en;q=0.9\r\n'
+    'Cookie: uid=QnVsJgU0GkO6tgaNyIhyBQ==\r\n'
+    '\r\n'
+)
+
+## Range of ports benchmarked servers listen on, below ephemeral ports.
+PORTS = (20000, 32000)
+
+## Poll types of server.
+ENGINES = [event.NAME for event in events.CommonEvents.__subclasses__()]
+
+## Request head close to header limits.
+LARGE_REQUEST = REQUEST[:-len(constants.CRLF)] + ''.join(
+    'X-Header-%d: %s\r\n' % (i, 'x' * 200) for i in range(80)
+) + constants.CRLF
+
+
+## Time a function.
+# @param func (callable) function to time
+# @param repeat (int) amount of calls
+# @returns (float) microseconds per call
+#
+def measure(func, repeat):
+    start = time.time()
+    for i in range(repeat):
+        func()
+    return (time.time() - start) * 1e6 / repeat
+
+
+## Request head parsing of the line by line state machine replaced by
+## @ref httpparser.RequestParser.
+# @param buf (RecvBuffer) connection receive buffer
+# @param chunks (list) request head as received
+# @returns (dict) parsed request
+#
+def legacy_parse(buf, chunks):
+    request = {'headers': {'Content-Length': 0, 'Connection': ''}}
+    first = True
+    for chunk in chunks:
+        buf.extend(chunk)
+        if first:
+            n = buf.find(constants.CRLF_BIN)
+            if n == -1:
+                continue
+            line = buf.take(n).decode('utf-8')
+            buf.consume(len(constants.CRLF_BIN))
+            method, uri, signature = line.split(' ', 2)
+            parsed = urlparse.urlparse(uri)
+            request['method'] = method
+            request['uri'] = parsed.path
+            request['params'] = urlparse.parse_qs(parsed.query)
+            first = False
+        while buf:
+            n = buf.find(constants.CRLF_BIN)
+            if n == -1:
+                break
+            if n == 0:
+                buf.consume(len(constants.CRLF_BIN))
+                return request
+            line = buf.take(n).decode('utf-8')
+            buf.consume(len(constants.CRLF_BIN))
+            if len(line) > constants.MAX_HEADER_LEN:
+                raise RuntimeError('Header too long')
+            n = line.find(':')
+            title, data = line[:n].rstrip(), line[n + 1:].lstrip()
+            if title == 'Content-Length':
+                data = int(data)
+            request['headers'][title] = data
+
+
+## Request head parsing of @ref httpparser.RequestParser.
+# @param parser (RequestParser) connection parser
+# @param buf (RecvBuffer) connection receive buffer
+# @param chunks (list) request head as received
+# @returns (Request) parsed request
+#
+def incremental_parse(parser, buf, chunks):
+    for chunk in chunks:
+        buf.extend(chunk)
+        request = parser.parse(buf)
+        if request is not None:
+            request.params
+            return request
+
+
+## Compare request head parsers.
+# @param args (object) program arguments
+#
+# Parser and buffer belong to a connection, so they are reused between
+# requests.
+#
+def bench_parse(args):
+    parser = httpparser.RequestParser()
+    buf = buffers.RecvBuffer()
+    for request, size in (
+        (REQUEST, len(REQUEST)),
+        (REQUEST, 64),
+        (REQUEST, 8),
+        (LARGE_REQUEST, len(LARGE_REQUEST)),
+        (LARGE_REQUEST, 1024),
+    ):
+        chunks = [
+            request[i:i + size] for i in range(0, len(request), size)
+        ]
+        legacy = measure(lambda: legacy_parse(buf, chunks), args.repeat)
+        incremental = measure(
+            lambda: incremental_parse(parser, buf, chunks),
+            args.repeat,
+        )
+        print(
+            '%5d bytes in %4d chunks: '
+            'legacy %8.2f us, incremental %8.2f us (x%.2f)' % (
+                len(request),
+                len(chunks),
+                legacy,
+                incremental,
+                legacy / incremental,
+            )
+        )
+
+
+## Chat messages response as built with ElementTree before
+## @ref formats was introduced.
+# @param messages (list) new messages
+# @param revision (int) room revision
+# @param users (iterable) room users
+# @returns (str) serialized response
+#
+def legacy_messages_xml(messages, revision, users):
+    root = et.Element('root')
+    messages_node = et.SubElement(root, 'messages')
+    for entry in messages:
+        et.SubElement(messages_node, 'message').attrib['text'] = entry
+    if messages:
+        et.SubElement(root, 'id').attrib['revision'] = '%s' % revision
+    users_node = et.SubElement(root, 'users')
+    for name in users:
+        et.SubElement(users_node, 'user').attrib['name'] = name
+    return et.tostring(root)
+
+
+## Chat rooms response as built with ElementTree before @ref formats was
+## introduced.
+# @param rooms (iterable) room names
+# @returns (str) serialized response
+#
+def legacy_rooms_xml(rooms):
+    root = et.Element('root')
+    for room in rooms:
+        et.SubElement(root, 'room').attrib['name'] = room
+    return et.tostring(root)
+
+
+## Compare response serializers.
+# @param args (object) program arguments
+#
+def bench_serialize(args):
+    users = ['user%d' % i for i in range(args.users)]
+    rooms = ['room %d' % i for i in range(args.users)]
+    for amount in (0, 1, args.messages):
+        messages = [
+            'user%d: message number %d & <more>' % (i % args.users, i)
+            for i in range(amount)
+        ]
+        for name, func in (
+            ('xml etree', legacy_messages_xml),
+            ('xml', formats.messages_xml),
+            ('json', formats.messages_json),
+        ):
+            print(
+                '%4d messages, %4d users, %-9s: %8.2f us, %6d bytes' % (
+                    amount,
+                    len(users),
+                    name,
+                    measure(
+                        lambda: func(messages, amount, users),
+                        args.repeat,
+                    ),
+                    len(func(messages, amount, users)),
+                )
+            )
+    for name, func in (
+        ('xml etree', legacy_rooms_xml),
+        ('xml', formats.rooms_xml),
+        ('json', formats.rooms_json),
+    ):
+        print(
+            '%4d rooms, %-9s: %8.2f us, %6d bytes' % (
+                len(rooms),
+                name,
+                measure(lambda: func(rooms), args.repeat),
+                len(func(rooms)),
+            )
+        )
+
+
+## Room history as kept before @ref history.RoomHistory was introduced.
+#
+class LegacyHistory(object):
+
+    def __init__(self):
+        self.room = {'messages': [], 'base_index': 0}
+
+    def append(self, messages):
+        self.room['messages'].append(messages)
+        if len(self.room['messages']) > constants.TOO_BIG:
+            self.room['messages'] = self.room['messages'][2:]
+            self.room['base_index'] = 2
+
+    @property
+    def revision(self):
+        return len(self.room['messages'])
+
+    def since(self, index):
+        list = self.room['messages']
+        messages = []
+        if len(list) == 0:
+            return []
+        if len(list) < index:
+            index = index - self.room['base_index']
+        for batch in list[index:]:
+            for message in batch:
+                messages.append(message)
+        return messages
+
+
+## Count messages a polling client misses or receives twice.
+# @param history (object) room history
+# @param rounds (int) amount of append and fetch rounds
+# @returns (tuple) amount of lost and repeated messages
+#
+def fetch_errors(history, rounds):
+    rand = random.Random(0)
+    sent = 0
+    received = []
+    revision = 0
+    for i in range(rounds):
+        for j in range(rand.randint(1, 3)):
+            history.append([sent])
+            sent += 1
+        messages = history.since(revision)
+        revision = history.revision
+        received.extend(messages)
+    lost = sent - len(set(received))
+    return lost, len(received) - len(set(received))
+
+
+## Compare room histories.
+# @param args (object) program arguments
+#
+def bench_history(args):
+    for name, factory in (
+        ('legacy', LegacyHistory),
+        ('ring', history.RoomHistory),
+    ):
+        lost, repeated = fetch_errors(factory(), args.repeat)
+        room = factory()
+        for i in range(constants.TOO_BIG * 2):
+            room.append(['message %d' % i])
+        revision = room.revision
+        print(
+            '%-6s: %d lost, %d repeated, '
+            'append %6.2f us, fetch of 1 %6.2f us, fetch of all %6.2f us' % (
+                name,
+                lost,
+                repeated,
+                measure(lambda: room.append(['message']), args.repeat),
+                measure(lambda: room.since(room.revision - 1), args.repeat),
+                measure(lambda: room.since(0), args.repeat),
+            )
+        )
+
+
+## Send request and read whole response.
+# @param s (object) connected socket
+# @param request (str) request to send
+# @returns (str) response head
+#
+def http_request(s, request):
+    s.sendall(request)
+    data = ''
+    while constants.CRLF * 2 not in data:
+        chunk = s.recv(constants.BLOCK_SIZE)
+        if not chunk:
+            raise RuntimeError('Disconnected')
+        data += chunk
+    head, content = data.split(constants.CRLF * 2, 1)
+    length = 0
+    for line in head.split(constants.CRLF)[1:]:
+        title, _, value = line.partition(':')
+        if title.lower() == 'content-length':
+            length = int(value)
+    while len(content) < length:
+        chunk = s.recv(constants.BLOCK_SIZE)
+        if not chunk:
+            raise RuntimeError('Disconnected')
+        content += chunk
+    return head
+
+
+## Poll chat messages over a persistent connection.
+# @param args (tuple) server port, user cookie and duration in seconds
+# @returns (int) amount of responses received
+#
+def poll_messages(args):
+    port, cookie, duration = args
+    body = '<root><fetch id="0"/><room name="bench"/><messages/></root>'
+    request = (
+        'POST /get-messages HTTP/1.1\r\n'
+        'Host: localhost\r\n'
+        'Cookie: %s\r\n'
+        'Content-Length: %d\r\n'
+        '\r\n'
+        '%s'
+    ) % (cookie, len(body), body)
+    s = socket.create_connection(('127.0.0.1', port))
+    amount = 0
+    end = time.time() + duration
+    while time.time() < end:
+        http_request(s, request)
+        amount += 1
+    s.close()
+    return amount
+
+
+## Measure request rate of clients polling a room.
+# @param pool (object) pool of client processes
+# @param port (int) server port
+# @param clients (int) amount of clients
+# @param duration (float) time in seconds to measure
+# @returns (float) requests per second
+#
+# Every client keeps a persistent connection polling the same room.
+#
+def poll_rate(pool, port, clients, duration):
+    s = socket.create_connection(('127.0.0.1', port))
+    head = http_request(
+        s,
+        'GET /register?name=bench HTTP/1.1\r\n\r\n',
+    )
+    cookie = head.split('Set-Cookie: ', 1)[1].split(constants.CRLF)[0]
+    body = '<root><room name="bench"/></root>'
+    http_request(
+        s,
+        'POST /add-room HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s' % (
+            len(body),
+            body,
+        ),
+    )
+    s.close()
+    return sum(pool.map(
+        poll_messages,
+        [(port, cookie, duration)] * clients,
+    )) / duration
+
+
+## Compare request rate by amount of worker processes.
+# @param args (object) program arguments
+#
+# Workers share chat state of the polled room through their store.
+#
+def bench_workers(args):
+    pool = multiprocessing.Pool(args.clients)
+    for workers in args.workers:
+        port = random.randint(*PORTS)
+        process = tools.start_server(port, ['--workers', str(workers)])
+        try:
+            print(
+                '%2d workers, %3d clients: %8.0f requests/s' % (
+                    workers,
+                    args.clients,
+                    poll_rate(pool, port, args.clients, args.duration),
+                )
+            )
+        finally:
+            process.terminate()
+            process.wait()
+    pool.close()
+
+
+## Compare request rate by poll type.
+# @param args (object) program arguments
+#
+# Idle persistent connections are kept open meanwhile, every poll type but
+# epoll passes all of them to the kernel on every poll.
+#
+def bench_engines(args):
+    pool = multiprocessing.Pool(args.clients)
+    for engine in args.engines:
+        port = random.randint(*PORTS)
+        process = tools.start_server(port, ['--poll-type', engine])
+        idle = []
+        try:
+            for i in range(args.idle):
+                idle.append(socket.create_connection(('127.0.0.1', port)))
+            print(
+                '%-6s, %4d idle, %3d clients: %8.0f requests/s' % (
+                    engine,
+                    args.idle,
+                    args.clients,
+                    poll_rate(pool, port, args.clients, args.duration),
+                )
+            )
+        finally:
+            for s in idle:
+                s.close()
+            process.terminate()
+            process.wait()
+    pool.close()
+
+
+## Measure polling loop stalls while a static file keeps changing.
+# @param path (str) static file path
+# @param offload (bool) True to reload file in a worker thread
+# @param args (object) program arguments
+# @returns (tuple) mean and longest delay of probe timer, in seconds
+#
+# A probe timer runs every args.period seconds, its delay is how long
+# the loop was busy elsewhere. Without offload the file is reloaded from
+# the loop, as before @ref services.StaticCache.refresh.
+#
+def loop_delays(path, offload, args):
+    poller = server.Server(constants.TIMEOUT_DEFAULT)
+    pool = executor.Executor(poller)
+    static = services.StaticCache()
+    static.load(path, 'text/plain')
+    delays = []
+    last = [time.time()]
+
+    def probe():
+        now = time.time()
+        delays.append(max(0, now - last[0] - args.period))
+        last[0] = now
+
+    def change():
+        mtime = os.stat(path).st_mtime + 1
+        os.utime(path, (mtime, mtime))
+        if offload:
+            static.refresh(pool)
+        else:
+            static.load(path, 'text/plain')
+
+    poller.call_every(args.period, probe)
+    poller.call_every(args.change_period, change)
+    poller.call_later(args.duration, poller.close_server)
+    poller.run()
+    pool.shutdown()
+    return sum(delays) / len(delays), max(delays)
+
+
+## Compare polling loop stalls with and without executor.
+# @param args (object) program arguments
+#
+def bench_stall(args):
+    fd, path = tempfile.mkstemp(suffix='.txt')
+    try:
+        rand = random.Random(0)
+        words = ['word%d' % i for i in range(1000)]
+        os.write(fd, ' '.join(
+            rand.choice(words) for i in range(args.size // 8)
+        )[:args.size])
+        os.close(fd)
+        for name, offload in (('inline', False), ('executor', True)):
+            mean, longest = loop_delays(path, offload, args)
+            print(
+                '%-8s: %d bytes file, probe delay mean %6.2f ms, '
+                'max %6.2f ms' % (
+                    name,
+                    os.stat(path).st_size,
+                    mean * 1000,
+                    longest * 1000,
+                )
+            )
+    finally:
+        os.remove(path)
+
+
+## Compare message log syncs and time history reads.
+# @param args (object) program arguments
+#
+def bench_log(args):
+    directory = tempfile.mkdtemp()
+    try:
+        for name, group in (('each', 1), ('grouped', args.group)):
+            os.mkdir(os.path.join(directory, name))
+            log = messagelog.RoomLog(
+                os.path.join(directory, name, 'lobby'.encode('hex'))
+            )
+            start = time.time()
+            for i in range(args.messages):
+                log.append(['user: message %d' % i])
+                if (i + 1) % group == 0:
+                    log.flush()
+                    log.sync()
+            log.close()
+            print(
+                '%-8s: sync every %4d messages, append %8.2f us' % (
+                    name,
+                    group,
+                    (time.time() - start) * 1e6 / args.messages,
+                )
+            )
+        path = os.path.join(directory, 'grouped')
+        start = time.time()
+        log = messagelog.MessageLog(path, writable=False)
+        restored = log.restore()
+        print(
+            'restore : %d messages, tail of %d in %6.2f ms' % (
+                restored['lobby'][0],
+                len(restored['lobby'][1]),
+                (time.time() - start) * 1000,
+            )
+        )
+        print(
+            'read    : page of %d oldest messages %6.2f us' % (
+                constants.TOO_BIG,
+                measure(
+                    lambda: log.read('lobby', 1, constants.TOO_BIG),
+                    args.repeat,
+                ),
+            )
+        )
+        log.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+## Parse program arguments.
+# @returns (dict) program arguments
+#
+def parse_args():
+    """Parse program arguments."""
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='bench')
+
+    parse = subparsers.add_parser(
+        'parse',
+        help='request head parsing',
+    )
+    parse.add_argument(
+        '--repeat',
+        default=20000,
+        type=int,
+        help='amount of requests to parse. default: %(default)s',
+    )
+    parse.set_defaults(func=bench_parse)
+
+    serialize = subparsers.add_parser(
+        'serialize',
+        help='chat response serialization',
+    )
+    serialize.add_argument(
+        '--repeat',
+        default=2000,
+        type=int,
+        help='amount of responses to serialize. default: %(default)s',
+    )
+    serialize.add_argument(
+        '--messages',
+        default=constants.TOO_BIG,
+        type=int,
+        help='amount of messages in a full response. default: %(default)s',
+    )
+    serialize.add_argument(
+        '--users',
+        default=20,
+        type=int,
+        help='amount of room users and rooms. default: %(default)s',
+    )
+    serialize.set_defaults(func=bench_serialize)
+
+    room_history = subparsers.add_parser(
+        'history',
+        help='room history appends and fetches',
+    )
+    room_history.add_argument(
+        '--repeat',
+        default=20000,
+        type=int,
+        help='amount of operations. default: %(default)s',
+    )
+    room_history.set_defaults(func=bench_history)
+
+    workers = subparsers.add_parser(
+        'workers',
+        help='request rate of worker processes',
+    )
+    workers.add_argument(
+        '--workers',
+        default=[1, 2, 4],
+        type=int,
+        nargs='+',
+        help='amounts of worker processes to compare. default: %(default)s',
+    )
+    workers.add_argument(
+        '--clients',
+        default=8,
+        type=int,
+        help='amount of client processes. default: %(default)s',
+    )
+    workers.add_argument(
+        '--duration',
+        default=5.0,
+        type=float,
+        help='time in seconds to measure each amount. default: %(default)s',
+    )
+    workers.set_defaults(func=bench_workers)
+
+    engines = subparsers.add_parser(
+        'engines',
+        help='request rate of poll types',
+    )
+    engines.add_argument(
+        '--engines',
+        default=sorted(ENGINES),
+        choices=sorted(ENGINES),
+        nargs='+',
+        help='poll types to compare. default: %(default)s',
+    )
+    engines.add_argument(
+        '--idle',
+        default=500,
+        type=int,
+        help='amount of idle connections. default: %(default)s',
+    )
+    engines.add_argument(
+        '--clients',
+        default=8,
+        type=int,
+        help='amount of client processes. default: %(default)s',
+    )
+    engines.add_argument(
+        '--duration',
+        default=5.0,
+        type=float,
+        help='time in seconds to measure each poll type. default: %(default)s',
+    )
+    engines.set_defaults(func=bench_engines)
+
+    stall = subparsers.add_parser(
+        'stall',
+        help='polling loop stalls of static file reloads',
+    )
+    stall.add_argument(
+        '--size',
+        default=constants.STATIC_MAX_SIZE,
+        type=int,
+        help='size of static file. default: %(default)s',
+    )
+    stall.add_argument(
+        '--period',
+        default=0.005,
+        type=float,
+        help='time in seconds between probes. default: %(default)s',
+    )
+    stall.add_argument(
+        '--change-period',
+        default=0.25,
+        type=float,
+        help='time in seconds between file changes. default: %(default)s',
+    )
+    stall.add_argument(
+        '--duration',
+        default=5.0,
+        type=float,
+        help='time in seconds to measure each mode. default: %(default)s',
+    )
+    stall.set_defaults(func=bench_stall)
+
+    message_log = subparsers.add_parser(
+        'log',
+        help='message log syncs and reads',
+    )
+    message_log.add_argument(
+        '--messages',
+        default=2000,
+        type=int,
+        help='amount of messages to append. default: %(default)s',
+    )
+    message_log.add_argument(
+        '--group',
+        default=100,
+        type=int,
+        help='amount of messages synced together. default: %(default)s',
+    )
+    message_log.add_argument(
+        '--repeat',
+        default=2000,
+        type=int,
+        help='amount of page reads. default: %(default)s',
+    )
+    message_log.set_defaults(func=bench_log)
+
+    return parser.parse_args()
+
+
+## Main implementation.
+def main():
+    """Main implementation."""
+
+    args = parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+## @package HTTP--Chat.buffers Connection buffers.
+## @file buffers.py Implementation of @ref HTTP--Chat.buffers
+#
+
+import base
+import collections
+import constants
+
+
+## Receive buffer.
+#
+# Growable bytearray filled in place by recv_into. Data is consumed by moving
+# a read cursor, unread data is moved to the front only when room is needed.
+# Slicing returns copies of unread data relative to the cursor, so the buffer
+# can stand in for a string when parsing.
+#
+class RecvBuffer(base.Base):
+
+    ## Constructor.
+    # @param size (int) initial capacity
+    #
+    def __init__(self, size=constants.BLOCK_SIZE):
+        super(RecvBuffer, self).__init__()
+        self._data = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    ## Amount of unread data.
+    def __len__(self):
+        return self._end - self._start
+
+    ## Copy of unread data slice.
+    # @param key (slice) slice relative to unread data
+    # @returns (str) data
+    #
+    def __getitem__(self, key):
+        start, stop, step = key.indices(len(self))
+        return str(self._data[self._start + start:self._start + stop:step])
+
+    ## Find sub string in unread data.
+    # @param sub (str) string to look for
+    # @param start (int) offset to start looking from
+    # @returns (int) offset of sub string, -1 if not found
+    #
+    def find(self, sub, start=0):
+        n = self._data.find(sub, self._start + start, self._end)
+        if n == -1:
+            return -1
+        return n - self._start
+
+    ## Mark data as read.
+    # @param n (int) amount of data read
+    #
+    def consume(self, n):
+        self._start += min(n, len(self))
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    ## Read data.
+    # @param n (int) maximum amount to read
+    # @returns (str) data read
+    #
+    def take(self, n):
+        data = self[:n]
+        self.consume(len(data))
+        return data
+
+    ## Append data.
+    # @param data (str) data to append
+    #
+    def extend(self, data):
+        self._reserve(len(data))
+        self._data[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    ## Receive data from socket into buffer.
+    # @param socket (object) socket to receive from
+    # @param size (int) maximum amount to receive
+    # @returns (int) amount received, 0 on end of stream
+    #
+    def recv_into(self, socket, size):
+        self._reserve(size)
+        view = memoryview(self._data)[self._end:self._end + size]
+        try:
+            n = socket.recv_into(view, size)
+        finally:
+            del view
+        self._end += n
+        return n
+
+    ## Make room for more data at end of buffer.
+    # @param size (int) room needed
+    #
+    def _reserve(self, size):
+        if self._end + size <= len(self._data):
+            return
+        unread = len(self)
+        if self._start > 0:
+            self._data[:unread] = self._data[self._start:self._end]
+            self._start, self._end = 0, unread
+        if unread + size > len(self._data):
+            self._data.extend(
+                bytearray(max(unread + size - len(self._data), len(self._data)))
+            )
+
+
+## Send queue.
+#
+# Pending chunks are sent through memoryviews with a send offset instead of
+# re-slicing a string. Small chunks are coalesced into a single bytearray so
+# headers and small content still go out in a single send, large chunks are
+# queued as is.
+#
+class SendQueue(base.Base):
+
+    ## Constructor.
+    # @param coalesce (int) maximum size of coalesced chunk
+    #
+    def __init__(self, coalesce=constants.BLOCK_SIZE):
+        super(SendQueue, self).__init__()
+        self._coalesce = coalesce
+        self._chunks = collections.deque()
+        self._offset = 0
+        self._size = 0
+        self._sent = 0
+
+    ## Amount of pending data.
+    def __len__(self):
+        return self._size
+
+    ## Retrieve amount of data sent so far.
+    @property
+    def sent(self):
+        return self._sent
+
+    ## Queue data.
+    # @param data (str) data to send
+    #
+    def append(self, data):
+        if not data:
+            return
+        self._size += len(data)
+        if len(data) > self._coalesce:
+            self._chunks.append(data)
+        elif (
+            self._chunks and
+            isinstance(self._chunks[-1], bytearray) and
+            len(self._chunks[-1]) + len(data) <= self._coalesce and
+            (len(self._chunks) > 1 or self._offset == 0)
+        ):
+            self._chunks[-1].extend(data)
+        else:
+            self._chunks.append(bytearray(data))
+
+    ## Send as much pending data as socket accepts.
+    # @param socket (object) socket to send to
+    # @throws socket.error If socket would block or failed
+    #
+    def send(self, socket):
+        while self._chunks:
+            view = memoryview(self._chunks[0])[self._offset:]
+            try:
+                n = socket.send(view)
+            finally:
+                del view
+            self._size -= n
+            self._sent += n
+            self._offset += n
+            if self._offset == len(self._chunks[0]):
+                self._chunks.popleft()
+                self._offset = 0
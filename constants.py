@@ -5,27 +5,110 @@
 ## Max block size to read.
 BLOCK_SIZE = 8192
 
+## Time in seconds between expiry checks of inactive users.
+CHECK_PERIOD = 1
+
+## zlib compression level of responses.
+COMPRESS_LEVEL = 6
+
+## Minimal fraction of size compression must save to be used.
+COMPRESS_MIN_RATIO = 0.1
+
+## Minimal response size in bytes worth compressing on the fly.
+COMPRESS_MIN_SIZE = 1024
+
 ## Characters indicating new line.
 CRLF = '\r\n'
 
 ## Binary new line.
 CRLF_BIN = CRLF.encode('utf-8')
 
+## Time in seconds between modification checks of cached static files.
+STATIC_CHECK_PERIOD = 1
+
+## Time in seconds between syncs of message logs to disk.
+LOG_SYNC_PERIOD = 0.1
+
+## Maximum size in bytes of static file kept in memory.
+STATIC_MAX_SIZE = 1024 * 1024
+
+## Time in seconds clients may use static files without revalidating.
+CACHE_MAX_AGE = 0
+
 ## Time in seconds until a user is defined as inactive in a room.
 EXPIRED_PERIOD = 60 * 5
 
+## Time in seconds between presence updates of a user sent to other workers.
+TOUCH_PERIOD = 5
+
 ## Communication protocol
 HTTP_SIGNATURE = 'HTTP/1.1'
 
+## Time in seconds an idle persistent connection is kept open.
+KEEP_ALIVE_TIMEOUT = 15
+
+## Time in seconds a client has to send a whole request once it started.
+REQUEST_TIMEOUT = 10
+
+## Time in seconds between server state log entries.
+STATS_PERIOD = 60
+
+## Maximum time in seconds a long-polling request is held.
+LONG_POLL_TIMEOUT = 30
+
+## Time in seconds between events on an otherwise idle event stream.
+STREAM_HEARTBEAT = 15
+
+## Maximum size of a WebSocket message.
+MAX_FRAME_SIZE = 65536
+
+## Size of file blocks read by worker threads.
+FILE_BLOCK_SIZE = 65536
+
+## Amount of worker threads running blocking work.
+EXECUTOR_THREADS = 4
+
+## Maximum amount of connections waiting to be accepted.
+LISTEN_BACKLOG = 128
+
+## Time in seconds accepting pauses once out of file descriptors.
+ACCEPT_BACKOFF = 0.1
+
 ## Maximum header length.
 MAX_HEADER_LEN = 4096
 
+## Maximum request line length.
+MAX_REQUEST_LINE_LEN = 8192
+
 ## Maximum header amount.
 MAX_HEADER_AMOUNT = 100
 
-## Time in seconds to sleep until I/O
+## Maximum request head length, request line and headers together.
+MAX_HEAD_LEN = 65536
+
+## Time in milliseconds to sleep until I/O
 TIMEOUT_DEFAULT = 1000
 
-## Maximum message storage length.
+## Maximum amount of messages kept per room.
 # upon reching this length old messages will be discarded when new ones arrive.
 TOO_BIG = 100
+
+## Maximum amount of serialized message responses cached per room.
+SNAPSHOT_CACHE_SIZE = 16
+
+## Default amount of messages in a page of older history.
+HISTORY_PAGE_SIZE = 50
+
+## Maximum amount of messages in a page of older history.
+HISTORY_PAGE_MAX = 200
+
+## Upper bounds in seconds of request latency histogram buckets.
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+)
+
+## Upper bounds in seconds of polling loop iteration histogram buckets.
+LOOP_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+
+## Upper bounds of ready events per poll histogram buckets.
+EVENTS_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
@@ -31,8 +31,21 @@ class CommonEvents(base.Base):
     def register(self, fd, event):
         pass
 
+    ## Change events of an already registered I/O object.
+    # @param fd (int) I/O object
+    # @param event (int) new events to look for
+    #
+    def modify(self, fd, event):
+        pass
+
+    ## Remove I/O object from poller.
+    # @param fd (int) I/O object
+    #
+    def unregister(self, fd):
+        pass
+
     ## Begin pollong process.
-    # @param timeout (float) max time window for single poll
+    # @param timeout (float) max time window for single poll in milliseconds
     # @returns (list) pairs of fd and events
     #
     def poll(self, timeout):
@@ -56,11 +69,54 @@ if os.name != 'nt':
         def register(self, fd, event):
             self._poller.register(fd, event)
 
+        ## @copydoc CommonEvents#modify
+        def modify(self, fd, event):
+            self._poller.modify(fd, event)
+
+        ## @copydoc CommonEvents#unregister
+        def unregister(self, fd):
+            self._poller.unregister(fd)
+
         ## @copydoc CommonEvents#poll
         def poll(self, timeout):
             return self._poller.poll(timeout)
 
 
+if hasattr(select, 'epoll'):
+    ## Epoll logic for Linux platforms.
+    #
+    # Registrations are kept by the kernel between polls, so only changes
+    # of interest cost a system call.
+    #
+    class EpollEvents(CommonEvents):
+
+        ## Readable class name.
+        NAME = 'Epoll'
+
+        ## Constructor.
+        def __init__(self):
+            super(EpollEvents, self).__init__()
+            self._poller = select.epoll()
+
+        ## @copydoc CommonEvents#register
+        def register(self, fd, event):
+            self._poller.register(fd, event)
+
+        ## @copydoc CommonEvents#modify
+        def modify(self, fd, event):
+            self._poller.modify(fd, event)
+
+        ## @copydoc CommonEvents#unregister
+        def unregister(self, fd):
+            self._poller.unregister(fd)
+
+        ## @copydoc CommonEvents#poll
+        def poll(self, timeout):
+            return self._poller.poll(
+                -1 if timeout is None else timeout / 1000.0
+            )
+
+
 ## Mimicing poll behaviour using select on Windows platforms.
 #
 class SelectEvents(CommonEvents):
@@ -77,6 +133,14 @@ class SelectEvents(CommonEvents):
     def register(self, fd, event):
         self._file_descriptors[fd] = event
 
+    ## @copydoc CommonEvents#modify
+    def modify(self, fd, event):
+        self._file_descriptors[fd] = event
+
+    ## @copydoc CommonEvents#unregister
+    def unregister(self, fd):
+        del self._file_descriptors[fd]
+
     ## @copydoc CommonEvents#poll
     def poll(self, timeout):
         rlist, wlist, xlist = [], [], []
@@ -90,14 +154,18 @@ class SelectEvents(CommonEvents):
             if event & SelectEvents.POLLERR:
                 xlist.append(fd)
 
-        r, w, x = select.select(rlist, wlist, xlist, timeout)
+        r, w, x = select.select(
+            rlist,
+            wlist,
+            xlist,
+            None if timeout is None else timeout / 1000.0,
+        )
 
         polled = {}
-        for fd in r + w + x:
-            if fd in r:
-                polled[fd] = SelectEvents.POLLIN
-            if fd in w:
-                polled[fd] = SelectEvents.POLLOUT
-            if fd in x:
-                polled[fd] = SelectEvents.POLLERR
+        for fd in r:
+            polled[fd] = polled.get(fd, 0) | SelectEvents.POLLIN
+        for fd in w:
+            polled[fd] = polled.get(fd, 0) | SelectEvents.POLLOUT
+        for fd in x:
+            polled[fd] = polled.get(fd, 0) | SelectEvents.POLLERR
         return polled.items()
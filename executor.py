@@ -0,0 +1,139 @@
+## @package HTTP--Chat.executor Executor module.
+## @file executor.py Implementation of @ref HTTP--Chat.executor
+#
+# Blocking work, such as file system access, runs in a pool of threads so
+# the polling loop never waits for it.
+#
+
+import Queue
+import base
+import collections
+import constants
+import errno
+import pollable
+import socket
+import sys
+import threading
+import util
+
+
+## Work submitted to executor.
+#
+class Task(base.Base):
+
+    ## Constructor.
+    # @param func (callable) function to run in a worker thread
+    # @param args (tuple) function arguments
+    # @param callback (callable) called from polling loop with result and
+    # exception, one of them None
+    #
+    def __init__(self, func, args, callback):
+        super(Task, self).__init__()
+        self._func = func
+        self._args = args
+        self._callback = callback
+        self._result = None
+        self._error = None
+        self._cancelled = False
+
+    ## Retrieve whether task was cancelled.
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    ## Cancel task, its callback is not called.
+    #
+    # A task already running still runs to its end.
+    #
+    def cancel(self):
+        self._cancelled = True
+
+    ## Run function, from worker thread.
+    def run(self):
+        try:
+            self._result = self._func(*self._args)
+        except Exception:
+            self._error = sys.exc_info()[1]
+
+    ## Call callback, from polling loop.
+    def complete(self):
+        if not self._cancelled:
+            self._callback(self._result, self._error)
+
+
+## Pool of worker threads.
+#
+# Finished tasks are queued for the polling loop and a byte is written to a
+# socket pair whose other end the loop polls, the loop then runs their
+# callbacks. Callbacks changing events of I/O objects must update them, see
+# @ref server.Server.update.
+#
+class Executor(base.Base):
+
+    ## Constructor.
+    # @param poller (object) related poller
+    # @param threads (int) amount of worker threads
+    #
+    def __init__(self, poller, threads=constants.EXECUTOR_THREADS):
+        super(Executor, self).__init__()
+        self._tasks = Queue.Queue()
+        self._done = collections.deque()
+        notify, self._wakeup = util.socketpair()
+        self._wakeup.setblocking(False)
+        poller.register(pollable.Notifier(notify, poller, self._complete))
+        self._threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    ## Submit function to run in a worker thread.
+    # @param callback (callable) called from polling loop with result and
+    # exception, one of them None
+    # @param func (callable) function to run
+    # @param args (tuple) function arguments
+    # @returns (Task) submitted task
+    #
+    def submit(self, callback, func, *args):
+        task = Task(func, args, callback)
+        self._tasks.put(task)
+        return task
+
+    ## Stop worker threads once queued tasks are done.
+    def shutdown(self):
+        for thread in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._wakeup.close()
+
+    ## Worker thread main loop.
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            if not task.cancelled:
+                task.run()
+            self._done.append(task)
+            try:
+                self._wakeup.send('x')
+            except socket.error as e:
+                # a full socket already wakes the loop, a closed one has no
+                # loop left to wake
+                if e.errno not in (errno.EWOULDBLOCK, errno.EPIPE):
+                    raise
+
+    ## Run callbacks of finished tasks.
+    def _complete(self):
+        while self._done:
+            task = self._done.popleft()
+            try:
+                task.complete()
+            except Exception:
+                self.logger.debug(
+                    'Task %s had unexpected exception:',
+                    task,
+                    exc_info=True,
+                )
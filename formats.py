@@ -0,0 +1,177 @@
+## @package HTTP--Chat.formats Wire formats module.
+## @file formats.py Implementation of @ref HTTP--Chat.formats
+#
+# Chat responses are written directly as text, in either XML or JSON,
+# without building an element tree first.
+#
+
+import json
+import util
+
+## XML media type.
+XML = 'text/xml'
+
+## JSON media type.
+JSON = 'application/json'
+
+## Supported media types by order of preference.
+SUPPORTED = (XML, JSON)
+
+## Compact JSON encoder, shared by everything written as JSON.
+ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+
+## Choose response format.
+# @param dialogue (dict) application context.
+# @returns (str) media type of response, Vary header is updated.
+#
+def choose(dialogue):
+
+    util.add_vary(dialogue, 'Accept')
+    return util.choose_type(
+        dialogue['request']['headers'].get('Accept', ''),
+        SUPPORTED,
+    )
+
+
+## Escape XML attribute value, the way ElementTree does.
+# @param value (unicode) attribute value.
+# @returns (unicode) escaped value.
+#
+def _escape(value):
+
+    if '&' in value:
+        value = value.replace('&', '&amp;')
+    if '<' in value:
+        value = value.replace('<', '&lt;')
+    if '>' in value:
+        value = value.replace('>', '&gt;')
+    if '"' in value:
+        value = value.replace('"', '&quot;')
+    if '\n' in value:
+        value = value.replace('\n', '&#10;')
+    return value
+
+
+## Write list of elements holding a single attribute.
+# @param parts (list) output parts to append to.
+# @param tag (str) list element tag.
+# @param item (str) item element tag.
+# @param attrib (str) item attribute name.
+# @param values (iterable) attribute values.
+#
+def _xml_list(parts, tag, item, attrib, values):
+
+    start = len(parts)
+    parts.append('<%s>' % tag)
+    for value in values:
+        parts.append('<%s %s="%s" />' % (item, attrib, _escape(value)))
+    if len(parts) == start + 1:
+        parts[start] = '<%s />' % tag
+    else:
+        parts.append('</%s>' % tag)
+
+
+## Write chat messages response as XML.
+# @param messages (list) new messages.
+# @param revision (int) room revision, sent only along with messages.
+# @param users (iterable) room users.
+# @returns (str) serialized response.
+#
+def messages_xml(messages, revision, users):
+
+    parts = ['<root>']
+    _xml_list(parts, 'messages', 'message', 'text', messages)
+    if messages:
+        parts.append('<id revision="%s" />' % revision)
+    _xml_list(parts, 'users', 'user', 'name', users)
+    parts.append('</root>')
+    return u''.join(parts).encode('ascii', 'xmlcharrefreplace')
+
+
+## Write chat messages response as JSON.
+# @param messages (list) new messages.
+# @param revision (int) room revision, sent only along with messages.
+# @param users (iterable) room users.
+# @returns (str) serialized response.
+#
+def messages_json(messages, revision, users):
+
+    response = {
+        'messages': messages,
+        'users': list(users),
+    }
+    if messages:
+        response['revision'] = revision
+    return ENCODER.encode(response)
+
+
+## Write page of older chat messages as XML.
+# @param messages (list) messages, oldest first.
+# @param first (int) sequence number of first message, sent only along with
+# messages.
+# @returns (str) serialized response.
+#
+def history_xml(messages, first):
+
+    parts = ['<root>']
+    _xml_list(parts, 'messages', 'message', 'text', messages)
+    if messages:
+        parts.append('<id first="%s" />' % first)
+    parts.append('</root>')
+    return u''.join(parts).encode('ascii', 'xmlcharrefreplace')
+
+
+## Write page of older chat messages as JSON.
+# @param messages (list) messages, oldest first.
+# @param first (int) sequence number of first message, sent only along with
+# messages.
+# @returns (str) serialized response.
+#
+def history_json(messages, first):
+
+    response = {
+        'messages': messages,
+    }
+    if messages:
+        response['first'] = first
+    return ENCODER.encode(response)
+
+
+## Write chat rooms response as XML.
+# @param rooms (iterable) room names.
+# @returns (str) serialized response.
+#
+def rooms_xml(rooms):
+
+    parts = []
+    _xml_list(parts, 'root', 'room', 'name', rooms)
+    return u''.join(parts).encode('ascii', 'xmlcharrefreplace')
+
+
+## Write chat rooms response as JSON.
+# @param rooms (iterable) room names.
+# @returns (str) serialized response.
+#
+def rooms_json(rooms):
+
+    return ENCODER.encode({'rooms': list(rooms)})
+
+
+## Serializers of chat messages response by media type.
+MESSAGES = {
+    XML: messages_xml,
+    JSON: messages_json,
+}
+
+## Serializers of older chat messages page by media type.
+HISTORY = {
+    XML: history_xml,
+    JSON: history_json,
+}
+
+## Serializers of chat rooms response by media type.
+ROOMS = {
+    XML: rooms_xml,
+    JSON: rooms_json,
+}
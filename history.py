@@ -0,0 +1,88 @@
+## @package HTTP--Chat.history Room history module.
+## @file history.py Implementation of @ref HTTP--Chat.history
+#
+
+import base
+import collections
+import constants
+import itertools
+
+
+## Bounded message history of a chat room.
+#
+# Every message gets a sequence number, one above the previous message. The
+# room revision is the sequence number of its last message, so clients fetch
+# messages since the revision they already have. Oldest messages are dropped
+# once history is full, a client that fell behind gets all messages still
+# kept.
+#
+class RoomHistory(base.Base):
+
+    ## Constructor.
+    # @param size (int) maximum amount of messages kept
+    # @param messages (iterable) last messages, restored from a log
+    # @param revision (int) sequence number of last of messages
+    #
+    def __init__(self, size=constants.TOO_BIG, messages=(), revision=0):
+        super(RoomHistory, self).__init__()
+        self._messages = collections.deque(messages, maxlen=size)
+        self._revision = revision
+
+    ## Amount of messages kept.
+    def __len__(self):
+        return len(self._messages)
+
+    ## Retrieve revision, sequence number of last message.
+    @property
+    def revision(self):
+        return self._revision
+
+    ## Retrieve sequence number of oldest message kept.
+    @property
+    def first(self):
+        return self._revision - len(self._messages) + 1
+
+    ## Add messages.
+    # @param messages (list) messages to add
+    # @returns (int) new revision
+    #
+    def append(self, messages):
+        self._messages.extend(messages)
+        self._revision += len(messages)
+        return self._revision
+
+    ## Check whether there are messages past revision.
+    # @param revision (int) revision client has
+    # @returns (bool) True if messages since revision are available
+    #
+    # A revision ahead of history, kept by a client since before the server
+    # restarted, counts as outdated.
+    #
+    def newer(self, revision):
+        return revision != self._revision and len(self._messages) > 0
+
+    ## Get messages within range of sequence numbers.
+    # @param first (int) sequence number of first message
+    # @param last (int) sequence number of last message
+    # @returns (list) messages still kept within range
+    #
+    def between(self, first, last):
+        start = max(first, self.first) - self.first
+        stop = min(last, self._revision) - self.first + 1
+        if start >= stop:
+            return []
+        return list(itertools.islice(self._messages, start, stop))
+
+    ## Get messages since revision.
+    # @param revision (int) revision client has
+    # @returns (list) messages with sequence number above revision
+    #
+    def since(self, revision):
+        if revision > self._revision:
+            revision = 0
+        amount = min(self._revision - revision, len(self._messages))
+        if amount <= 0:
+            return []
+        messages = list(itertools.islice(reversed(self._messages), amount))
+        messages.reverse()
+        return messages
@@ -0,0 +1,246 @@
+## @package HTTP--Chat.httpparser HTTP request parser module.
+## @file httpparser.py Implementation of @ref HTTP--Chat.httpparser
+#
+
+import Cookie
+import base
+import constants
+import urlparse
+
+## Binary new line.
+CRLF = constants.CRLF_BIN
+
+## End of request head.
+END = CRLF * 2
+
+
+## Case insensitive header dictionary.
+#
+# Header names are stored lower case.
+#
+class Headers(dict):
+
+    ## Constructor.
+    # @param headers (dict) initial headers
+    #
+    def __init__(self, headers=None):
+        super(Headers, self).__init__()
+        if headers is not None:
+            self.update(headers)
+
+    def __getitem__(self, key):
+        return super(Headers, self).__getitem__(key.lower())
+
+    def __setitem__(self, key, value):
+        super(Headers, self).__setitem__(key.lower(), value)
+
+    def __delitem__(self, key):
+        super(Headers, self).__delitem__(key.lower())
+
+    def __contains__(self, key):
+        return super(Headers, self).__contains__(key.lower())
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        return super(Headers, self).get(key.lower(), default)
+
+    def pop(self, key, *args):
+        return super(Headers, self).pop(key.lower(), *args)
+
+    def setdefault(self, key, default=None):
+        return super(Headers, self).setdefault(key.lower(), default)
+
+    ## Add headers, replacing existing ones.
+    # @param headers (dict) headers to add
+    #
+    def update(self, headers):
+        for key, value in headers.items():
+            self[key] = value
+
+
+## Parsed request head.
+#
+# Query parameters and cookies are only parsed when first used.
+#
+class Request(base.Base):
+
+    ## Constructor.
+    # @param method (str) request method
+    # @param uri (str) request URI
+    # @param headers (Headers) request headers
+    #
+    def __init__(self, method, uri, headers):
+        super(Request, self).__init__()
+        self._method = method
+        self._uri = uri
+        self._path, _, self._query = uri.partition('?')
+        self._headers = headers
+        self._params = None
+        self._cookies = None
+
+    ## Retrieve method.
+    @property
+    def method(self):
+        return self._method
+
+    ## Retrieve URI.
+    @property
+    def uri(self):
+        return self._uri
+
+    ## Retrieve URI path.
+    @property
+    def path(self):
+        return self._path
+
+    ## Retrieve URI query string.
+    @property
+    def query(self):
+        return self._query
+
+    ## Retrieve headers.
+    @property
+    def headers(self):
+        return self._headers
+
+    ## Retrieve query parameters.
+    @property
+    def params(self):
+        if self._params is None:
+            self._params = urlparse.parse_qs(self._query)
+        return self._params
+
+    ## Retrieve cookies.
+    @property
+    def cookies(self):
+        if self._cookies is None:
+            self._cookies = Cookie.SimpleCookie(
+                str(self._headers.get('Cookie', ''))
+            )
+        return self._cookies
+
+
+## Incremental request head parser.
+#
+# Every call resumes scanning where the previous one stopped, so data already
+# examined is not searched again no matter how the head was split between
+# reads. Limits are enforced on raw data of incomplete heads, a line is
+# rejected as soon as it grows too long even if its end was not received yet.
+# Buffer is left untouched until the whole head is received, then the head is
+# taken out of it and split at once, so buffer holds up to a whole head.
+#
+class RequestParser(base.Base):
+
+    ## Constructor.
+    # @param max_line (int) maximum request line length
+    # @param max_header (int) maximum header line length
+    # @param max_amount (int) maximum amount of headers
+    # @param max_head (int) maximum length of whole head
+    #
+    def __init__(
+        self,
+        max_line=constants.MAX_REQUEST_LINE_LEN,
+        max_header=constants.MAX_HEADER_LEN,
+        max_amount=constants.MAX_HEADER_AMOUNT,
+        max_head=constants.MAX_HEAD_LEN,
+    ):
+        super(RequestParser, self).__init__()
+        self._max_line = max_line
+        self._max_header = max_header
+        self._max_amount = max_amount
+        self._max_head = max_head
+        self.reset()
+
+    ## Retrieve amount of data buffer holds at most while parsing a head.
+    #
+    # Head along with the empty line ending it, anything longer is rejected
+    # before this much is received.
+    #
+    @property
+    def max_buffered(self):
+        return self._max_head + len(END)
+
+    ## Prepare parser for next request.
+    def reset(self):
+        self._scan = 0
+        self._start = 0
+        self._lines = 0
+
+    ## Parse request head if it was received completely.
+    # @param buf (RecvBuffer) received data
+    # @returns (Request) parsed request, None if head is incomplete
+    # @throws RuntimeError If head violates HTTP protocol or limits
+    #
+    def parse(self, buf):
+        if self._scan == 0:
+            # empty lines preceding request line are ignored
+            while buf[:len(CRLF)] == CRLF:
+                buf.consume(len(CRLF))
+        n = buf.find(END, self._scan)
+        if n != -1:
+            head = buf.take(n).decode('utf-8')
+            buf.consume(len(END))
+            self.reset()
+            return self._build(head)
+
+        limit = self._max_header if self._lines else self._max_line
+        n = buf.find(CRLF, self._start)
+        while n != -1:
+            if n - self._start > limit:
+                raise RuntimeError('Header too long')
+            self._lines += 1
+            if self._lines > self._max_amount + 1:
+                raise RuntimeError('Too many headers')
+            limit = self._max_header
+            self._start = n + len(CRLF)
+            n = buf.find(CRLF, self._start)
+        size = len(buf)
+        if size >= self.max_buffered:
+            raise RuntimeError('Request head too long')
+        # carriage return may be the first half of the line end
+        if size - self._start > limit and (
+            size - self._start > limit + 1 or
+            buf[size - 1:size] != CRLF[:1]
+        ):
+            raise RuntimeError('Header too long')
+        self._scan = max(size - len(END) + 1, 0)
+        return None
+
+    ## Build request out of head.
+    # @param head (unicode) request line followed by header lines
+    # @returns (Request) parsed request
+    # @throws RuntimeError If head violates HTTP protocol or limits
+    #
+    def _build(self, head):
+        if len(head) > self._max_head:
+            raise RuntimeError('Request head too long')
+        lines = head.split(constants.CRLF)
+        if len(lines) > self._max_amount + 1:
+            raise RuntimeError('Too many headers')
+        # no single line can exceed limits of a short head
+        if len(head) > min(self._max_line, self._max_header) and (
+            len(lines[0]) > self._max_line or
+            any(len(line) > self._max_header for line in lines[1:])
+        ):
+            raise RuntimeError('Header too long')
+        req_comps = lines[0].split(' ', 2)
+        if len(req_comps) != 3:
+            raise RuntimeError('Incomplete HTTP protocol')
+        method, uri, signature = req_comps
+        if signature != constants.HTTP_SIGNATURE:
+            raise RuntimeError('Not HTTP protocol')
+        headers = Headers()
+        for line in lines[1:]:
+            title, sep, data = line.partition(':')
+            if not sep:
+                raise RuntimeError('Invalid Header')
+            # names are lower case already, skip conversion
+            dict.__setitem__(headers, title.rstrip().lower(), data.strip())
+        if 'content-length' in headers:
+            try:
+                headers['content-length'] = int(headers['content-length'])
+            except ValueError:
+                raise RuntimeError('Invalid Content-Length')
+        return Request(method, uri, headers)
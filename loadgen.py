@@ -0,0 +1,693 @@
+#!usr/bin/python
+
+## @package HTTP--Chat.loadgen Load generator module.
+## @file loadgen.py Implementation of @ref HTTP--Chat.loadgen
+#
+# Simulated browser clients doing what home.html, rooms.html and chat.html
+# do, run against a local server. Each client process runs its share of
+# clients on a @ref server.Server polling loop, then reports throughput,
+# latency percentiles, errors and message delivery lag.
+#
+
+import argparse
+import base
+import buffers
+import collections
+import constants
+import errno
+import events
+import httpparser
+import json
+import multiprocessing
+import pollable
+import random
+import server
+import shlex
+import socket
+import time
+import tools
+import urllib
+import urllib2
+
+
+## Text of simulated messages, followed by time sent.
+MESSAGE_PREFIX = 'load '
+
+## Percentiles reported.
+PERCENTILES = (50, 90, 99)
+
+## Poll types by name.
+EVENT_TYPES = {
+    event.NAME: event for event in events.CommonEvents.__subclasses__()
+}
+
+
+## Create empty statistics.
+# @returns (dict) statistics of a client process
+#
+# Statistics are plain dicts, they are sent back from client processes.
+#
+def new_stats():
+    return {
+        'latency': {},
+        'errors': {},
+        'lag': [],
+        'sent': 0,
+        'received': 0,
+    }
+
+
+## Add statistics of a client process.
+# @param total (dict) statistics to add to
+# @param stats (dict) statistics to add
+#
+def merge_stats(total, stats):
+    for name, latencies in stats['latency'].items():
+        total['latency'].setdefault(name, []).extend(latencies)
+    for kind, amount in stats['errors'].items():
+        total['errors'][kind] = total['errors'].get(kind, 0) + amount
+    total['lag'].extend(stats['lag'])
+    total['sent'] += stats['sent']
+    total['received'] += stats['received']
+
+
+## Get percentiles.
+# @param values (list) values
+# @returns (list) reported percentiles and maximum of values
+#
+def percentiles(values):
+    values = sorted(values)
+    return [
+        values[min(len(values) - 1, len(values) * p // 100)]
+        for p in PERCENTILES
+    ] + [values[-1]]
+
+
+## Client side of a persistent HTTP connection.
+#
+# Requests are sent in order, each once the response to the previous one is
+# received. Only responses of known length are read, event streams and
+# upgraded connections are not supported.
+#
+class HttpClient(pollable.Pollable):
+
+    ## Constructor.
+    # @param address (tuple) server address
+    # @param poller (object) related poller
+    # @param on_close (callable) called with client once closed
+    # @param block_size (int) maximum amount to read
+    #
+    # Connects without blocking, requests are queued meanwhile.
+    #
+    def __init__(
+        self,
+        address,
+        poller,
+        on_close,
+        block_size=constants.BLOCK_SIZE,
+    ):
+        super(HttpClient, self).__init__()
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setblocking(False)
+        self._socket.connect_ex(address)
+        self._poller = poller
+        self._on_close = on_close
+        self._block_size = block_size
+        self._buf = buffers.RecvBuffer(block_size)
+        self._outgoing = buffers.SendQueue(block_size)
+        self._requests = collections.deque()
+        self._response = None
+        self._closed = False
+
+    ## Retrieve socket.
+    @property
+    def socket(self):
+        return self._socket
+
+    ## Retrieve related poller.
+    @property
+    def poller(self):
+        return self._poller
+
+    ## Queue request.
+    # @param data (str) whole request, head and content
+    # @param callback (callable) called with status code, headers and
+    # content of response
+    #
+    def request(self, data, callback):
+        if self._closed:
+            return
+        self._requests.append((data, callback))
+        if len(self._requests) == 1:
+            self._outgoing.append(data)
+            self.poller.update(self)
+
+    ## Close connection.
+    def close(self):
+        self.onerror()
+
+    ## @copydoc pollable.Pollable#getfd
+    def getfd(self):
+        return self.socket.fileno()
+
+    ## @copydoc pollable.Pollable#getevents
+    def getevents(self):
+        e = events.CommonEvents.POLLERR | events.CommonEvents.POLLIN
+        if self._outgoing:
+            e |= events.CommonEvents.POLLOUT
+        return e
+
+    ## @copydoc pollable.Pollable#onwrite
+    def onwrite(self):
+        try:
+            self._outgoing.send(self.socket)
+        except socket.error as e:
+            if e.errno != errno.EWOULDBLOCK:
+                raise
+
+    ## @copydoc pollable.Pollable#onread
+    def onread(self):
+        try:
+            if not self._buf.recv_into(self.socket, self._block_size):
+                raise server.Disconnect()
+        except socket.error as e:
+            if e.errno != errno.EWOULDBLOCK:
+                raise
+        while self._requests and not self._closed:
+            if self._response is None:
+                n = self._buf.find(httpparser.END)
+                if n == -1:
+                    return
+                lines = self._buf.take(n + len(httpparser.END)).split(
+                    httpparser.CRLF
+                )
+                headers = httpparser.Headers()
+                for line in lines[1:]:
+                    if line:
+                        name, _, value = line.partition(':')
+                        headers[name.strip()] = value.strip()
+                self._response = (
+                    int(lines[0].split(' ', 2)[1]),
+                    headers,
+                    int(headers.get('Content-Length', 0)),
+                )
+            status, headers, length = self._response
+            if len(self._buf) < length:
+                return
+            self._response = None
+            data, callback = self._requests.popleft()
+            if self._requests:
+                self._outgoing.append(self._requests[0][0])
+            callback(status, headers, self._buf.take(length))
+
+    ## @copydoc pollable.Pollable#onerror
+    def onerror(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.poller.unregister(self)
+        self.socket.close()
+        self._on_close(self)
+
+
+## Simulated browser chat client.
+#
+# Opens home page, registers, opens rooms page and polls room list, then
+# opens chat page of its room and polls its messages every period, the way
+# chat.html does without WebSocket or EventSource. Every send period one of
+# the polls carries a message holding time it was sent, receiving it tells
+# delivery lag. A client whose connection broke starts over once a period
+# passed.
+#
+class ChatClient(base.Base):
+
+    ## Constructor.
+    # @param generator (LoadGenerator) generator running client
+    # @param name (str) user name
+    # @param room (str) room to chat in
+    #
+    def __init__(self, generator, name, room):
+        super(ChatClient, self).__init__()
+        self._generator = generator
+        self._args = generator.args
+        self._name = name
+        self._room = room
+        self._connection = None
+        self._cookie = None
+        self._revision = 0
+        self._joined = False
+        self._polls = 0
+        self._next_send = None
+        self._timer = None
+        self._deadline = None
+        self._failed = False
+
+    ## Start client from home page.
+    def start(self):
+        self._connection = HttpClient(
+            self._generator.address,
+            self._generator.poller,
+            self._closed,
+        )
+        self._generator.poller.register(self._connection)
+        self._cookie = None
+        self._revision = 0
+        self._joined = False
+        self._failed = False
+        self._get('/', self._home)
+
+    ## Send request, timing its response.
+    # @param uri (str) request URI
+    # @param callback (callable) called with response headers and content
+    # @param body (str) request content, sent as POST if not None
+    #
+    def _get(self, uri, callback, body=None):
+        head = [
+            '%s %s HTTP/1.1' % ('GET' if body is None else 'POST', uri),
+            'Host: %s:%s' % self._generator.address,
+            'Accept: application/json',
+        ]
+        if self._cookie is not None:
+            head.append('Cookie: %s' % self._cookie)
+        if body is not None:
+            head.append('Content-Type: text/xml')
+            head.append('Content-Length: %d' % len(body))
+        start = time.time()
+        self._deadline = self._generator.poller.call_later(
+            self._args.timeout,
+            self._fail,
+            'timeout',
+        )
+
+        def done(status, headers, content):
+            self._deadline.cancel()
+            if status != 200:
+                self._fail('status %s' % status)
+                return
+            self._generator.latency(
+                uri.partition('?')[0],
+                time.time() - start,
+            )
+            callback(headers, content)
+
+        self._connection.request(
+            constants.CRLF.join(head) + constants.CRLF * 2 + (body or ''),
+            done,
+        )
+
+    ## Record error and close connection.
+    # @param kind (str) error description
+    #
+    def _fail(self, kind):
+        self._generator.error(kind)
+        self._failed = True
+        self._connection.close()
+
+    ## Called once connection closed, starts over after a period.
+    # @param connection (HttpClient) closed connection
+    #
+    def _closed(self, connection):
+        if self._generator.stopping:
+            return
+        if not self._failed:
+            self._generator.error('disconnected')
+        self._deadline.cancel()
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self._generator.poller.call_later(
+            self._args.period,
+            self.start,
+        )
+
+    ## Register once home page is loaded.
+    def _home(self, headers, content):
+        self._get(
+            '/register?%s' % urllib.urlencode({'name': self._name}),
+            self._registered,
+        )
+
+    ## Open rooms page once registered.
+    def _registered(self, headers, content):
+        self._cookie = headers['Set-Cookie']
+        self._get('/rooms', self._rooms_page)
+
+    ## Poll room list once rooms page is loaded.
+    def _rooms_page(self, headers, content):
+        self._polls = 1
+        self._get('/get-rooms', self._rooms_listed)
+
+    ## Enter room once listed enough times.
+    def _rooms_listed(self, headers, content):
+        if self._polls < self._args.room_polls:
+            self._polls += 1
+            self._timer = self._generator.poller.call_later(
+                self._args.period,
+                self._get,
+                '/get-rooms',
+                self._rooms_listed,
+            )
+            return
+        if self._room not in json.loads(content)['rooms']:
+            self._generator.error('room missing')
+        self._get(
+            '/chat?%s' % urllib.urlencode({'room': self._room}),
+            self._chat_page,
+        )
+
+    ## Start polling messages once chat page is loaded.
+    def _chat_page(self, headers, content):
+        self._next_send = time.time() + random.uniform(
+            0,
+            self._args.send_period,
+        )
+        self._poll()
+
+    ## Poll messages, posting one if due.
+    def _poll(self):
+        messages = ''
+        now = time.time()
+        if self._joined and now >= self._next_send:
+            self._next_send += self._args.send_period
+            messages = '<message text="%s%.6f"/>' % (MESSAGE_PREFIX, now)
+            self._generator.stats['sent'] += 1
+        self._get(
+            '/get-messages',
+            self._polled,
+            (
+                '<root><fetch id="%s"/><room name="%s"/>'
+                '<messages>%s</messages></root>'
+            ) % (self._revision, self._room, messages),
+        )
+
+    ## Record messages received, then poll again after a period.
+    #
+    # Messages received by first poll were sent before client joined, they
+    # tell no lag.
+    #
+    def _polled(self, headers, content):
+        response = json.loads(content)
+        if 'revision' in response:
+            self._revision = response['revision']
+        if self._joined:
+            now = time.time()
+            for message in response['messages']:
+                text = message.partition(': ')[2]
+                if text.startswith(MESSAGE_PREFIX):
+                    self._generator.stats['received'] += 1
+                    self._generator.stats['lag'].append(
+                        now - float(text[len(MESSAGE_PREFIX):])
+                    )
+        self._joined = True
+        self._timer = self._generator.poller.call_later(
+            self._args.period,
+            self._poll,
+        )
+
+
+## Clients of a single process.
+#
+class LoadGenerator(base.Base):
+
+    ## Constructor.
+    # @param args (object) program arguments
+    #
+    def __init__(self, args):
+        super(LoadGenerator, self).__init__()
+        self._args = args
+        self._address = ('127.0.0.1', args.port)
+        self._poller = server.Server(
+            constants.TIMEOUT_DEFAULT,
+            poll_type=EVENT_TYPES[args.poll_type],
+        )
+        self._stats = new_stats()
+        self._stopping = False
+
+    ## Retrieve program arguments.
+    @property
+    def args(self):
+        return self._args
+
+    ## Retrieve server address.
+    @property
+    def address(self):
+        return self._address
+
+    ## Retrieve polling loop running clients.
+    @property
+    def poller(self):
+        return self._poller
+
+    ## Retrieve statistics.
+    @property
+    def stats(self):
+        return self._stats
+
+    ## Retrieve whether clients are being stopped.
+    @property
+    def stopping(self):
+        return self._stopping
+
+    ## Record latency of a request.
+    # @param name (str) service name
+    # @param seconds (float) time until whole response was received
+    #
+    def latency(self, name, seconds):
+        self._stats['latency'].setdefault(name, []).append(seconds)
+
+    ## Record an error.
+    # @param kind (str) error description
+    #
+    def error(self, kind):
+        self._stats['errors'][kind] = self._stats['errors'].get(kind, 0) + 1
+
+    ## Run clients.
+    # @param first (int) number of first client
+    # @param amount (int) amount of clients
+    # @returns (dict) statistics
+    #
+    # Clients start spread over ramp time, all of them stop after duration.
+    # Polling loop runs while there are connections, so first client starts
+    # right away, and clients stop early once every connection broke.
+    #
+    def run(self, first, amount):
+        for n in range(first, first + amount):
+            client = ChatClient(
+                self,
+                'load%d' % n,
+                'load%d' % (n % self._args.rooms),
+            )
+            if n == first:
+                client.start()
+            else:
+                self._poller.call_later(
+                    random.uniform(0, self._args.ramp),
+                    client.start,
+                )
+        self._poller.call_later(self._args.duration, self._stop)
+        self._poller.run()
+        return self._stats
+
+    ## Stop clients.
+    def _stop(self):
+        self._stopping = True
+        self._poller.close_server()
+
+
+## Run clients of a single process.
+# @param job (tuple) program arguments, number of first client and amount
+# @returns (dict) statistics
+#
+def run_clients(job):
+    args, first, amount = job
+    return LoadGenerator(args).run(first, amount)
+
+
+## Create chat rooms of clients.
+# @param args (object) program arguments
+#
+# Clients only enter rooms, adding an existing room would empty it.
+#
+def add_rooms(args):
+    for n in range(args.rooms):
+        urllib2.urlopen(
+            'http://127.0.0.1:%d/add-room' % args.port,
+            '<root><room name="load%d"/></root>' % n,
+        ).read()
+
+
+## Print report.
+# @param stats (dict) statistics of all clients
+# @param duration (float) time in seconds clients ran
+#
+def report(stats, duration):
+    requests = sum(len(latencies) for latencies in stats['latency'].values())
+    print(
+        '%d requests in %.1f s, %.1f requests/s' % (
+            requests,
+            duration,
+            requests / duration,
+        )
+    )
+    print(
+        '%-14s %8s %9s %9s %9s %9s' % (
+            ('service', 'requests') +
+            tuple('p%d ms' % p for p in PERCENTILES) +
+            ('max ms',)
+        )
+    )
+    for name, latencies in sorted(stats['latency'].items()):
+        print(
+            '%-14s %8d %9.2f %9.2f %9.2f %9.2f' % (
+                (name, len(latencies)) +
+                tuple(t * 1000 for t in percentiles(latencies))
+            )
+        )
+    print(
+        'errors: %s' % (
+            ', '.join(
+                '%s %d' % (kind, amount)
+                for kind, amount in sorted(stats['errors'].items())
+            ) or 'none'
+        )
+    )
+    print(
+        'messages: %d sent, %d received' % (
+            stats['sent'],
+            stats['received'],
+        )
+    )
+    if stats['lag']:
+        print(
+            'delivery lag ms: %s' % ', '.join(
+                '%s %.1f' % (name, t * 1000)
+                for name, t in zip(
+                    ['p%d' % p for p in PERCENTILES] + ['max'],
+                    percentiles(stats['lag']),
+                )
+            )
+        )
+
+
+## Parse program arguments.
+# @returns (dict) program arguments
+#
+def parse_args():
+    """Parse program arguments."""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--port',
+        default=8080,
+        type=int,
+        help='port of server on localhost. default: %(default)s',
+    )
+    parser.add_argument(
+        '--spawn',
+        default=None,
+        metavar='SERVER_ARGS',
+        help='''start server with these additional arguments, empty for
+            none. default: use running server
+            ''',
+    )
+    parser.add_argument(
+        '--clients',
+        default=1000,
+        type=int,
+        help='amount of simulated clients. default: %(default)s',
+    )
+    parser.add_argument(
+        '--processes',
+        default=multiprocessing.cpu_count(),
+        type=int,
+        help='amount of client processes. default: %(default)s',
+    )
+    parser.add_argument(
+        '--rooms',
+        default=10,
+        type=int,
+        help='amount of rooms clients chat in. default: %(default)s',
+    )
+    parser.add_argument(
+        '--duration',
+        default=30.0,
+        type=float,
+        help='time in seconds clients run. default: %(default)s',
+    )
+    parser.add_argument(
+        '--ramp',
+        default=5.0,
+        type=float,
+        help='time in seconds clients start over. default: %(default)s',
+    )
+    parser.add_argument(
+        '--period',
+        default=1.0,
+        type=float,
+        help='time in seconds between polls of a client. default: %(default)s',
+    )
+    parser.add_argument(
+        '--send-period',
+        default=10.0,
+        type=float,
+        help='''time in seconds between messages of a client.
+            default: %(default)s
+            ''',
+    )
+    parser.add_argument(
+        '--room-polls',
+        default=2,
+        type=int,
+        help='room list polls before entering room. default: %(default)s',
+    )
+    parser.add_argument(
+        '--timeout',
+        default=constants.REQUEST_TIMEOUT,
+        type=float,
+        help='time in seconds to wait for a response. default: %(default)s',
+    )
+    parser.add_argument(
+        '--poll-type',
+        choices=EVENT_TYPES.keys(),
+        default=sorted(EVENT_TYPES.keys())[0],
+        help='''event type of client processes.
+            default: %(default)s, choices: %(choices)s
+            ''',
+    )
+    args = parser.parse_args()
+    if args.clients < 1 or args.processes < 1 or args.rooms < 1:
+        parser.error('clients, processes and rooms must be at least one')
+    args.processes = min(args.processes, args.clients)
+    return args
+
+
+## Main implementation.
+def main():
+    """Main implementation."""
+
+    args = parse_args()
+    process = None
+    if args.spawn is not None:
+        process = tools.start_server(args.port, shlex.split(args.spawn))
+    try:
+        add_rooms(args)
+        pool = multiprocessing.Pool(args.processes)
+        jobs = []
+        first = 0
+        for i in range(args.processes):
+            amount = (args.clients - first) // (args.processes - i)
+            jobs.append((args, first, amount))
+            first += amount
+        start = time.time()
+        total = new_stats()
+        for stats in pool.map(run_clients, jobs):
+            merge_stats(total, stats)
+        report(total, time.time() - start)
+        pool.close()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
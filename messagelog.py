@@ -0,0 +1,355 @@
+## @package HTTP--Chat.messagelog Message log module.
+## @file messagelog.py Implementation of @ref HTTP--Chat.messagelog
+#
+# Every room has an append-only log of its messages and an index holding
+# offset of every message in the log. Both files are only appended to, so
+# startup reads no more than the end of them.
+#
+
+import base
+import binascii
+import constants
+import errno
+import mmap
+import os
+import struct
+
+## Suffix of log files.
+LOG_SUFFIX = '.log'
+
+## Suffix of index files.
+INDEX_SUFFIX = '.idx'
+
+## Log record header, length of message that follows.
+RECORD = struct.Struct('>I')
+
+## Index record, offset of message record in log.
+INDEX = struct.Struct('<Q')
+
+## Binary mode flag, needed on Windows only.
+O_BINARY = getattr(os, 'O_BINARY', 0)
+
+
+## Write whole data to file.
+# @param fd (int) file descriptor
+# @param data (str) data to write
+#
+def _write(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+## Read from file at offset.
+# @param fd (int) file descriptor
+# @param offset (int) offset to read at
+# @param size (int) amount to read
+# @returns (str) data read, shorter at end of file
+#
+def _read(fd, offset, size):
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+## Get path of room log files, without suffix.
+# @param directory (str) directory of log files
+# @param room (str) room name
+# @returns (str) path
+#
+# Room names are hex encoded, any name makes a valid file name.
+#
+def _path(directory, room):
+    if isinstance(room, unicode):
+        room = room.encode('utf-8')
+    return os.path.join(directory, binascii.hexlify(room))
+
+
+## Log of a single room.
+#
+# Messages appended are kept pending until flushed, sequence number of a
+# message is its position in log, starting at one.
+#
+class RoomLog(base.Base):
+
+    ## Constructor.
+    # @param path (str) path of files, without suffix
+    # @param writable (bool) open for appending, otherwise for reading
+    #
+    # Opening for appending drops records torn by a crash, only a single
+    # process may do so.
+    #
+    def __init__(self, path, writable=True):
+        super(RoomLog, self).__init__()
+        self._path = path
+        self._writable = writable
+        if writable:
+            flags = os.O_RDWR | os.O_CREAT | os.O_APPEND | O_BINARY
+        else:
+            flags = os.O_RDONLY | O_BINARY
+        self._log = os.open(path + LOG_SUFFIX, flags, 0o644)
+        self._index = os.open(path + INDEX_SUFFIX, flags, 0o644)
+        self._pending = []
+        self._pending_index = []
+        self._maps = None
+        self._mapped = 0
+        if writable:
+            self._recover()
+
+    ## Retrieve amount of messages, pending ones included.
+    @property
+    def count(self):
+        if self._writable:
+            return self._count
+        return os.fstat(self._index).st_size // INDEX.size
+
+    ## Drop records past last whole message.
+    def _recover(self):
+        size = os.fstat(self._log).st_size
+        index_size = os.fstat(self._index).st_size
+        count = index_size // INDEX.size
+        end = 0
+        while count > 0:
+            offset, = INDEX.unpack(
+                _read(self._index, (count - 1) * INDEX.size, INDEX.size)
+            )
+            header = _read(self._log, offset, RECORD.size)
+            if len(header) == RECORD.size:
+                end = offset + RECORD.size + RECORD.unpack(header)[0]
+                if end <= size:
+                    break
+            count -= 1
+            end = 0
+        if end != size or count * INDEX.size != index_size:
+            self.logger.warning('dropping torn records of %s', self._path)
+            os.ftruncate(self._log, end)
+            os.ftruncate(self._index, count * INDEX.size)
+        self._count = count
+        self._size = end
+
+    ## Append messages.
+    # @param messages (list) messages to append
+    #
+    def append(self, messages):
+        for data in messages:
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            self._pending.append(RECORD.pack(len(data)))
+            self._pending.append(data)
+            self._pending_index.append(INDEX.pack(self._size))
+            self._size += RECORD.size + len(data)
+            self._count += 1
+
+    ## Write pending messages to files.
+    # @returns (bool) True if there were pending messages
+    #
+    # Log is written before index, index never points past log.
+    #
+    def flush(self):
+        if not self._pending:
+            return False
+        _write(self._log, ''.join(self._pending))
+        _write(self._index, ''.join(self._pending_index))
+        self._pending = []
+        self._pending_index = []
+        return True
+
+    ## Make written messages durable.
+    #
+    # Safe to call from worker threads.
+    #
+    def sync(self):
+        os.fsync(self._log)
+        os.fsync(self._index)
+
+    ## Read messages.
+    # @param first (int) sequence number of first message
+    # @param last (int) sequence number of last message
+    # @returns (list) messages, as many as there are in range
+    #
+    # Log and index are memory mapped, only pages read are loaded.
+    #
+    def read(self, first, last):
+        if self._writable:
+            self.flush()
+        count = self.count
+        first, last = max(first, 1), min(last, count)
+        if first > last:
+            return []
+        log, index = self._map(count)
+        messages = []
+        for n in range(first, last + 1):
+            offset, = INDEX.unpack_from(index, (n - 1) * INDEX.size)
+            length, = RECORD.unpack_from(log, offset)
+            start = offset + RECORD.size
+            messages.append(log[start:start + length].decode('utf-8'))
+        return messages
+
+    ## Map files holding at least count messages.
+    # @param count (int) amount of messages needed
+    # @returns (tuple) log and index maps
+    #
+    # Files are mapped again once they grew past their maps.
+    #
+    def _map(self, count):
+        if self._mapped < count:
+            size = os.fstat(self._log).st_size
+            self._unmap()
+            self._maps = (
+                mmap.mmap(
+                    self._log,
+                    size,
+                    access=mmap.ACCESS_READ,
+                ),
+                mmap.mmap(
+                    self._index,
+                    count * INDEX.size,
+                    access=mmap.ACCESS_READ,
+                ),
+            )
+            self._mapped = count
+        return self._maps
+
+    ## Release file maps.
+    def _unmap(self):
+        if self._maps is not None:
+            for m in self._maps:
+                m.close()
+            self._maps = None
+            self._mapped = 0
+
+    ## Close files, pending messages are written first.
+    def close(self):
+        if self._writable:
+            self.flush()
+        self._unmap()
+        os.close(self._log)
+        os.close(self._index)
+
+
+## Logs of all rooms, kept in a directory.
+#
+# Chat operations are recorded as applied, see @ref store.LocalStore.
+# Writes are grouped: pending messages of every room are written and synced
+# together by @ref sync, syncing runs on a worker thread.
+#
+class MessageLog(base.Base):
+
+    ## Constructor.
+    # @param directory (str) directory of log files
+    # @param writable (bool) open for recording, otherwise for reading
+    #
+    def __init__(self, directory, writable=True):
+        super(MessageLog, self).__init__()
+        self._directory = directory
+        self._writable = writable
+        self._logs = {}
+        self._dirty = set()
+        self._syncing = None
+        if writable:
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        for name in os.listdir(directory):
+            if name.endswith(LOG_SUFFIX):
+                self._open(binascii.unhexlify(name[:-len(LOG_SUFFIX)]))
+
+    ## Open log of room.
+    # @param room (str) room name
+    # @returns (RoomLog) room log
+    #
+    def _open(self, room):
+        log = self._logs[room] = RoomLog(
+            _path(self._directory, room),
+            writable=self._writable,
+        )
+        return log
+
+    ## Get log of room.
+    # @param room (str) room name
+    # @returns (RoomLog) room log, None if room has no log
+    #
+    # A reader opens logs created meanwhile by the writer.
+    #
+    def _get(self, room):
+        log = self._logs.get(room)
+        if log is None and (
+            self._writable or
+            os.path.exists(_path(self._directory, room) + LOG_SUFFIX)
+        ):
+            log = self._open(room)
+        return log
+
+    ## Read revision and last messages of every room.
+    # @param amount (int) maximum amount of messages per room
+    # @returns (dict) revision and last messages by room name
+    #
+    def restore(self, amount=constants.TOO_BIG):
+        return {
+            room: (log.count, log.read(log.count - amount + 1, log.count))
+            for room, log in self._logs.items()
+        }
+
+    ## Record chat operation.
+    # @param operation (list) operation name followed by its arguments
+    #
+    # Only room creation and posted messages are kept. Creating a room that
+    # exists keeps its log.
+    #
+    def record(self, operation):
+        if operation[0] == 'room':
+            self._get(operation[1])
+        elif operation[0] == 'post':
+            log = self._get(operation[1])
+            log.append(operation[3])
+            self._dirty.add(log)
+
+    ## Read messages of room.
+    # @param room (str) room name
+    # @param first (int) sequence number of first message
+    # @param last (int) sequence number of last message
+    # @returns (list) messages, as many as there are in range
+    #
+    def read(self, room, first, last):
+        log = self._get(room)
+        if log is None:
+            return []
+        return log.read(first, last)
+
+    ## Write pending messages and sync them on a worker thread.
+    # @param executor (Executor) executor to sync on
+    #
+    # Messages recorded while a sync runs are written by the next one.
+    #
+    def sync(self, executor):
+        if self._syncing is not None or not self._dirty:
+            return
+        logs = [log for log in self._dirty if log.flush()]
+        self._dirty = set()
+        self._syncing = executor.submit(self._synced, self._sync, logs)
+
+    ## Sync logs, from worker thread.
+    # @param logs (list) logs to sync
+    #
+    def _sync(self, logs):
+        for log in logs:
+            log.sync()
+
+    ## Called once logs are synced.
+    # @param result (object) unused
+    # @param error (Exception) error syncing, None if synced
+    #
+    def _synced(self, result, error):
+        self._syncing = None
+        if error is not None:
+            self.logger.error('failed to sync message logs: %s', error)
+
+    ## Close every log, pending messages are written and synced.
+    def close(self):
+        for log in self._logs.values():
+            if self._writable:
+                log.flush()
+                log.sync()
+            log.close()
+        self._logs = {}
@@ -0,0 +1,364 @@
+## @package HTTP--Chat.metrics Metrics module.
+## @file metrics.py Implementation of @ref HTTP--Chat.metrics
+#
+# Counters, gauges and histograms of server activity, kept in a registry of
+# the polling loop, see @ref server.Server.metrics. Recording a value costs
+# no more than a few additions, metrics are only serialized when asked for,
+# as JSON or Prometheus text.
+#
+
+import base
+import bisect
+import formats
+
+## Prometheus text media type.
+PROMETHEUS = 'text/plain'
+
+## Prometheus text format version.
+PROMETHEUS_VERSION = '0.0.4'
+
+
+## Format number the way Prometheus expects it.
+# @param value (float) value
+# @returns (str) formatted value
+#
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+## Format Prometheus sample labels.
+# @param labels (list) label name and value pairs
+# @returns (str) formatted labels, empty if there are none
+#
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (
+            name,
+            str(value).replace(
+                '\\', '\\\\',
+            ).replace(
+                '"', '\\"',
+            ).replace(
+                '\n', '\\n',
+            ),
+        )
+        for name, value in labels
+    )
+
+
+## Monotonic count of events.
+#
+# A metric given a function reads its value from it when serialized, so
+# values the server already keeps, such as amount of rooms, cost nothing to
+# track.
+#
+class Counter(base.Base):
+
+    ## Metric type.
+    TYPE = 'counter'
+
+    ## Constructor.
+    # @param func (callable) returns value, None to keep value counted
+    #
+    def __init__(self, func=None):
+        super(Counter, self).__init__()
+        self._value = 0
+        self._func = func
+
+    ## Retrieve value.
+    @property
+    def value(self):
+        if self._func is not None:
+            return self._func()
+        return self._value
+
+    ## Count events.
+    # @param amount (int) amount of events
+    #
+    def inc(self, amount=1):
+        self._value += amount
+
+    ## Get samples.
+    # @param name (str) metric name
+    # @returns (list) sample name, labels and value tuples
+    #
+    def samples(self, name):
+        return [(name, [], self.value)]
+
+    ## Get value for JSON.
+    # @returns (object) value
+    #
+    def dump(self):
+        return self.value
+
+
+## Value that goes up and down.
+#
+class Gauge(Counter):
+
+    ## Metric type.
+    TYPE = 'gauge'
+
+    ## Set value.
+    # @param value (float) new value
+    #
+    def set(self, value):
+        self._value = value
+
+    ## Undo events.
+    # @param amount (int) amount of events
+    #
+    def dec(self, amount=1):
+        self._value -= amount
+
+
+## Distribution of observed values over fixed buckets.
+#
+class Histogram(base.Base):
+
+    ## Metric type.
+    TYPE = 'histogram'
+
+    ## Constructor.
+    # @param buckets (tuple) sorted upper bounds of buckets
+    #
+    def __init__(self, buckets):
+        super(Histogram, self).__init__()
+        self._buckets = tuple(buckets) + (float('inf'),)
+        self._counts = [0] * len(self._buckets)
+        self._sum = 0
+        self._count = 0
+
+    ## Retrieve amount of values observed.
+    @property
+    def count(self):
+        return self._count
+
+    ## Retrieve sum of values observed.
+    @property
+    def sum(self):
+        return self._sum
+
+    ## Observe value.
+    # @param value (float) value
+    #
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    ## Get cumulative bucket counts.
+    # @returns (list) upper bound and count of values up to it pairs
+    #
+    def cumulative(self):
+        result = []
+        total = 0
+        for bound, count in zip(self._buckets, self._counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    ## @copydoc Counter#samples
+    def samples(self, name):
+        return [
+            (name + '_bucket', [('le', _number(bound))], count)
+            for bound, count in self.cumulative()
+        ] + [
+            (name + '_sum', [], self._sum),
+            (name + '_count', [], self._count),
+        ]
+
+    ## @copydoc Counter#dump
+    def dump(self):
+        return {
+            'buckets': [
+                [_number(bound), count] for bound, count in self.cumulative()
+            ],
+            'sum': self._sum,
+            'count': self._count,
+        }
+
+
+## Metrics of same name, one for every combination of label values.
+#
+class Family(base.Base):
+
+    ## Constructor.
+    # @param name (str) metric name
+    # @param description (str) metric help
+    # @param label_names (tuple) label names
+    # @param metric_type (str) type of metrics
+    # @param factory (callable) creates metric of a label combination
+    #
+    def __init__(self, name, description, label_names, metric_type, factory):
+        super(Family, self).__init__()
+        self._name = name
+        self._description = description
+        self._label_names = label_names
+        self._type = metric_type
+        self._factory = factory
+        self._children = {}
+
+    ## Retrieve metric name.
+    @property
+    def name(self):
+        return self._name
+
+    ## Retrieve metric help.
+    @property
+    def description(self):
+        return self._description
+
+    ## Retrieve metric type.
+    @property
+    def type(self):
+        return self._type
+
+    ## Get metric of label values, creating it on first use.
+    # @param values (tuple) label values, by order of label names
+    # @returns (object) metric
+    #
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._factory()
+        return child
+
+    ## Get samples of every label combination.
+    # @returns (list) sample name, labels and value tuples
+    #
+    def samples(self):
+        result = []
+        for values, child in sorted(self._children.items()):
+            labels = zip(self._label_names, values)
+            for name, extra, value in child.samples(self._name):
+                result.append((name, labels + extra, value))
+        return result
+
+    ## Get values of every label combination for JSON.
+    # @returns (object) value, labels mapped to values if family has labels
+    #
+    def dump(self):
+        if not self._label_names:
+            return self.labels().dump()
+        return [
+            {
+                'labels': dict(zip(self._label_names, values)),
+                'value': child.dump(),
+            }
+            for values, child in sorted(self._children.items())
+        ]
+
+
+## Registry of metrics.
+#
+# Metrics are created on first request for their name, so every user of a
+# metric may ask for it. Metrics without labels are returned as is, those
+# with labels as a @ref Family.
+#
+class Registry(base.Base):
+
+    ## Constructor.
+    def __init__(self):
+        super(Registry, self).__init__()
+        self._families = {}
+        self._order = []
+
+    ## Get metric, creating it on first request.
+    # @param name (str) metric name
+    # @param description (str) metric help
+    # @param label_names (tuple) label names
+    # @param metric_type (str) type of metrics
+    # @param factory (callable) creates metric of a label combination
+    # @returns (object) metric, family of metrics if there are labels
+    #
+    def _get(self, name, description, label_names, metric_type, factory):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = Family(
+                name,
+                description,
+                label_names,
+                metric_type,
+                factory,
+            )
+            self._order.append(family)
+        if label_names:
+            return family
+        return family.labels()
+
+    ## Get counter.
+    # @param name (str) metric name
+    # @param description (str) metric help
+    # @param label_names (tuple) label names
+    # @param func (callable) returns count, None to keep value counted
+    # @returns (object) counter, family of counters if there are labels
+    #
+    def counter(self, name, description, label_names=(), func=None):
+        return self._get(
+            name,
+            description,
+            label_names,
+            Counter.TYPE,
+            lambda: Counter(func),
+        )
+
+    ## Get gauge.
+    # @param name (str) metric name
+    # @param description (str) metric help
+    # @param func (callable) returns value, None to keep value set
+    # @returns (Gauge) gauge
+    #
+    def gauge(self, name, description, func=None):
+        return self._get(
+            name,
+            description,
+            (),
+            Gauge.TYPE,
+            lambda: Gauge(func),
+        )
+
+    ## Get histogram.
+    # @param name (str) metric name
+    # @param description (str) metric help
+    # @param buckets (tuple) sorted upper bounds of buckets
+    # @param label_names (tuple) label names
+    # @returns (object) histogram, family of histograms if there are labels
+    #
+    def histogram(self, name, description, buckets, label_names=()):
+        return self._get(
+            name,
+            description,
+            label_names,
+            Histogram.TYPE,
+            lambda: Histogram(buckets),
+        )
+
+    ## Serialize metrics as JSON.
+    # @returns (str) metric values by name
+    #
+    def json(self):
+        return formats.ENCODER.encode({
+            family.name: family.dump() for family in self._order
+        })
+
+    ## Serialize metrics as Prometheus text.
+    # @returns (str) metrics in Prometheus text format
+    #
+    def prometheus(self):
+        lines = []
+        for family in self._order:
+            lines.append('# HELP %s %s' % (family.name, family.description))
+            lines.append('# TYPE %s %s' % (family.name, family.type))
+            for name, labels, value in family.samples():
+                lines.append(
+                    '%s%s %s' % (name, _labels(labels), _number(value))
+                )
+        lines.append('')
+        return '\n'.join(lines)
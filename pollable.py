@@ -3,16 +3,73 @@
 #
 
 import base
+import buffers
 import constants
 import errno
+import httpparser
+import json
+import os
 import services
 import socket
-import urlparse
+import time
+import util
+import websocket
 
 from events import CommonEvents
 from server import Disconnect
 
 
+## Read block of file.
+# @param f (file) file to read
+# @param offset (int) offset to read at
+# @param size (int) maximum amount to read
+# @returns (str) block read
+#
+def _read_block(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+
+## Get metrics of client connections.
+# @param registry (Registry) metrics registry, see @ref server.Server.metrics
+# @returns (dict) connection metrics by name
+#
+def _connection_metrics(registry):
+    return {
+        'accepted': registry.counter(
+            'chat_connections_accepted_total',
+            'Client connections accepted.',
+        ),
+        'closed': registry.counter(
+            'chat_connections_closed_total',
+            'Client connections closed.',
+        ),
+        'open': registry.gauge(
+            'chat_connections_open',
+            'Client connections open.',
+        ),
+        'received': registry.counter(
+            'chat_received_bytes_total',
+            'Bytes received from clients.',
+        ),
+        'sent': registry.counter(
+            'chat_sent_bytes_total',
+            'Bytes sent to clients.',
+        ),
+        'requests': registry.counter(
+            'chat_requests_total',
+            'Requests by service.',
+            ('service',),
+        ),
+        'latency': registry.histogram(
+            'chat_request_duration_seconds',
+            'Time from first byte of request to end of response by service.',
+            constants.LATENCY_BUCKETS,
+            ('service',),
+        ),
+    }
+
+
 ## Interface for generic I/O object
 #
 class Pollable(base.Base):
@@ -68,6 +125,8 @@ class SocketListen(Pollable):
         self._ret_class = ret_class
         self._poller = poller
         self._context = context
+        self._metrics = _connection_metrics(poller.metrics)
+        self._backoff = None
 
     ## Retrieve socket.
     @property
@@ -95,22 +154,56 @@ class SocketListen(Pollable):
 
     ## @copydoc Pollable#getevents
     def getevents(self):
+        if self._backoff is not None:
+            return CommonEvents.POLLERR
         return CommonEvents.POLLERR | CommonEvents.POLLIN
 
     ## @copydoc Pollable#onread
+    #
+    # Accepts up to @ref constants.LISTEN_BACKLOG pending connections, so a
+    # burst of clients does not wait a poll each. Nagle's algorithm is
+    # disabled, connections already coalesce what they send, see
+    # @ref buffers.SendQueue, and a response sent in two parts would
+    # otherwise wait for the delayed acknowledge of the first one.
+    #
+    # Once out of file descriptors pending connections stay readable, so
+    # accepting pauses for @ref constants.ACCEPT_BACKOFF instead of busy
+    # polling until connections close.
+    #
     def onread(self):
         self.logger.debug('Listening')
-        try:
-            client, addr = self.socket.accept()
+        for i in range(constants.LISTEN_BACKLOG):
+            try:
+                client, addr = self.socket.accept()
+            except socket.error as e:
+                if e.errno == errno.EWOULDBLOCK:
+                    return
+                self.logger.error('Unexpected error accepting: %s', e)
+                if e.errno in (errno.EMFILE, errno.ENFILE):
+                    self._backoff = self.poller.call_later(
+                        constants.ACCEPT_BACKOFF,
+                        self._resume,
+                    )
+                return
             client.setblocking(False)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._metrics['accepted'].inc()
+            self._metrics['open'].inc()
             self.logger.debug('Connected new client %s', client.fileno())
-        except Exception as e:
-            self.logger.error('Unexpected error: %s', exc_info=True)
-            client.close()
-        self.poller.register(self.ret_class(client, self.poller, self.context))
+            self.poller.register(
+                self.ret_class(client, self.poller, self.context)
+            )
+
+    ## Accept connections again after a pause.
+    def _resume(self):
+        self._backoff = None
+        self.poller.update(self)
 
     ## @copydoc Pollable#onerror
     def onerror(self):
+        if self._backoff is not None:
+            self._backoff.cancel()
+            self._backoff = None
         self.poller.unregister(self)
         self.logger.debug('removed and closed passive socket %s', self.getfd())
         self.socket.close()
@@ -121,9 +214,9 @@ class SocketListen(Pollable):
 class HttpSocket(Pollable):
 
     ## State machine states.
-    (FIRST, HEADERS, CONTENT, R_FIRST, R_HEADERS, R_CONTENT, END) = range(7)
+    (FIRST, CONTENT, R_FIRST, R_HEADERS, R_CONTENT, END) = range(6)
     _services = {
-        service.NAME: service for service in services.Service.__subclasses__()
+        service.NAME: service for service in services.service_classes()
     }
 
     ## Constructor.
@@ -144,26 +237,24 @@ class HttpSocket(Pollable):
         self._poller = poller
         self._block_size = block_size
         self._context = context
-        self._buf = ''
+        self._buf = buffers.RecvBuffer(block_size)
         self._state = HttpSocket.FIRST
-        self._outgoing = ''
-        self._dialogue = {
-            'request': {
-                'headers': {
-                    'Content-Length': 0,
-                },
-                'name': '',
-                'content': '',
-                'context': self._context,
-            },
-            'response': {
-                'headers': {
-
-                },
-                'content': '',
-            },
-        }
+        self._outgoing = buffers.SendQueue(block_size)
+        self._content = bytearray()
+        self._parser = httpparser.RequestParser()
+        self._dialogue = self._new_dialogue()
         self._service = None
+        self._keep_alive = False
+        self._suspended = False
+        self._content_done = False
+        self._file = None
+        self._reading = None
+        self._closed = False
+        self._timer = None
+        self._receiving = False
+        self._started = None
+        self._metrics = _connection_metrics(poller.metrics)
+        self._arm(constants.KEEP_ALIVE_TIMEOUT)
 
     ## Retrieve socket.
     @property
@@ -190,11 +281,6 @@ class HttpSocket(Pollable):
     def buf(self):
         return self._buf
 
-    ## Set value of reading buffer.
-    @buf.setter
-    def buf(self, val):
-        self._buf = val
-
     ## Retrieve state.
     @property
     def state(self):
@@ -220,21 +306,26 @@ class HttpSocket(Pollable):
     def dialogue(self):
         return self._dialogue
 
-    ## Retrieve sending buffer.
+    ## Retrieve sending queue.
     @property
     def outgoing(self):
         return self._outgoing
 
-    ## Set sending buffer.
-    @outgoing.setter
-    def outgoing(self, val):
-        self._outgoing = val
-
     ## Retrieve related poller.
     @property
     def poller(self):
         return self._poller
 
+    ## Retrieve whether connection persists after current response.
+    @property
+    def keep_alive(self):
+        return self._keep_alive
+
+    ## Retrieve whether response is waiting for its service to be ready.
+    @property
+    def suspended(self):
+        return self._suspended
+
     ## Equality operator.
     # @arg other (object) other object.
     # @returns (bool) True if equal.
@@ -251,31 +342,139 @@ class HttpSocket(Pollable):
     ## @copydoc Pollable#getevents
     def getevents(self):
         e = CommonEvents.POLLERR
-        if len(self.buf) < self.block_size:
+        limit = self.block_size
+        if self.state == HttpSocket.FIRST:
+            # head is kept in buffer until complete, parser rejects it
+            # before it grows past this
+            limit = self._parser.max_buffered
+        if len(self.buf) < limit:
             e |= CommonEvents.POLLIN
-        if self.outgoing:
+        if self.outgoing or (
+            self._file is not None and self._reading is None
+        ):
             e |= CommonEvents.POLLOUT
         return e
 
+    ## Start timer closing connection unless request is received in time.
+    # @param delay (float) time in seconds request has to arrive
+    #
+    def _arm(self, delay):
+        self._disarm()
+        self._timer = self.poller.call_later(delay, self._on_timeout)
+
+    ## Stop request timer.
+    def _disarm(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    ## Close connection idle between requests or receiving one too slowly.
+    def _on_timeout(self):
+        self._timer = None
+        self.logger.debug('connection %s timed out', self.getfd())
+        self._terminate()
+
     ## @copydoc Pollable#onwrite
     def onwrite(self):
+        sent = self.outgoing.sent
         try:
-            while self._outgoing:
-                self.logger.debug('SENDING: %s', self.outgoing)
-                self.outgoing = self.outgoing[self.socket.send(self.outgoing):]
+            self.logger.debug('SENDING: %s bytes', len(self.outgoing))
+            self.outgoing.send(self.socket)
+            if self._file is not None and not self._send_file():
+                return
             self._parse()
         except socket.error as e:
             if e.errno != errno.EWOULDBLOCK:
                 raise
+        finally:
+            self._metrics['sent'].inc(self.outgoing.sent - sent)
+
+    ## Send file handed by service.
+    # @returns (bool) True if whole file was sent.
+    # @throws RuntimeError If file is shorter than announced
+    #
+    # Uses sendfile where available so file content never passes through
+    # user space, otherwise file is read by @ref _read_file.
+    #
+    def _send_file(self):
+        if not hasattr(os, 'sendfile'):
+            return self._read_file()
+        f, offset, remaining = self._file
+        while remaining > 0:
+            try:
+                n = os.sendfile(
+                    self.socket.fileno(),
+                    f.fileno(),
+                    offset,
+                    remaining,
+                )
+            except OSError as e:
+                if e.errno != errno.EWOULDBLOCK:
+                    raise
+                return False
+            if n == 0:
+                raise RuntimeError('File truncated')
+            self._metrics['sent'].inc(n)
+            offset += n
+            remaining -= n
+            self._file = (f, offset, remaining)
+        self._file = None
+        return True
+
+    ## Queue file handed by service block by block.
+    # @returns (bool) True if whole file was queued.
+    #
+    # Every block is read by a worker thread once the previous one was sent,
+    # see @ref executor.Executor.
+    #
+    def _read_file(self):
+        f, offset, remaining = self._file
+        if remaining <= 0:
+            self._file = None
+            return True
+        if self._reading is None:
+            self._reading = self.context['executor'].submit(
+                self._file_read,
+                _read_block,
+                f,
+                offset,
+                min(remaining, constants.FILE_BLOCK_SIZE),
+            )
+        return False
+
+    ## Queue block of file read by worker thread.
+    # @param data (str) block read
+    # @param error (Exception) read error, None if read
+    #
+    def _file_read(self, data, error):
+        self._reading = None
+        if self._closed:
+            return
+        if error is not None or not data:
+            self.logger.debug(
+                'failed to read file for %s: %s',
+                self.getfd(),
+                error or 'File truncated',
+            )
+            self._terminate()
+            return
+        f, offset, remaining = self._file
+        self._file = (f, offset + len(data), remaining - len(data))
+        self.outgoing.append(data)
+        self.poller.update(self)
 
     ## @copydoc Pollable#onread
     def onread(self):
         try:
-            temp = self.socket.recv(self.block_size)
-            self.logger.debug('received %s', temp)
-            if not temp:
+            n = self.buf.recv_into(self.socket, self.block_size)
+            self.logger.debug('received %s bytes', n)
+            if not n:
                 raise Disconnect()
-            self.buf += temp
+            self._metrics['received'].inc(n)
+            if self.state == HttpSocket.FIRST and not self._receiving:
+                self._receiving = True
+                self._started = time.time()
+                self._arm(constants.REQUEST_TIMEOUT)
             self._parse()
         except socket.error as e:
             if e.errno != errno.EWOULDBLOCK:
@@ -285,133 +484,215 @@ class HttpSocket(Pollable):
     def onerror(self):
         self._terminate()
 
-    ## Parse header
-    # @param line (str) header line to parse
-    # @returns (tuple) first is header title second is header data
-    # @throws RuntimeError If header violates HTTP protocol
-    #
-    def _parse_header(self, line):
-        SEP = ':'
-        n = line.find(SEP)
-        if n == -1:
-            raise RuntimeError('Invalid Header')
-        return line[:n].rstrip(), line[n + len(SEP):].lstrip()
-
-    ## Parse and carefully examine first line of HTTP request.
-    # @param req (str) HTTP request first line
-    # @throws RuntimeError If HTTP protocol is incomplete
-    # @throws RuntimeError If protocol is not HTTP
+    ## Create dialogue data structure for a single request.
+    # @returns (dict) empty dialogue
+    #
+    def _new_dialogue(self):
+        return {
+            'request': {
+                'headers': httpparser.Headers({
+                    'Content-Length': 0,
+                    'Connection': '',
+                }),
+                'name': '',
+                'content': '',
+                'context': self._context,
+            },
+            'response': {
+                'headers': {
+
+                },
+                'content': '',
+            },
+            'resume': self._resume,
+            'call_later': self.poller.call_later,
+        }
+
+    ## Continue a suspended response.
+    #
+    # Called by services when whatever they were waiting for happened,
+    # possibly from within handlers of other I/O objects.
+    #
+    def _resume(self):
+        if self._closed or not self.suspended:
+            return
+        try:
+            self._parse()
+        except Exception:
+            self.logger.debug(
+                'Socket fd: %s had unexpected exception:',
+                self.getfd(),
+                exc_info=True,
+            )
+            self._terminate()
+            return
+        self.poller.update(self)
+
+    ## Prepare persistent connection for its next request.
+    def _reset(self):
+        self._dialogue = self._new_dialogue()
+        self._content = bytearray()
+        self.service = None
+        self._keep_alive = False
+        self._content_done = False
+        self._receiving = bool(self.buf)
+        if self._receiving:
+            self._started = time.time()
+            self._arm(constants.REQUEST_TIMEOUT)
+        else:
+            self._arm(constants.KEEP_ALIVE_TIMEOUT)
+        self.state = HttpSocket.FIRST
+        self.logger.debug('CHANGED STATE TO: %s', self.state)
+
+    ## Decide whether connection persists after current response.
+    # @returns (bool) True if connection should be kept alive.
+    #
+    # Response must be delimited by its headers, otherwise closing the
+    # connection is the only way to end it. Pre-serialized heads always
+    # hold Content-Length.
+    #
+    def _should_keep_alive(self):
+        if self.dialogue['request']['headers'][
+            'Connection'
+        ].lower() == 'close':
+            return False
+        headers = self.dialogue['response']['headers']
+        return (
+            'head' in self.dialogue['response'] or
+            'Content-Length' in headers or
+            'Transfer-Encoding' in headers
+        )
+
+    ## Examine parsed request head and pick service handling it.
+    # @param request (Request) parsed request head
     # @throws RuntimeError If URI is invalid
     #
-    def _validate(self, req):
-        req_comps = req.split(' ', 2)
-        if len(req_comps) != 3:
-            raise RuntimeError('Incomplete HTTP protocol')
-        method, uri, signature = req_comps
-        if signature != constants.HTTP_SIGNATURE:
-            raise RuntimeError('Not HTTP protocol')
-        parsed = urlparse.urlparse(uri)
-        if parsed.path not in self._services.keys():
+    def _validate(self, request):
+        if request.path not in self._services:
             raise RuntimeError(
                 "Invalid uri: %s",
-                uri,
+                request.uri,
             )
-        self.dialogue['request']['method'] = method
-        self.dialogue['request']['uri'] = parsed.path
-        self.dialogue['request']['params'] = urlparse.parse_qs(parsed.query)
-        self.service = self._services[parsed.path]()
+        self.dialogue['request']['method'] = request.method
+        self.dialogue['request']['uri'] = request.path
+        self.dialogue['request']['parsed'] = request
+        self.service = self._services[request.path]()
+        self._metrics['requests'].labels(request.path).inc()
         self.logger.debug('validated protocol')
 
     ## State machine logic handling and responding to HTTP requests.
-    # @throws RuntimeError If a header is too long
-    # @throws RuntimeError If request has too many headers
+    # @throws RuntimeError If request head violates protocol or limits
     #
     def _parse(self):
         if self.state == HttpSocket.FIRST:
-            n = self.buf.find(constants.CRLF_BIN)
-            if n != -1:
-                line = self.buf[:n].decode('utf-8')
-                self.buf = self.buf[n + len(constants.CRLF_BIN):]
-                self._validate(line)
+            request = self._parser.parse(self.buf)
+            if request is not None:
+                self._validate(request)
                 self.service.on_first_line(self.dialogue)
-                self.state = HttpSocket.HEADERS
+                self.service.on_headers(self.dialogue)
+                self.dialogue['request']['headers'].update(request.headers)
+                self.state = HttpSocket.CONTENT
                 self.logger.debug('CHANGED STATE TO: %s', self.state)
-        if self.state == HttpSocket.HEADERS:
-            self.service.on_headers(self.dialogue)
-            while self.buf:
-                n = self.buf.find(constants.CRLF_BIN)
-                if n == -1:
-                    break
-                if n == 0:
-                    self.state = HttpSocket.CONTENT
-                    self.logger.debug('CHANGED STATE TO: %s', self.state)
-                    self.buf = self.buf[n + len(constants.CRLF_BIN):]
-                    break
-                line = self.buf[:n].decode('utf-8')
-                if len(line) > constants.MAX_HEADER_LEN:
-                    raise RuntimeError("Header too long")
-                title, data = self._parse_header(line)
-                if len(
-                    self.dialogue['request']['headers'].keys()
-                ) > constants.MAX_HEADER_AMOUNT:
-                    raise RuntimeError("Too many headers")
-                if title in self.dialogue['request']['headers']:
-                    if title == 'Content-Length':
-                        data = int(data)
-                    self.dialogue['request']['headers'][title] = data
-                self.buf = self.buf[n + len(constants.CRLF_BIN):]
         if self.state == HttpSocket.CONTENT:
             if self.dialogue['request']['headers']['Content-Length'] > 0:
-                self.dialogue['request']['content'] += self.buf
-                self.logger.debug(
-                    'put content in context: %s',
-                    self.buf,
+                content = self.buf.take(
+                    self.dialogue['request']['headers']['Content-Length']
                 )
+                self._content.extend(content)
                 self.logger.debug(
-                    'actual content is: %s',
-                    self.dialogue['request']['content'],
+                    'put content in context: %s',
+                    content,
                 )
                 self.logger.debug(
                     'length before: %s',
                     self.dialogue['request']['headers']['Content-Length'],
                 )
                 self.dialogue[
-                    'request']['headers']['Content-Length'] -= len(self.buf)
+                    'request']['headers']['Content-Length'] -= len(content)
                 self.logger.debug(
                     'length after: %s',
                     self.dialogue['request']['headers']['Content-Length'],
                 )
-                self.buf = ''
                 self.service.on_content(self.dialogue)
             if self.dialogue['request']['headers']['Content-Length'] <= 0:
+                self.dialogue['request']['content'] = str(self._content)
+                self._disarm()
                 self.state = HttpSocket.R_FIRST
                 self.logger.debug('CHANGED STATE TO: %s', self.state)
         if self.state == HttpSocket.R_FIRST:
             self.service.response_first_line(self.dialogue)
-            self._format_first_line()
             self.state = HttpSocket.R_HEADERS
             self.logger.debug('CHANGED STATE TO: %s', self.state)
         if self.state == HttpSocket.R_HEADERS:
+            if not self.service.response_ready(self.dialogue):
+                self._suspend()
+                return
+            self._suspended = False
+            self._format_first_line()
             self.service.response_headers(self.dialogue)
+            self._keep_alive = self._should_keep_alive()
+            headers = self.dialogue['response']['headers']
+            if 'Connection' not in headers:
+                if self.keep_alive:
+                    headers['Connection'] = 'keep-alive'
+                    headers['Keep-Alive'] = (
+                        'timeout=%s' % constants.KEEP_ALIVE_TIMEOUT
+                    )
+                else:
+                    headers['Connection'] = 'close'
             self._format_headers()
             self.state = HttpSocket.R_CONTENT
             self.logger.debug('CHANGED STATE TO: %s', self.state)
         if self.state == HttpSocket.R_CONTENT:
-            self.service.response_content(self.dialogue)
-            self._format_content()
-            if len(
-                self.dialogue['response']['content']
-            ) == 0 and not self.outgoing:
+            if not self._content_done and self._file is None:
+                if not self.service.content_ready(self.dialogue):
+                    self._suspend()
+                    return
+                self._suspended = False
+                self.service.response_content(self.dialogue)
+                if 'file' in self.dialogue['response']:
+                    self._file = self.dialogue['response'].pop('file')
+                if len(self.dialogue['response']['content']) == 0:
+                    self._content_done = True
+                self._format_content()
+            if (
+                self._content_done and
+                not self.outgoing and
+                self._file is None
+            ):
                 self.state = HttpSocket.END
                 self.logger.debug('CHANGED STATE TO: %s', self.state)
         if self.state == HttpSocket.END:
-                self.service.on_end(self.dialogue)
+            self.service.on_end(self.dialogue)
+            self._metrics['latency'].labels(self.service.NAME).observe(
+                time.time() - self._started
+            )
+            if 'upgrade' in self.dialogue:
+                self._upgrade()
+                return
+            if not self.keep_alive:
                 self._terminate()
+                return
+            self._reset()
+            if self.buf:
+                self._parse()
+
+    ## Suspend response until service resumes it.
+    def _suspend(self):
+        if not self.suspended:
+            self._suspended = True
+            self.logger.debug('suspended %s', self.getfd())
 
     ## String formatting for response first line.
     #
+    # Services may provide a pre-serialized head holding the first line
+    # along with their fixed headers.
+    #
     def _format_first_line(self):
-        self.outgoing += (
+        if 'head' in self.dialogue['response']:
+            self.outgoing.append(self.dialogue['response']['head'])
+            return
+        self.outgoing.append((
             (
                 '%s %s %s\r\n'
             ) % (
@@ -419,32 +700,438 @@ class HttpSocket(Pollable):
                 self.dialogue['response']['code'],
                 self.dialogue['response']['message'],
             )
-        ).encode('utf-8')
+        ).encode('utf-8'))
 
     ## String formatting for response headers.
     #
     def _format_headers(self):
         for header, info in self.dialogue['response']['headers'].items():
-            self.outgoing += (
+            self.outgoing.append((
                 (
                     '%s: %s\r\n'
                 ) % (
                     header,
                     info,
                 )
-            ).encode('utf-8')
-        self.outgoing += '\r\n'.encode('utf-8')
+            ).encode('utf-8'))
+        self.outgoing.append('\r\n'.encode('utf-8'))
 
     ## Formatting for response content.
     #
+    # Chunked responses frame every piece of content and end with an empty
+    # chunk.
+    #
     def _format_content(self):
-        self.outgoing += self.dialogue['response']['content']
+        content = self.dialogue['response']['content']
+        if self.dialogue['response']['headers'].get(
+            'Transfer-Encoding'
+        ) != 'chunked':
+            self.outgoing.append(content)
+        elif content:
+            self.outgoing.append('%x\r\n' % len(content))
+            self.outgoing.append(content)
+            self.outgoing.append(constants.CRLF_BIN)
+        else:
+            self.outgoing.append('0\r\n\r\n')
+
+    ## Hand connection over to the protocol it was upgraded to.
+    #
+    # Socket is kept open and registered again under its new handler.
+    #
+    def _upgrade(self):
+        self._closed = True
+        self.poller.unregister(self)
+        self.poller.register(
+            WebSocketConnection(
+                self.socket,
+                self.poller,
+                self.context,
+                self.dialogue['upgrade']['room'],
+                self.dialogue['upgrade']['username'],
+                buf=self.buf,
+                block_size=self.block_size,
+            )
+        )
+        self.logger.debug('upgraded socket %s to websocket', self.getfd())
 
     ## End of communication. Close and remove communication socket.
     def _terminate(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._disarm()
+        if self._reading is not None:
+            self._reading.cancel()
+        if self._file is not None:
+            self._file[0].close()
+        if self.service is not None:
+            self.service.on_close(self.dialogue)
+        self._metrics['closed'].inc()
+        self._metrics['open'].dec()
         self.poller.unregister(self)
         self.logger.debug(
             'ended communication and closed socket %s',
             self.getfd(),
         )
         self.socket.close()
+
+
+## WebSocket chat connection handler.
+#
+# Created by @ref HttpSocket once a client upgraded its connection. Every
+# text frame received is a message posted to the room, every change of the
+# room is pushed back as a text frame holding revision, messages and users.
+#
+class WebSocketConnection(Pollable):
+
+    ## Constructor.
+    # @param socket (object) communication socket
+    # @param poller (object) related poller
+    # @param context (dict) application context
+    # @param room (str) chat room name
+    # @param username (str) connected user name
+    # @param buf (RecvBuffer) data received after handshake
+    # @param block_size (int) maximum amount to read
+    #
+    def __init__(
+        self,
+        socket,
+        poller,
+        context,
+        room,
+        username,
+        buf=None,
+        block_size=constants.BLOCK_SIZE,
+    ):
+        super(WebSocketConnection, self).__init__()
+        self._socket = socket
+        self._poller = poller
+        self._context = context
+        self._room = room
+        self._username = username
+        if buf is None:
+            buf = buffers.RecvBuffer(block_size)
+        self._buf = buf
+        self._block_size = block_size
+        self._outgoing = buffers.SendQueue(block_size)
+        self._fragments = []
+        self._revision = 0
+        self._heartbeat = poller.call_every(
+            constants.STREAM_HEARTBEAT,
+            self._ping,
+        )
+        self._waiter = None
+        self._closing = False
+        self._closed = False
+        self._metrics = _connection_metrics(poller.metrics)
+        self._push()
+
+    ## Retrieve socket.
+    @property
+    def socket(self):
+        return self._socket
+
+    ## Retrieve related poller.
+    @property
+    def poller(self):
+        return self._poller
+
+    ## Retrieve context.
+    @property
+    def context(self):
+        return self._context
+
+    ## Retrieve sending buffer.
+    @property
+    def outgoing(self):
+        return self._outgoing
+
+    ## @copydoc Pollable#getfd
+    def getfd(self):
+        return self.socket.fileno()
+
+    ## @copydoc Pollable#getevents
+    def getevents(self):
+        e = CommonEvents.POLLERR
+        if not self._closing:
+            e |= CommonEvents.POLLIN
+        if self.outgoing:
+            e |= CommonEvents.POLLOUT
+        return e
+
+    ## Ping client periodically, keeping it present in the room.
+    def _ping(self):
+        if self._closing:
+            return
+        self.context['store'].touch(self._room, self._username)
+        self.outgoing.append(websocket.encode_frame(websocket.PING))
+        self.poller.update(self)
+
+    ## @copydoc Pollable#onwrite
+    def onwrite(self):
+        sent = self.outgoing.sent
+        try:
+            self.outgoing.send(self.socket)
+        except socket.error as e:
+            if e.errno != errno.EWOULDBLOCK:
+                raise
+        finally:
+            self._metrics['sent'].inc(self.outgoing.sent - sent)
+        if self._closing and not self.outgoing:
+            self._terminate()
+
+    ## @copydoc Pollable#onread
+    def onread(self):
+        try:
+            n = self._buf.recv_into(self.socket, self._block_size)
+            if not n:
+                raise Disconnect()
+            self._metrics['received'].inc(n)
+        except socket.error as e:
+            if e.errno != errno.EWOULDBLOCK:
+                raise
+        try:
+            while not self._closing:
+                frame = websocket.decode_frame(
+                    self._buf,
+                    constants.MAX_FRAME_SIZE,
+                )
+                if frame is None:
+                    break
+                fin, opcode, payload, n = frame
+                self._buf.consume(n)
+                self._onframe(fin, opcode, payload)
+        except RuntimeError:
+            self.logger.debug('protocol error', exc_info=True)
+            self._close(websocket.CLOSE_PROTOCOL_ERROR)
+
+    ## @copydoc Pollable#onerror
+    def onerror(self):
+        self._terminate()
+
+    ## Handle a single received frame.
+    # @param fin (bool) True if last fragment of message
+    # @param opcode (int) frame opcode
+    # @param payload (str) frame payload
+    #
+    def _onframe(self, fin, opcode, payload):
+        if opcode == websocket.PING:
+            self.outgoing.append(
+                websocket.encode_frame(websocket.PONG, payload)
+            )
+        elif opcode == websocket.CLOSE:
+            self._close(websocket.CLOSE_NORMAL)
+        elif opcode in (websocket.TEXT, websocket.CONTINUATION):
+            self._fragments.append(payload)
+            if sum(len(f) for f in self._fragments) > constants.MAX_FRAME_SIZE:
+                raise RuntimeError('Message too big')
+            if fin:
+                text = ''.join(self._fragments).decode('utf-8')
+                self._fragments = []
+                self._post(text)
+
+    ## Post message to room.
+    # @param text (unicode) message text
+    #
+    def _post(self, text):
+        self.context['store'].post(self._room, self._username, [text])
+
+    ## Waiter called when room has new messages.
+    def _wake(self):
+        self._waiter = None
+        if self._closed or self._closing:
+            return
+        self._push()
+        self.poller.update(self)
+
+    ## Queue everything new in room since last push and wait for more.
+    def _push(self):
+        room = self.context['rooms'][self._room]
+        messages = room['history'].since(self._revision)
+        if messages:
+            self._revision = room['history'].revision
+            self.outgoing.append(websocket.encode_frame(
+                websocket.TEXT,
+                json.dumps({
+                    'revision': self._revision,
+                    'messages': messages,
+                    'users': room['users'].keys(),
+                }),
+            ))
+        if self._waiter is None:
+            self._waiter = util.add_waiter(room, self._wake)
+
+    ## Start closing handshake.
+    # @param code (int) close status code
+    #
+    def _close(self, code):
+        if not self._closing:
+            self._closing = True
+            self.outgoing.append(websocket.encode_close(code))
+
+    ## End of communication. Close and remove communication socket.
+    def _terminate(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._heartbeat.cancel()
+        util.cancel_waiter(self._waiter)
+        self._waiter = None
+        self._metrics['closed'].inc()
+        self._metrics['open'].dec()
+        self.poller.unregister(self)
+        self.logger.debug(
+            'ended websocket communication and closed socket %s',
+            self.getfd(),
+        )
+        self.socket.close()
+
+
+## Connection carrying newline separated operations between processes.
+#
+class StoreLink(Pollable):
+
+    ## Separator of operations.
+    NEWLINE = '\n'
+
+    ## Constructor.
+    # @param socket (object) connected socket
+    # @param poller (object) related poller
+    # @param on_receive (callable) called with link and whole lines received
+    # @param on_close (callable) called with link once closed
+    # @param block_size (int) maximum amount to read
+    #
+    def __init__(
+        self,
+        socket,
+        poller,
+        on_receive,
+        on_close,
+        block_size=constants.BLOCK_SIZE,
+    ):
+        super(StoreLink, self).__init__()
+        self._socket = socket
+        self._socket.setblocking(False)
+        self._poller = poller
+        self._on_receive = on_receive
+        self._on_close = on_close
+        self._block_size = block_size
+        self._buf = buffers.RecvBuffer(block_size)
+        self._outgoing = buffers.SendQueue(block_size)
+        self._closed = False
+
+    ## Retrieve socket.
+    @property
+    def socket(self):
+        return self._socket
+
+    ## Retrieve related poller.
+    @property
+    def poller(self):
+        return self._poller
+
+    ## Queue data and have poller send it.
+    # @param data (str) lines to send
+    #
+    def send(self, data):
+        if self._closed:
+            return
+        self._outgoing.append(data)
+        self.poller.update(self)
+
+    ## @copydoc Pollable#getfd
+    def getfd(self):
+        return self.socket.fileno()
+
+    ## @copydoc Pollable#getevents
+    def getevents(self):
+        e = CommonEvents.POLLERR | CommonEvents.POLLIN
+        if self._outgoing:
+            e |= CommonEvents.POLLOUT
+        return e
+
+    ## @copydoc Pollable#onwrite
+    def onwrite(self):
+        try:
+            self._outgoing.send(self.socket)
+        except socket.error as e:
+            if e.errno != errno.EWOULDBLOCK:
+                raise
+
+    ## @copydoc Pollable#onread
+    def onread(self):
+        try:
+            if not self._buf.recv_into(self.socket, self._block_size):
+                raise Disconnect()
+        except socket.error as e:
+            if e.errno != errno.EWOULDBLOCK:
+                raise
+        lines = []
+        while True:
+            n = self._buf.find(self.NEWLINE)
+            if n == -1:
+                break
+            lines.append(self._buf.take(n + len(self.NEWLINE)))
+        if lines:
+            self._on_receive(self, ''.join(lines))
+
+    ## @copydoc Pollable#onerror
+    def onerror(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.poller.unregister(self)
+        self._on_close(self)
+        self.socket.close()
+
+
+## Wakeup of polling loop by other threads.
+#
+# Polls one end of a socket pair, other threads write to the other end.
+#
+class Notifier(Pollable):
+
+    ## Constructor.
+    # @param socket (object) socket to poll
+    # @param poller (object) related poller
+    # @param callback (callable) called on every wakeup
+    #
+    def __init__(self, socket, poller, callback):
+        super(Notifier, self).__init__()
+        self._socket = socket
+        self._socket.setblocking(False)
+        self._poller = poller
+        self._callback = callback
+
+    ## Retrieve socket.
+    @property
+    def socket(self):
+        return self._socket
+
+    ## Retrieve related poller.
+    @property
+    def poller(self):
+        return self._poller
+
+    ## @copydoc Pollable#getfd
+    def getfd(self):
+        return self.socket.fileno()
+
+    ## @copydoc Pollable#getevents
+    def getevents(self):
+        return CommonEvents.POLLERR | CommonEvents.POLLIN
+
+    ## @copydoc Pollable#onread
+    def onread(self):
+        try:
+            if not self.socket.recv(constants.BLOCK_SIZE):
+                raise Disconnect()
+        except socket.error as e:
+            if e.errno != errno.EWOULDBLOCK:
+                raise
+        self._callback()
+
+    ## @copydoc Pollable#onerror
+    def onerror(self):
+        self.poller.unregister(self)
+        self.socket.close()
@@ -0,0 +1,67 @@
+## @package HTTP--Chat.presence Presence module.
+## @file presence.py Implementation of @ref HTTP--Chat.presence
+#
+
+import base
+import constants
+import heapq
+import itertools
+import time
+
+
+## Presence of users in chat rooms.
+#
+# Every room keeps its users, mapped to the time they were last seen, in
+# room['users'], so listing them needs no scan. Expiry is indexed by a heap
+# holding a single entry per present user. Seeing a user again only updates
+# the room, an entry that comes due for a user seen meanwhile is pushed back
+# to its new deadline. Expiring is therefore amortized O(expired) and runs
+# from the server loop rather than from requests.
+#
+class Presence(base.Base):
+
+    ## Constructor.
+    # @param period (float) time in seconds until a user is inactive
+    #
+    def __init__(self, period=constants.EXPIRED_PERIOD):
+        super(Presence, self).__init__()
+        self._period = period
+        self._heap = []
+        self._counter = itertools.count()
+
+    ## Retrieve amount of users tracked in all rooms.
+    def __len__(self):
+        return len(self._heap)
+
+    ## Mark user as active in room.
+    # @param room (dict) chat room
+    # @param username (str) user name
+    #
+    def touch(self, room, username):
+        now = time.time()
+        if username not in room['users']:
+            room['users_version'] += 1
+            heapq.heappush(
+                self._heap,
+                (now + self._period, next(self._counter), room, username),
+            )
+        room['users'][username] = now
+
+    ## Remove users inactive for too long.
+    # @param now (float) current time, None for now
+    #
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, room, username = heapq.heappop(self._heap)
+            seen = room['users'][username]
+            if now - seen >= self._period:
+                del room['users'][username]
+                room['users_version'] += 1
+                self.logger.debug('%s is inactive', username)
+            else:
+                heapq.heappush(
+                    self._heap,
+                    (seen + self._period, next(self._counter), room, username),
+                )
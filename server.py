@@ -9,11 +9,25 @@ import base
 import constants
 import errno
 import events
+import executor
+import heapq
+import itertools
 import logging
+import math
+import messagelog
+import metrics
+import os
 import pollable
 import select
+import services
 import signal
 import socket
+import store
+import time
+
+
+## SO_REUSEPORT socket option, missing from socket module of python-2.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
 
 
 ## Disconnect exception.
@@ -26,15 +40,63 @@ class Disconnect(RuntimeError):
         super(Disconnect, self).__init__('Disconnect')
 
 
+## Scheduled callback.
+#
+# Returned by @ref Server.call_later and @ref Server.call_every, cancelled
+# timers stay in the schedule and are skipped once due.
+#
+class Timer(base.Base):
+
+    ## Constructor.
+    # @param deadline (float) time to run at
+    # @param callback (callable) function to run
+    # @param args (tuple) callback arguments
+    # @param period (float) time in seconds between runs, None to run once
+    #
+    def __init__(self, deadline, callback, args, period=None):
+        super(Timer, self).__init__()
+        self._deadline = deadline
+        self._callback = callback
+        self._args = args
+        self._period = period
+        self._cancelled = False
+
+    ## Retrieve time to run at.
+    @property
+    def deadline(self):
+        return self._deadline
+
+    ## Retrieve time between runs.
+    @property
+    def period(self):
+        return self._period
+
+    ## Retrieve whether timer was cancelled.
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    ## Cancel timer, does nothing if it already ran.
+    def cancel(self):
+        self._cancelled = True
+
+    ## Run callback.
+    #
+    # Periodic timer is moved to its next deadline first.
+    #
+    def run(self):
+        if self._period is not None:
+            self._deadline += self._period
+        self._callback(*self._args)
+
+
 ## Server implementation.
 #
-# Handles poller loop.
+# Handles poller loop and schedule of timers. Poll waits no longer than
+# until the next timer is due.
 #
 class Server(base.Base):
 
-    ## List of pollable I/O objects.
-    _pollable = []
-
     ## Constructor.
     # @param timeout (float) maximum time window for I/O.
     # @param poll_type (object) poll logic, platform based.
@@ -47,42 +109,194 @@ class Server(base.Base):
         super(Server, self).__init__()
         self._timeout = timeout
         self._poll_type = poll_type
+        self._poller = poll_type()
+        self._pollable = {}
+        self._interest = {}
+        self._timers = []
+        self._counter = itertools.count()
+        self._running = False
+        self._stall = 0
+        self._metrics = metrics.Registry()
+        self._iteration = self._metrics.histogram(
+            'chat_loop_iteration_seconds',
+            'Time spent handling events and timers of a single poll.',
+            constants.LOOP_BUCKETS,
+        )
+        self._ready = self._metrics.histogram(
+            'chat_loop_ready_events',
+            'Events ready per poll.',
+            constants.EVENTS_BUCKETS,
+        )
 
     ## Retrive timeout.
     @property
     def timeout(self):
         return self._timeout
 
+    ## Retrieve longest time in seconds spent handling events of a single
+    ## poll, since last logged.
+    @property
+    def stall(self):
+        return self._stall
+
+    ## Retrieve metrics of polling loop and everything it runs.
+    @property
+    def metrics(self):
+        return self._metrics
+
     ## Retrive poll type.
     @property
     def poll_type(self):
         return self._poll_type
 
+    ## Retrive persistent poller.
+    @property
+    def poller(self):
+        return self._poller
+
     ## Add listener socket.
     # @param bind_address (str) socket address
     # @param bind_port (int) socket port
+    # @param context (dict) application context
+    # @param reuse_port (bool) share port with listeners of other processes
     #
     def add_passive(
         self,
         bind_address,
         bind_port,
+        context,
+        reuse_port=False,
     ):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuse_port:
+            s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         s.bind((bind_address, bind_port))
-        s.listen(10)
+        s.listen(constants.LISTEN_BACKLOG)
         s.setblocking(False)
-        self._pollable.append()
+        self.register(
+            pollable.SocketListen(
+                s,
+                pollable.HttpSocket,
+                self,
+                context,
+            )
+        )
         self.logger.debug(
             'Created new listener socket %s:%s',
             bind_address,
             bind_port,
         )
 
+    ## Schedule callback.
+    # @param delay (float) time in seconds to wait
+    # @param callback (callable) function to run
+    # @param args (tuple) callback arguments
+    # @returns (Timer) scheduled timer
+    # @throws ValueError If delay is not a finite number
+    #
+    # Callbacks run from polling loop. Those changing events of I/O objects
+    # must update them, see @ref update.
+    #
+    def call_later(self, delay, callback, *args):
+        return self._schedule(Timer(time.time() + delay, callback, args))
+
+    ## Schedule callback to run periodically.
+    # @param period (float) time in seconds between runs
+    # @param callback (callable) function to run
+    # @param args (tuple) callback arguments
+    # @returns (Timer) scheduled timer, cancelling it stops the runs
+    # @throws ValueError If period is not a finite number
+    #
+    def call_every(self, period, callback, *args):
+        return self._schedule(
+            Timer(time.time() + period, callback, args, period=period)
+        )
+
+    ## Add timer to schedule.
+    # @param timer (Timer) timer to add
+    # @returns (Timer) added timer
+    # @throws ValueError If deadline of timer is not a finite number
+    #
+    # A deadline that does not compare to others would break heap order.
+    #
+    def _schedule(self, timer):
+        if math.isnan(timer.deadline) or math.isinf(timer.deadline):
+            raise ValueError('Invalid timer deadline: %s' % timer.deadline)
+        heapq.heappush(
+            self._timers,
+            (timer.deadline, next(self._counter), timer),
+        )
+        return timer
+
+    ## Time until next timer is due.
+    # @param now (float) current time
+    # @returns (int) milliseconds to wait, at most poll timeout
+    #
+    def _next_timeout(self, now):
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return self.timeout
+        delay = (self._timers[0][0] - now) * 1000
+        if delay <= 0:
+            return 0
+        # written so a delay that is not a number waits whole poll timeout
+        if delay < self.timeout:
+            return int(delay) + 1
+        return self.timeout
+
+    ## Run every timer that is due.
+    #
+    # Timers scheduled meanwhile run on next iteration at the earliest.
+    #
+    def _run_timers(self):
+        now = time.time()
+        due = []
+        while self._timers and self._timers[0][0] <= now:
+            due.append(heapq.heappop(self._timers)[2])
+        for timer in due:
+            if timer.cancelled:
+                continue
+            try:
+                timer.run()
+            except Exception:
+                self.logger.debug(
+                    'Timer %s had unexpected exception:',
+                    timer,
+                    exc_info=True,
+                )
+            if timer.period is not None and not timer.cancelled:
+                self._schedule(timer)
+
+    ## Log server state.
+    #
+    # Longest stall of polling loop is reset once logged.
+    #
+    def _log_stats(self):
+        self.logger.debug(
+            'handling %s connections, %s timers scheduled, '
+            'longest loop stall %.1f ms',
+            len(self._pollable),
+            len(self._timers),
+            self._stall * 1000,
+        )
+        self._stall = 0
+
+    ## Stop polling loop, closing every I/O object.
+    #
+    # Safe to call from signal handlers.
+    #
+    def close_server(self):
+        self._running = False
+
     ## Add I/O object to polling list.
     # @param object (object) I/O entity to add
     #
     def register(self, object):
-        self._pollable.append(object)
+        fd = object.getfd()
+        self._pollable[fd] = object
+        self._interest[fd] = object.getevents()
+        self._poller.register(fd, self._interest[fd])
         self.logger.debug('registered %s', object)
 
     ## Remove I/O object from polling list.
@@ -90,74 +304,128 @@ class Server(base.Base):
     #
     def unregister(self, object):
         self.logger.debug('removed %s', object)
-        self._pollable.remove(object)
+        fd = object.getfd()
+        del self._pollable[fd]
+        del self._interest[fd]
+        self._poller.unregister(fd)
 
-    ## Create poller object.
-    # @returns poller object.
+    ## Push I/O object events to poller if they have changed.
+    # @param object (object) registered I/O entity
+    #
+    # Must be called whenever object events may change outside of its own
+    # event handlers.
     #
-    def _create_poller(self):
-        poller = self.poll_type()
-        for s in self._pollable:
-            poller.register(s.getfd(), s.getevents())
-        return poller
+    def update(self, object):
+        self._update(object.getfd(), object)
+
+    ## Push I/O object events to poller if they have changed.
+    # @param fd (int) fd object was registered with
+    # @param object (object) registered I/O entity
+    #
+    def _update(self, fd, object):
+        if self._pollable.get(fd) is not object:
+            return
+        e = object.getevents()
+        if e != self._interest[fd]:
+            self._interest[fd] = e
+            self._poller.modify(fd, e)
 
     ## Retrieve I/O object based on fd.
     # @param fd (int) fd to match
     # @returns (object) object matching fd
     #
     def _get_socket(self, fd):
-        for s in self._pollable:
-            if s.getfd() == fd:
-                return s
+        return self._pollable.get(fd)
 
     ## Polling loop.
     #
-    # For each registered fd invokes methods appropriate to events.
+    # For each registered fd invokes methods appropriate to events, then runs
+    # due timers.
     #
     def run(self):
-        while self._pollable:
-            self.logger.debug(
-                'currently handling %s connctions',
-                len(self._pollable),
-            )
+        self._running = True
+        stats = self.call_every(constants.STATS_PERIOD, self._log_stats)
+        while self._running and self._pollable:
             try:
+                polled = []
                 try:
-                    for fd, e in self._create_poller().poll(self.timeout):
-                        socket = self._get_socket(fd)
-                        try:
-                            if (
-                                e &
-                                (
-                                    events.CommonEvents.POLLHUP |
-                                    events.CommonEvents.POLLERR
-                                )
-                            ):
-                                raise RuntimeError('Connection Broken')
-                            if e & events.CommonEvents.POLLIN:
-                                socket.onread()
-                            if e & events.CommonEvents.POLLOUT:
-                                socket.onwrite()
-                        except Disconnect:
-                            self.logger.debug(
-                                'Socket fd: %d has disconnected',
-                                fd,
-                            )
-                            socket.onerror()
-                        except Exception as ex:
-                            self.logger.debug(
-                                'Socket fd: %s had unexpected exception:',
-                                fd,
-                                exc_info=True,
-                            )
-                            socket.onerror()
-                except select.error as ex:
-                    if ex[0] != errno.EINTR:
+                    polled = self.poller.poll(
+                        self._next_timeout(time.time())
+                    )
+                except (select.error, IOError, OSError) as ex:
+                    if ex.args[0] != errno.EINTR:
                         raise
+                start = time.time()
+                for fd, e in polled:
+                    socket = self._get_socket(fd)
+                    if socket is None:
+                        continue
+                    try:
+                        if (
+                            e &
+                            (
+                                events.CommonEvents.POLLHUP |
+                                events.CommonEvents.POLLERR
+                            )
+                        ):
+                            raise RuntimeError('Connection Broken')
+                        if e & events.CommonEvents.POLLIN:
+                            socket.onread()
+                        if e & events.CommonEvents.POLLOUT:
+                            socket.onwrite()
+                    except Disconnect:
+                        self.logger.debug(
+                            'Socket fd: %d has disconnected',
+                            fd,
+                        )
+                        socket.onerror()
+                    except Exception as ex:
+                        self.logger.debug(
+                            'Socket fd: %s had unexpected exception:',
+                            fd,
+                            exc_info=True,
+                        )
+                        socket.onerror()
+                    self._update(fd, socket)
+                self._run_timers()
+                elapsed = time.time() - start
+                self._stall = max(self._stall, elapsed)
+                self._iteration.observe(elapsed)
+                self._ready.observe(len(polled))
             except Exception as ex:
                 self.logger.debug(
                     'Unexpected error: %s',
                     exc_info=True,
                 )
+        stats.cancel()
+        for socket in self._pollable.values():
+            try:
+                socket.onerror()
+            except Exception:
+                self.logger.debug(
+                    'Socket %s failed to close:',
+                    socket,
+                    exc_info=True,
+                )
+
+
+## Fork worker processes.
+# @param amount (int) amount of workers
+# @returns (tuple) in a worker, socket connected to parent process and an
+# empty list. In parent process, None and sockets connected to workers.
+#
+def fork_workers(amount):
+    links = []
+    for i in range(amount):
+        parent_end, worker_end = socket.socketpair()
+        if os.fork() == 0:
+            parent_end.close()
+            for link in links:
+                link.close()
+            return worker_end, []
+        worker_end.close()
+        links.append(parent_end)
+    return None, links
 
 
 ## Parse program arguments. Make them easy to input and access.
@@ -211,6 +479,33 @@ def parse_args():
         type=int,
         help='maximum block size for buffers. default: %(default)s',
     )
+    parser.add_argument(
+        '--max-age',
+        default=constants.CACHE_MAX_AGE,
+        type=int,
+        help='Cache-Control max-age of static files. default: %(default)s',
+    )
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help='''amount of worker processes sharing the listening port.
+            default: %(default)s
+            ''',
+    )
+    parser.add_argument(
+        '--threads',
+        default=constants.EXECUTOR_THREADS,
+        type=int,
+        help='amount of threads running blocking work. default: %(default)s',
+    )
+    parser.add_argument(
+        '--data-dir',
+        default=None,
+        help='''directory to keep message logs in.
+            default: keep messages in memory only
+            ''',
+    )
     parser.add_argument(
         '--poll-type',
         choices=EVENT_TYPES.keys(),
@@ -221,6 +516,11 @@ def parse_args():
     )
     args = parser.parse_args()
     args.log_level = LOG_LEVELS[args.log_level_str]
+    args.poll_type = EVENT_TYPES[args.poll_type]
+    if args.workers < 1:
+        parser.error('at least one worker is needed')
+    if args.threads < 1:
+        parser.error('at least one thread is needed')
     return args
 
 
@@ -242,7 +542,32 @@ def main():
     try:
         logger.info('Startup')
         logger.debug('Args: %s', args)
-        server = Server(args.timeout)
+        message_log, restored = None, None
+        if args.data_dir is not None:
+            message_log = messagelog.MessageLog(args.data_dir)
+            restored = message_log.restore()
+        link, workers = None, []
+        if args.workers > 1:
+            link, workers = fork_workers(args.workers)
+        server = Server(
+            args.timeout,
+            poll_type=args.poll_type,
+        )
+        pool = executor.Executor(server, threads=args.threads)
+        if message_log is not None:
+            if link is not None:
+                # parent process records, workers only read
+                message_log.close()
+                message_log = messagelog.MessageLog(
+                    args.data_dir,
+                    writable=False,
+                )
+            else:
+                server.call_every(
+                    constants.LOG_SYNC_PERIOD,
+                    message_log.sync,
+                    pool,
+                )
 
         def exit_handler(signal, frame):
             server.close_server()
@@ -250,37 +575,67 @@ def main():
         signal.signal(signal.SIGINT, exit_handler)
         signal.signal(signal.SIGTERM, exit_handler)
 
+        if workers:
+            # parent process only relays store operations, workers exit
+            # once it closes their links
+            store.StoreHub(workers, server, message_log)
+            server.run()
+            pool.shutdown()
+            if message_log is not None:
+                message_log.close()
+            for i in range(len(workers)):
+                while True:
+                    try:
+                        os.wait()
+                        break
+                    except OSError as e:
+                        if e.errno != errno.EINTR:
+                            raise
+            return
+
+        if link is None:
+            chat_store = store.LocalStore(restored, message_log)
+        else:
+            chat_store = store.ReplicatedStore(link, server, restored)
         response_context = {}
         request_context = {
-            'users': {
-
-            },
-            'rooms': {
-
-            },
+            'users': chat_store.users,
+            'rooms': chat_store.rooms,
+            'static': services.StaticCache(max_age=args.max_age),
+            'store': chat_store,
+            'executor': pool,
+            'log': message_log,
+            'metrics': server.metrics,
         }
+        chat_store.add_metrics(server.metrics)
+        server.call_every(
+            constants.CHECK_PERIOD,
+            chat_store.presence.expire,
+        )
+        server.call_every(
+            constants.STATIC_CHECK_PERIOD,
+            request_context['static'].refresh,
+            request_context['executor'],
+        )
+        for service in services.service_classes():
+            if service.FILE is not None:
+                request_context['static'].load(
+                    service.FILE,
+                    service.CONTENT_TYPE,
+                )
 
         bind_addr, bind_port = args.new.split(':')
-        bind_port = int(bind_port)
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.bind((bind_addr, bind_port))
-        s.listen(10)
-        s.setblocking(False)
-        server.register(
-            pollable.SocketListen(
-                s,
-                pollable.HttpSocket,
-                server,
-                request_context,
-            )
-        )
-        server.logger.debug(
-            'Created new listener socket %s:%s',
+        server.add_passive(
             bind_addr,
-            bind_port,
+            int(bind_port),
+            request_context,
+            reuse_port=link is not None,
         )
 
         server.run()
+        pool.shutdown()
+        if message_log is not None:
+            message_log.close()
 
     except Exception as e:
         logger.debug('Exception', exc_info=True)
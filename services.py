@@ -5,10 +5,16 @@
 import Cookie
 import base
 import constants
+import email.utils
+import formats
+import hashlib
+import json
+import metrics
 import os
 import time
 import urlparse
 import util
+import websocket
 import xml.etree.ElementTree as et
 
 
@@ -19,6 +25,12 @@ class Service(base.Base):
     ## Service name, request URI.
     NAME = 'Base'
 
+    ## Static file served by service, if any.
+    FILE = None
+
+    ## Content type of static file.
+    CONTENT_TYPE = None
+
     ## Constructor.
     def __init__(self):
         super(Service, self).__init__()
@@ -47,15 +59,40 @@ class Service(base.Base):
     def response_first_line(self, dialogue):
         pass
 
+    ## Method to call before response headers state.
+    # @param dialogue (dict) application context
+    # @returns (bool) True if response can be sent now.
+    #
+    # A service that is not ready must arrange for dialogue['resume'] to be
+    # called once it is, until then the response is suspended. Services
+    # waiting for time to pass schedule it with dialogue['call_later'], see
+    # @ref server.Server.call_later, and cancel the returned timer once done.
+    #
+    def response_ready(self, dialogue):
+        return True
+
     ## Method to call on response headers state.
     # @param dialogue (dict) application context
     #
     def response_headers(self, dialogue):
         pass
 
+    ## Method to call before each response content state.
+    # @param dialogue (dict) application context
+    # @returns (bool) True if more content can be produced now.
+    #
+    # Same contract as @ref response_ready.
+    #
+    def content_ready(self, dialogue):
+        return True
+
     ## Method to call on response content state.
     # @param dialogue (dict) application context
     #
+    # Called repeatedly, empty content ends the response. A service may also
+    # set dialogue['response']['file'] to a (file, offset, length) tuple, that
+    # part of the file is sent by the connection before asking for more.
+    #
     def response_content(self, dialogue):
         pass
 
@@ -65,124 +102,672 @@ class Service(base.Base):
     def on_end(self, dialogue):
         pass
 
+    ## Method to call once connection closes.
+    # @param dialogue (dict) application context
+    #
+    # Called whether or not communication reached its end, so services
+    # release timers and waiters of connections closed while waiting.
+    #
+    def on_close(self, dialogue):
+        pass
 
-## File service sending application icon.
+
+## Cache of static files served by file services.
+#
+# Every file is kept in memory along with its pre-serialized response head,
+# status line and headers, so serving it costs no file system access. A file
+# is reloaded once its modification time or size changes, checked by
+# @ref refresh in a worker thread, see @ref executor.Executor.
 #
-class Favicon(Service):
+# Files bigger than max_size only have their head cached, their body is left
+# for services to hand to the connection as a file.
+#
+# Validators are computed once per load, letting services answer conditional
+# requests with a pre-serialized 304 head. Each cached head holds the response
+# status line and every fixed header.
+#
+class StaticCache(base.Base):
 
-    ## Service name, request URI.
-    NAME = '/favicon.ico'
+    ## Constructor.
+    # @param max_size (int) maximum size of file kept in memory
+    # @param max_age (int) seconds clients may use files without revalidating
+    #
+    def __init__(
+        self,
+        max_size=constants.STATIC_MAX_SIZE,
+        max_age=constants.CACHE_MAX_AGE,
+    ):
+        super(StaticCache, self).__init__()
+        self._max_size = max_size
+        self._max_age = max_age
+        self._entries = {}
+        self._refreshing = None
+
+    ## Load file into cache.
+    # @param path (str) file path
+    # @param content_type (str) file content type
+    # @returns (dict) cache entry
+    #
+    def load(self, path, content_type):
+        entry = self._entries[path] = self._read(path, content_type)
+        return entry
+
+    ## Read file and build its cache entry.
+    # @param path (str) file path
+    # @param content_type (str) file content type
+    # @returns (dict) cache entry
+    #
+    # Files kept in memory are also compressed once, the compressed variant is
+    # kept if it saves at least @ref constants.COMPRESS_MIN_RATIO of the size.
+    # Safe to call from worker threads.
+    #
+    def _read(self, path, content_type):
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            body = f.read() if st.st_size <= self._max_size else None
+        compressed = None
+        if body is not None:
+            etag = hashlib.md5(body).hexdigest()
+            compressed = util.compress(body, 'gzip')
+            if len(compressed) > len(body) * (1 - constants.COMPRESS_MIN_RATIO):
+                compressed = None
+        else:
+            etag = '%x-%x' % (st.st_size, int(st.st_mtime * 1000))
+        vary = '' if compressed is None else 'Vary: Accept-Encoding\r\n'
+        entry = self._variant(
+            st,
+            content_type,
+            '"%s"' % etag,
+            vary,
+            body,
+        )
+        entry.update({
+            'path': path,
+            'mtime': st.st_mtime,
+            'size': st.st_size,
+            'content_type': content_type,
+            'gzip': None,
+        })
+        if compressed is not None:
+            entry['gzip'] = self._variant(
+                st,
+                content_type,
+                '"%s-gzip"' % etag,
+                vary + 'Content-Encoding: gzip\r\n',
+                compressed,
+            )
+        self.logger.debug('read %s, %s bytes', path, st.st_size)
+        return entry
+
+    ## Pre-serialize response heads of a single representation of file.
+    # @param st (object) file status
+    # @param content_type (str) file content type
+    # @param etag (str) representation entity tag
+    # @param extra (str) serialized headers specific to representation
+    # @param body (str) representation content, None if not in memory
+    # @returns (dict) heads, entity tag and content of representation
+    #
+    def _variant(self, st, content_type, etag, extra, body):
+        validators = (
+            'ETag: %s\r\n'
+            'Last-Modified: %s\r\n'
+            'Cache-Control: max-age=%s\r\n'
+            '%s'
+        ) % (
+            etag,
+            email.utils.formatdate(st.st_mtime, usegmt=True),
+            self._max_age,
+            extra,
+        )
+        return {
+            'head': (
+                '%s 200 OK\r\n'
+                'Content-Length: %s\r\n'
+                'Content-Type: %s\r\n'
+                '%s'
+            ) % (
+                constants.HTTP_SIGNATURE,
+                st.st_size if body is None else len(body),
+                content_type,
+                validators,
+            ),
+            'not_modified': '%s 304 Not Modified\r\n%s' % (
+                constants.HTTP_SIGNATURE,
+                validators,
+            ),
+            'etag': etag,
+            'body': body,
+        }
+
+    ## Retrieve cached file, loading it if not cached yet.
+    # @param path (str) file path
+    # @param content_type (str) file content type
+    # @returns (dict) cache entry
+    #
+    def get(self, path, content_type):
+        entry = self._entries.get(path)
+        if entry is None:
+            return self.load(path, content_type)
+        return entry
+
+    ## Reload changed files in a worker thread.
+    # @param executor (Executor) executor to run check on
+    #
+    # Does nothing while previous check still runs.
+    #
+    def refresh(self, executor):
+        if self._refreshing is None:
+            self._refreshing = executor.submit(
+                self._refreshed,
+                self._changed,
+                self._entries.values(),
+            )
+
+    ## Read files changed since cached.
+    # @param entries (list) cache entries to check
+    # @returns (list) new cache entries
+    #
+    # Runs in a worker thread.
+    #
+    def _changed(self, entries):
+        changed = []
+        for entry in entries:
+            st = os.stat(entry['path'])
+            if st.st_mtime != entry['mtime'] or st.st_size != entry['size']:
+                changed.append(
+                    self._read(entry['path'], entry['content_type'])
+                )
+        return changed
+
+    ## Replace entries of changed files.
+    # @param changed (list) new cache entries
+    # @param error (Exception) error checking files, None if checked
+    #
+    def _refreshed(self, changed, error):
+        self._refreshing = None
+        if error is not None:
+            self.logger.error('failed to refresh static files: %s', error)
+            return
+        for entry in changed:
+            self._entries[entry['path']] = entry
+            self.logger.debug('reloaded %s', entry['path'])
+
+    ## Check whether client copy of cached file is still valid.
+    # @param entry (dict) cache entry
+    # @param headers (dict) request headers
+    # @returns (bool) True if client copy is valid.
+    #
+    # If-None-Match takes precedence over If-Modified-Since.
+    #
+    def not_modified(self, entry, headers):
+        if 'If-None-Match' in headers:
+            tags = [t.strip() for t in headers['If-None-Match'].split(',')]
+            return '*' in tags or entry['etag'] in tags
+        if 'If-Modified-Since' in headers:
+            since = email.utils.parsedate_tz(headers['If-Modified-Since'])
+            return (
+                since is not None and
+                email.utils.mktime_tz(since) >= int(entry['mtime'])
+            )
+        return False
+
+    ## Respond to request with cached file.
+    # @param entry (dict) cache entry
+    # @param dialogue (dict) application context
+    # @returns (str) content to send, None if file itself should be sent.
+    #
+    # Compressed variant is chosen when client accepts it.
+    #
+    def respond(self, entry, dialogue):
+        headers = dialogue['request']['headers']
+        if entry['gzip'] is not None and util.choose_encoding(
+            headers.get('Accept-Encoding', ''),
+            ('gzip',),
+        ):
+            entry = entry['gzip']
+        if self.not_modified(entry, headers):
+            dialogue['response']['code'] = '304'
+            dialogue['response']['message'] = 'Not Modified'
+            dialogue['response']['head'] = entry['not_modified']
+            return ''
+        dialogue['response']['code'] = '200'
+        dialogue['response']['message'] = 'OK'
+        dialogue['response']['head'] = entry['head']
+        return entry['body']
+
+
+## Service sending a static file.
+#
+# Files are served from @ref StaticCache, those too big to be cached are
+# handed over to the connection to send. Subclasses set FILE and
+# CONTENT_TYPE, those sending the file only for some requests call
+# @ref _respond_file themselves.
+#
+class FileService(Service):
 
     ## Constructor.
     def __init__(
         self,
     ):
-        super(Favicon, self).__init__()
+        super(FileService, self).__init__()
         self._resource = None
         self._content = ''
+        self._file = None
 
-    ## Retrieve fd of file to send.
+    ## Retrieve cache entry of file to send.
     @property
     def resource(self):
         return self._resource
 
-    ## Set the fd of file to send.
+    ## Set cache entry of file to send.
     @resource.setter
     def resource(self, val):
         self._resource = val
 
+    ## Respond with file.
+    # @param dialogue (dict) application context
+    #
+    def _respond_file(self, dialogue):
+        self.resource = dialogue['request']['context']['static'].get(
+            self.FILE, self.CONTENT_TYPE)
+        self._content = dialogue['request']['context']['static'].respond(
+            self.resource, dialogue)
+
     ## @copydoc Service#response_first_line
     def response_first_line(self, dialogue):
-        dialogue['response']['code'] = '200'
-        dialogue['response']['message'] = 'OK'
-        self.resource = open('chat.ico', 'rb')
-
-    ## @copydoc Service#response_headers
-    def response_headers(self, dialogue):
-        dialogue['response']['headers']['Content-Length'] = os.fstat(
-            self.resource.fileno()).st_size
-        dialogue['response']['headers']['Content-Type'] = 'image/jpeg'
+        self._respond_file(dialogue)
 
     ## @copydoc Service#response_content
     def response_content(self, dialogue):
-        dialogue['response']['content'] = self.resource.read(
-            constants.BLOCK_SIZE)
+        if self._content is None:
+            self._file = open(self.resource['path'], 'rb')
+            dialogue['response']['file'] = (
+                self._file, 0, self.resource['size'])
+            self._content = ''
+        dialogue['response']['content'] = self._content
+        self._content = ''
 
     ## @copydoc Service#on_end
     def on_end(self, dialogue):
-        self.resource.close()
+        if self._file is not None:
+            self._file.close()
+
+
+## File service sending application icon.
+#
+class Favicon(FileService):
+
+    ## Service name, request URI.
+    NAME = '/favicon.ico'
+
+    ## File to send.
+    FILE = 'chat.ico'
+
+    ## Content type of file to send.
+    CONTENT_TYPE = 'image/jpeg'
 
 
 ## File service sending chat room html
 #
-class Chat(Service):
+# Also accepts WebSocket upgrades, the connection is then handed over to a
+# WebSocket handler bound to the requested room.
+#
+class Chat(FileService):
 
     ## Service name, request URI.
     NAME = '/chat'
 
+    ## File to send.
+    FILE = 'chat.html'
+
+    ## Content type of file to send.
+    CONTENT_TYPE = 'text/html'
+
+    ## @copydoc Service#on_headers
+    def on_headers(self, dialogue):
+        dialogue['request']['headers']['Upgrade'] = ''
+        dialogue['request']['headers']['Sec-WebSocket-Key'] = ''
+        dialogue['request']['headers']['Sec-WebSocket-Version'] = ''
+
+    ## @copydoc Service#response_first_line
+    def response_first_line(self, dialogue):
+        room = dialogue['request']['parsed'].params['room'][0]
+        username = util.get_user(dialogue)
+        dialogue['request']['context']['store'].touch(room, username)
+        self.logger.debug(
+            "USERS %s", dialogue['request']['context']['rooms'][room]['users'])
+        if dialogue['request']['headers']['Upgrade'].lower() != 'websocket':
+            self._respond_file(dialogue)
+        elif dialogue['request']['headers'][
+            'Sec-WebSocket-Version'
+        ] != websocket.VERSION:
+            dialogue['response']['code'] = '426'
+            dialogue['response']['message'] = 'Upgrade Required'
+        else:
+            dialogue['response']['code'] = '101'
+            dialogue['response']['message'] = 'Switching Protocols'
+            dialogue['upgrade'] = {
+                'room': room,
+                'username': username,
+            }
+
+    ## @copydoc Service#response_headers
+    def response_headers(self, dialogue):
+        if 'upgrade' in dialogue:
+            dialogue['response']['headers']['Upgrade'] = 'websocket'
+            dialogue['response']['headers']['Connection'] = 'Upgrade'
+            dialogue['response']['headers'][
+                'Sec-WebSocket-Accept'] = websocket.accept_key(
+                    dialogue['request']['headers']['Sec-WebSocket-Key'])
+        elif self.resource is None:
+            dialogue['response']['headers'][
+                'Sec-WebSocket-Version'] = websocket.VERSION
+            dialogue['response']['headers']['Content-Length'] = 0
+
+
+## Request body of chat messages service.
+#
+# Parsed once per request and shared between service callbacks. Body is
+# either XML or, when sent as such, JSON.
+#
+class MessagesRequest(base.Base):
+
+    ## Constructor.
+    # @param content (str) request body
+    # @param content_type (str) request body media type
+    #
+    def __init__(self, content, content_type=formats.XML):
+        super(MessagesRequest, self).__init__()
+        if content_type.split(';')[0].strip() == formats.JSON:
+            body = json.loads(content)
+            self._room = body['room']
+            self._fetch = int(body['fetch'])
+            self._messages = body['messages']
+        else:
+            root = et.fromstring(content)
+            self._room = root.find('room').attrib['name']
+            self._fetch = int(root.find('fetch').attrib['id'])
+            self._messages = [
+                message.attrib['text']
+                for message in root.find('messages').findall('message')
+            ]
+
+    ## Retrieve room name.
+    @property
+    def room(self):
+        return self._room
+
+    ## Retrieve revision client already has.
+    @property
+    def fetch(self):
+        return self._fetch
+
+    ## Retrieve texts of messages to post.
+    @property
+    def messages(self):
+        return self._messages
+
+
+## Service handling chat messages.
+#
+# When requested with a wait parameter the response is held until the room
+# has messages past the client revision or the wait period elapses.
+#
+class GetMessages(Service):
+
+    ## Service name, request URI.
+    NAME = '/get-messages'
+
     ## Constructor.
     def __init__(
         self,
     ):
-        super(Chat, self).__init__()
-        self._resource = None
+        super(GetMessages, self).__init__()
         self._content = ''
+        self._request = None
+        self._deadline = None
+        self._timer = None
+        self._stored = True
+        self._waiter = None
+        self._resume = None
 
-    ## Retrieve fd of file to send.
+    ## Retrieve response content to send.
     @property
-    def resource(self):
-        return self._resource
+    def content(self):
+        return self._content
 
-    ## Set fd of file to send.
-    @resource.setter
-    def resource(self, val):
-        self._resource = val
+    ## Set response content to send.
+    @content.setter
+    def content(self, val):
+        self._content = val
+
+    ## @copydoc Service#response_first_line
+    def response_first_line(self, dialogue):
+        self._resume = dialogue['resume']
+        dialogue['response']['code'] = '200'
+        dialogue['response']['message'] = 'OK'
+        self._request = MessagesRequest(
+            dialogue['request']['content'],
+            dialogue['request']['headers'].get('Content-Type', formats.XML),
+        )
+        wait = None
+        if 'wait' in dialogue['request']['parsed'].params:
+            wait = util.parse_period(
+                dialogue['request']['parsed'].params['wait'][0],
+                constants.LONG_POLL_TIMEOUT,
+            )
+        username = util.get_user(dialogue)
+        store = dialogue['request']['context']['store']
+        if len(self._request.messages) > 0:
+            self._stored = False
+            store.post(
+                self._request.room,
+                username,
+                self._request.messages,
+                self._on_stored,
+            )
+        else:
+            store.touch(self._request.room, username)
+        if wait is not None:
+            self._deadline = time.time() + wait
+            self._timer = dialogue['call_later'](wait, dialogue['resume'])
+
+    ## Called once posted messages are in room history.
+    def _on_stored(self):
+        self._stored = True
+        self._resume()
+
+    ## @copydoc Service#response_ready
+    def response_ready(self, dialogue):
+        if not self._stored:
+            return False
+        if self._deadline is None or time.time() >= self._deadline:
+            return True
+        room = dialogue['request']['context']['rooms'][self._request.room]
+        if room['history'].newer(self._request.fetch):
+            return True
+        if self._waiter is None:
+            self._waiter = util.add_waiter(room, self._wake)
+        return False
+
+    ## Waiter called when room has new messages.
+    def _wake(self):
+        self._waiter = None
+        self._resume()
+
+    ## @copydoc Service#response_headers
+    def response_headers(self, dialogue):
+        room = dialogue['request']['context']['rooms'][self._request.room]
+        media_type = formats.choose(dialogue)
+        snapshot = room['snapshots'].get(
+            room,
+            self._request.fetch,
+            media_type,
+            lambda: formats.MESSAGES[media_type](
+                room['history'].since(self._request.fetch),
+                room['history'].revision,
+                room['users'].keys(),
+            ),
+        )
+        self.content = util.compress_response(
+            snapshot['identity'],
+            dialogue,
+            snapshot,
+        )
+        dialogue['response']['headers']['Content-Length'] = len(self.content)
+        dialogue['response']['headers']['Content-Type'] = media_type
+
+    ## @copydoc Service#response_content
+    def response_content(self, dialogue):
+        dialogue['response']['content'] = self.content
+        self.content = ''
+
+    ## @copydoc Service#on_end
+    def on_end(self, dialogue):
+        self._release()
+
+    ## @copydoc Service#on_close
+    def on_close(self, dialogue):
+        self._release()
+
+    ## Cancel timer and stop waiting for room.
+    def _release(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        util.cancel_waiter(self._waiter)
+        self._waiter = None
+
+
+## Service streaming chat messages as server-sent events.
+#
+# Keeps a chunked text/event-stream response open and pushes every new batch
+# of room messages, along with the room users, as it arrives. Every message
+# and user name is a JSON string on a data line of its own, so line breaks
+# within them cannot end the line and inject event fields.
+#
+class Stream(Service):
+
+    ## Service name, request URI.
+    NAME = '/stream'
+
+    ## Constructor.
+    def __init__(
+        self,
+    ):
+        super(Stream, self).__init__()
+        self._room = None
+        self._username = None
+        self._revision = 0
+        self._heartbeat = 0
+        self._timer = None
+        self._waiter = None
+        self._resume = None
 
     ## @copydoc Service#on_headers
     def on_headers(self, dialogue):
-        dialogue['request']['headers']['Cookie'] = ''
+        dialogue['request']['headers']['Last-Event-ID'] = ''
 
     ## @copydoc Service#response_first_line
     def response_first_line(self, dialogue):
         dialogue['response']['code'] = '200'
         dialogue['response']['message'] = 'OK'
-        self.resource = open('chat.html', 'rb')
-        c = Cookie.SimpleCookie()
-        c.load(str(dialogue['request']['headers']['Cookie']))
-        room = dialogue['request']['params']['room'][0]
-        username = dialogue['request']['context']['users'][c['uid'].value]
-        dialogue['request']['context']['rooms'][room]['users'][username] = time.time()
-        self.logger.debug(
-            "USERS %s", dialogue['request']['context']['rooms'][room]['users'])
+        self._room = dialogue['request']['parsed'].params['room'][0]
+        self._username = util.get_user(dialogue)
+        if dialogue['request']['headers']['Last-Event-ID']:
+            self._revision = int(
+                dialogue['request']['headers']['Last-Event-ID'])
 
     ## @copydoc Service#response_headers
     def response_headers(self, dialogue):
-        dialogue['response']['headers']['Content-Length'] = os.fstat(
-            self.resource.fileno()).st_size
-        dialogue['response']['headers']['Content-Type'] = 'text/html'
+        dialogue['response']['headers']['Content-Type'] = 'text/event-stream'
+        dialogue['response']['headers']['Cache-Control'] = 'no-cache'
+        dialogue['response']['headers']['Transfer-Encoding'] = 'chunked'
+
+    ## @copydoc Service#content_ready
+    def content_ready(self, dialogue):
+        room = dialogue['request']['context']['rooms'][self._room]
+        if (
+            time.time() >= self._heartbeat or
+            room['history'].newer(self._revision)
+        ):
+            return True
+        if self._waiter is None:
+            self._resume = dialogue['resume']
+            self._waiter = util.add_waiter(room, self._wake)
+        return False
+
+    ## Waiter called when room has new messages.
+    def _wake(self):
+        self._waiter = None
+        self._resume()
 
     ## @copydoc Service#response_content
     def response_content(self, dialogue):
-        dialogue['response']['content'] = self.resource.read(
-            constants.BLOCK_SIZE)
+        room = dialogue['request']['context']['rooms'][self._room]
+        dialogue['request']['context']['store'].touch(
+            self._room, self._username)
+        self._heartbeat = time.time() + constants.STREAM_HEARTBEAT
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = dialogue['call_later'](
+            constants.STREAM_HEARTBEAT,
+            dialogue['resume'],
+        )
+        events = []
+        messages = room['history'].since(self._revision)
+        if messages:
+            self._revision = room['history'].revision
+            events.append(
+                'id: %s\nevent: messages\n%s\n' % (
+                    self._revision,
+                    ''.join('data: %s\n' % json.dumps(m) for m in messages),
+                )
+            )
+        events.append(
+            'event: users\n%s\n' % (
+                ''.join(
+                    'data: %s\n' % json.dumps(name) for name in room['users']
+                ),
+            )
+        )
+        dialogue['response']['content'] = ''.join(events).encode('utf-8')
 
     ## @copydoc Service#on_end
     def on_end(self, dialogue):
-        self.resource.close()
+        self._release()
 
+    ## @copydoc Service#on_close
+    def on_close(self, dialogue):
+        self._release()
 
-## Service handling chat messages.
+    ## Cancel heartbeat and stop waiting for room.
+    def _release(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        util.cancel_waiter(self._waiter)
+        self._waiter = None
+
+
+## Service handling pages of older chat messages.
 #
-class GetMessages(Service):
+# Pages end right before the sequence number given by the before parameter,
+# the latest messages when missing, and hold at most limit messages. Messages
+# still in room history are served from it, older ones are read from the
+# message log, whose index maps sequence number to offset directly. Messages
+# the log is yet to hold are left out of the page rather than leaving a gap.
+#
+class History(Service):
 
     ## Service name, request URI.
-    NAME = '/get-messages'
+    NAME = '/history'
 
     ## Constructor.
     def __init__(
         self,
     ):
-        super(GetMessages, self).__init__()
+        super(History, self).__init__()
         self._content = ''
 
     ## Retrieve response content to send.
@@ -195,56 +780,40 @@ class GetMessages(Service):
     def content(self, val):
         self._content = val
 
-    ## @copydoc Service#on_headers
-    def on_headers(self, dialogue):
-        dialogue['request']['headers']['Cookie'] = ''
-
     ## @copydoc Service#response_first_line
     def response_first_line(self, dialogue):
         dialogue['response']['code'] = '200'
         dialogue['response']['message'] = 'OK'
-        c = Cookie.SimpleCookie()
-        c.load(str(dialogue['request']['headers']['Cookie']))
-        root = et.fromstring(dialogue['request']['content'])
-        messages = root.findall('messages')
-        room = root.findall('room')[0].attrib['name']
-        appendee = []
-        for message in messages[0].findall('message'):
-            appendee.append('%s: %s' % (
-                dialogue['request']['context']['users'][c['uid'].value], message.attrib['text']))
-        if len(appendee) > 0:
-            dialogue['request']['context']['rooms'][room]['messages'].append(
-                appendee)
-        dialogue['request']['context']['rooms'][room]['users'][dialogue['request']
-                                                               ['context']['users'][c['uid'].value]] = time.time()
-        if len(dialogue['request']['context']['rooms'][room]['messages']) > constants.TOO_BIG:
-            dialogue['request']['context']['rooms'][room]['messages'] = dialogue['request']['context']['rooms'][room]['messages'][2:]
-            dialogue['request']['context']['rooms'][room]['base_index'] = 2
 
     ## @copydoc Service#response_headers
     def response_headers(self, dialogue):
-        c = Cookie.SimpleCookie()
-        c.load(str(dialogue['request']['headers']['Cookie']))
-        root = et.fromstring(dialogue['request']['content'])
-        room = root.findall('room')[0].attrib['name']
-        messages = util.get_revision(dialogue['request']['context']['rooms'][room], int(
-            root.findall('fetch')[0].attrib['id']))
-        root = et.Element('root')
-        messages_node = et.SubElement(root, 'messages')
-        for entry in messages:
-            et.SubElement(messages_node, 'message').attrib['text'] = entry
-        if messages:
-            et.SubElement(root, 'id').attrib['revision'] = '%s' % (
-                len(dialogue['request']['context']['rooms'][room]['messages']))
-        users_node = et.SubElement(root, 'users')
-        util.clear_outdated_users(
-            dialogue['request']['context']['rooms'][room]['users'])
-        for name in dialogue['request']['context']['rooms'][room]['users'].keys():
-            et.SubElement(users_node, 'user').attrib['name'] = name
-        self.logger.debug('HERE BE THE MESSAGES: %s', et.tostring(root))
-        self.content = et.tostring(root)
+        params = dialogue['request']['parsed'].params
+        name = params['room'][0]
+        room_history = dialogue['request']['context']['rooms'][name]['history']
+        limit = min(
+            int(params.get('limit', [constants.HISTORY_PAGE_SIZE])[0]),
+            constants.HISTORY_PAGE_MAX,
+        )
+        last = min(
+            int(params.get('before', [room_history.revision + 1])[0]) - 1,
+            room_history.revision,
+        )
+        first = max(last - limit + 1, 1)
+        messages = []
+        log = dialogue['request']['context']['log']
+        if log is not None and first < room_history.first:
+            older = min(last, room_history.first - 1)
+            messages = log.read(name, first, older)
+            if len(messages) != older - first + 1:
+                messages = []
+        messages += room_history.between(first, last)
+        media_type = formats.choose(dialogue)
+        self.content = util.compress_response(
+            formats.HISTORY[media_type](messages, last - len(messages) + 1),
+            dialogue,
+        )
         dialogue['response']['headers']['Content-Length'] = len(self.content)
-        dialogue['response']['headers']['Content-Type'] = 'text/xml'
+        dialogue['response']['headers']['Content-Type'] = media_type
 
     ## @copydoc Service#response_content
     def response_content(self, dialogue):
@@ -254,27 +823,16 @@ class GetMessages(Service):
 
 ## File service sending home page.
 #
-class Home(Service):
+class Home(FileService):
 
     ## Request URI.
     NAME = '/'
 
-    ## Constructor.
-    def __init__(
-        self,
-    ):
-        super(Home, self).__init__()
-        self._resource = None
-
-    ## Retrieve fd of file to send.
-    @property
-    def resource(self):
-        return self._resource
+    ## File to send.
+    FILE = 'home.html'
 
-    ## Set fd of file to send.
-    @resource.setter
-    def resource(self, val):
-        self._resource = val
+    ## Content type of file to send.
+    CONTENT_TYPE = 'text/html'
 
     ## @copydoc Service#on_headers
     def on_headers(self, dialogue):
@@ -285,28 +843,14 @@ class Home(Service):
         dialogue['response']['code'] = '200'
         dialogue['response']['message'] = 'OK'
         if not dialogue['request']['headers']['Cookie']:
-            self.resource = open('home.html', 'rb')
+            self._respond_file(dialogue)
 
     ## @copydoc Service#response_headers
     def response_headers(self, dialogue):
-        if not dialogue['request']['headers']['Cookie']:
-            dialogue['response']['headers']['Content-Length'] = os.fstat(
-                self.resource.fileno()).st_size
-            dialogue['response']['headers']['Content-Type'] = 'text/html'
-        else:
+        if dialogue['request']['headers']['Cookie']:
+            dialogue['response']['headers']['Content-Length'] = 0
             dialogue['response']['headers']['Refresh'] = '0; url=/rooms'
 
-    ## @copydoc Service#response_content
-    def response_content(self, dialogue):
-        if not dialogue['request']['headers']['Cookie']:
-            dialogue['response']['content'] = self.resource.read(
-                constants.BLOCK_SIZE)
-
-    ## @copydoc Service#on_end
-    def on_end(self, dialogue):
-        if not dialogue['request']['headers']['Cookie']:
-            self.resource.close()
-
 
 ## Service handling registration process.
 #
@@ -320,114 +864,166 @@ class Register(Service):
         self,
     ):
         super(Register, self).__init__()
+        self._uid = None
+        self._stored = False
+        self._resume = None
 
     ## @copydoc Service#response_first_line
     def response_first_line(self, dialogue):
         self.logger.debug("NEW USER CONNECTED: %s",
-                          dialogue['request']['params']['name'][0])
+                          dialogue['request']['parsed'].params['name'][0])
         dialogue['response']['code'] = '200'
         dialogue['response']['message'] = 'OK'
+        self._resume = dialogue['resume']
+        self._uid = util.generate_unique(
+            dialogue['request']['context']['users'].keys())
+        dialogue['request']['context']['store'].add_user(
+            self._uid,
+            dialogue['request']['parsed'].params['name'][0],
+            self._on_stored,
+        )
+
+    ## Called once user is registered.
+    def _on_stored(self):
+        self._stored = True
+        self._resume()
+
+    ## @copydoc Service#response_ready
+    def response_ready(self, dialogue):
+        return self._stored
 
     ## @copydoc Service#response_headers
     def response_headers(self, dialogue):
+        name = dialogue['request']['parsed'].params['name'][0]
         c = Cookie.SimpleCookie()
-        c['uid'] = util.generate_unique(
-            dialogue['request']['context']['users'].keys())
-        dialogue['request']['context']['users'][c['uid']
-                                                .value] = dialogue['request']['params']['name'][0]
+        c['uid'] = self._uid
         self.logger.info(
             "%s has connected",
-            dialogue['request']['params']['name'][0],
+            name,
         )
         dialogue['response']['headers']['Set-Cookie'] = '%s=%s' % (
             c['uid'].key, c['uid'].value)
+        dialogue['response']['headers']['Content-Length'] = 0
         dialogue['response']['headers']['Refresh'] = '0; url=/rooms'
 
 
 ## File service sending list of chat rooms html.
 #
-class Rooms(Service):
+class Rooms(FileService):
 
     ## Service name, request URI.
     NAME = '/rooms'
 
+    ## File to send.
+    FILE = 'rooms.html'
+
+    ## Content type of file to send.
+    CONTENT_TYPE = 'text/html'
+
+
+## Service handling addition of new rooms.
+#
+class AddRoom(Service):
+
+    ## Service name, request URI.
+    NAME = '/add-room'
+
     ## Constructor.
     def __init__(
         self,
     ):
-        super(Rooms, self).__init__()
-        self._resource = None
-
-    ## Retrieve fd of file to send.
-    @property
-    def resource(self):
-        return self._resource
-
-    ## Set fd of file to send.
-    @resource.setter
-    def resource(self, val):
-        self._resource = val
+        super(AddRoom, self).__init__()
+        self._stored = False
+        self._resume = None
 
     ## @copydoc Service#response_first_line
     def response_first_line(self, dialogue):
         dialogue['response']['code'] = '200'
         dialogue['response']['message'] = 'OK'
-        self.resource = open('rooms.html', 'rb')
+        self._resume = dialogue['resume']
+        root = et.fromstring(dialogue['request']['content'])
+        dialogue['request']['context']['store'].add_room(
+            root[0].attrib['name'],
+            self._on_stored,
+        )
 
-    ## @copydoc Service#response_headers
-    def response_headers(self, dialogue):
-        dialogue['response']['headers']['Content-Length'] = os.fstat(
-            self.resource.fileno()).st_size
-        dialogue['response']['headers']['Content-Type'] = 'text/html'
+    ## Called once room is created.
+    def _on_stored(self):
+        self._stored = True
+        self._resume()
 
-    ## @copydoc Service#response_content
-    def response_content(self, dialogue):
-        dialogue['response']['content'] = self.resource.read(
-            constants.BLOCK_SIZE)
+    ## @copydoc Service#response_ready
+    def response_ready(self, dialogue):
+        return self._stored
 
-    ## @copydoc Service#on_end
-    def on_end(self, dialogue):
-        self.resource.close()
+    ## @copydoc Service#response_headers
+    def response_headers(self, dialogue):
+        dialogue['response']['headers']['Content-Length'] = 0
 
 
-## Service handling addition of new rooms.
+## Service handling request to get current rooms.
 #
-class AddRoom(Service):
+class GetRooms(Service):
 
     ## Service name, request URI.
-    NAME = '/add-room'
+    NAME = '/get-rooms'
 
     ## Constructor.
     def __init__(
         self,
     ):
-        super(AddRoom, self).__init__()
+        super(GetRooms, self).__init__()
+        self._content = ''
+
+    ## Retrieve response content to send.
+    @property
+    def content(self):
+        return self._content
+
+    ## Set response content to send.
+    @content.setter
+    def content(self, val):
+        self._content = val
 
     ## @copydoc Service#response_first_line
     def response_first_line(self, dialogue):
         dialogue['response']['code'] = '200'
         dialogue['response']['message'] = 'OK'
-        root = et.fromstring(dialogue['request']['content'])
-        dialogue['request']['context']['rooms'][root[0].attrib['name']] = {
-            'users': {}, 'messages': [], 'base_index': 0}
-        self.logger.info(
-            "Created new room: %s",
-            root[0].attrib['name'],
+
+    ## @copydoc Service#response_headers
+    def response_headers(self, dialogue):
+        media_type = formats.choose(dialogue)
+        self.content = util.compress_response(
+            formats.ROOMS[media_type](
+                dialogue['request']['context']['rooms'].keys(),
+            ),
+            dialogue,
         )
+        dialogue['response']['headers']['Content-Length'] = len(self.content)
+        dialogue['response']['headers']['Content-Type'] = media_type
 
+    ## @copydoc Service#response_content
+    def response_content(self, dialogue):
+        dialogue['response']['content'] = self.content
+        self.content = ''
 
-## Service handling request to get current rooms.
+
+## Service handling request for server metrics.
 #
-class GetRooms(Service):
+# Metrics are sent as JSON, or as Prometheus text to clients preferring
+# text/plain, as Prometheus does. With several worker processes every worker
+# reports metrics of its own.
+#
+class Stats(Service):
 
     ## Service name, request URI.
-    NAME = '/get-rooms'
+    NAME = '/stats'
 
     ## Constructor.
     def __init__(
         self,
     ):
-        super(GetRooms, self).__init__()
+        super(Stats, self).__init__()
         self._content = ''
 
     ## Retrieve response content to send.
@@ -447,14 +1043,43 @@ class GetRooms(Service):
 
     ## @copydoc Service#response_headers
     def response_headers(self, dialogue):
-        root = et.Element('root')
-        for room in dialogue['request']['context']['rooms'].keys():
-            et.SubElement(root, 'room').attrib['name'] = room
-        self.content = et.tostring(root)
+        registry = dialogue['request']['context']['metrics']
+        util.add_vary(dialogue, 'Accept')
+        media_type = util.choose_type(
+            dialogue['request']['headers'].get('Accept', ''),
+            (formats.JSON, metrics.PROMETHEUS),
+        )
+        if media_type == metrics.PROMETHEUS:
+            content = registry.prometheus()
+            media_type = '%s; version=%s' % (
+                metrics.PROMETHEUS,
+                metrics.PROMETHEUS_VERSION,
+            )
+        else:
+            content = registry.json()
+        self.content = util.compress_response(content, dialogue)
         dialogue['response']['headers']['Content-Length'] = len(self.content)
-        dialogue['response']['headers']['Content-Type'] = 'text/xml'
+        dialogue['response']['headers']['Content-Type'] = media_type
+        dialogue['response']['headers']['Cache-Control'] = 'no-cache'
 
     ## @copydoc Service#response_content
     def response_content(self, dialogue):
         dialogue['response']['content'] = self.content
         self.content = ''
+
+
+## Get every service.
+# @returns (list) subclasses of @ref Service at any depth that serve a URI
+#
+# Base classes such as @ref FileService do not set NAME of their own and are
+# left out.
+#
+def service_classes():
+    result = []
+    pending = [Service]
+    while pending:
+        for service in pending.pop().__subclasses__():
+            if 'NAME' in vars(service):
+                result.append(service)
+            pending.append(service)
+    return result
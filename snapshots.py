@@ -0,0 +1,68 @@
+## @package HTTP--Chat.snapshots Response snapshot module.
+## @file snapshots.py Implementation of @ref HTTP--Chat.snapshots
+#
+
+import base
+import collections
+import constants
+
+
+## Cache of serialized message responses of a single room.
+#
+# Clients of a room mostly poll from the same revision, so a response
+# serialized for one of them is reused by the rest. Entries are keyed by
+# revision client has and response format, all of them are dropped once room
+# history or user list changes. Revisions that get the same messages share an
+# entry, and at most size entries are kept, oldest dropped first, so clients
+# sending arbitrary revisions cannot grow the cache. Every entry holds the
+# identity content and content codings of it compressed so far.
+#
+class SnapshotCache(base.Base):
+
+    ## Constructor.
+    # @param size (int) maximum amount of entries kept
+    #
+    def __init__(self, size=constants.SNAPSHOT_CACHE_SIZE):
+        super(SnapshotCache, self).__init__()
+        self._size = size
+        self._entries = collections.OrderedDict()
+        self._version = None
+        self._hits = 0
+        self._misses = 0
+
+    ## Retrieve amount of lookups served from cache.
+    @property
+    def hits(self):
+        return self._hits
+
+    ## Retrieve amount of lookups that had to serialize.
+    @property
+    def misses(self):
+        return self._misses
+
+    ## Get serialized response, building it if not cached.
+    # @param room (dict) chat room
+    # @param revision (int) revision client has
+    # @param media_type (str) response media type
+    # @param build (callable) serializes response when called
+    # @returns (dict) entry, maps 'identity' and content codings to content
+    #
+    def get(self, room, revision, media_type, build):
+        history = room['history']
+        version = (history.revision, room['users_version'])
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+        # same messages as @ref history.RoomHistory.since returns
+        if revision > history.revision:
+            revision = 0
+        key = (max(revision, history.first - 1), media_type)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._hits += 1
+            return entry
+        self._misses += 1
+        if len(self._entries) >= self._size:
+            self._entries.popitem(last=False)
+        entry = self._entries[key] = {'identity': build()}
+        return entry
@@ -0,0 +1,312 @@
+## @package HTTP--Chat.store Chat state store module.
+## @file store.py Implementation of @ref HTTP--Chat.store
+#
+# Users, rooms and presence are changed only through a store. Reading them
+# goes straight to the dicts the store keeps, those never get replaced.
+# Rooms and their messages may be kept in a @ref messagelog.MessageLog, users
+# and presence are not kept.
+#
+
+import base
+import collections
+import constants
+import formats
+import history
+import json
+import os
+import pollable
+import presence
+import snapshots
+import time
+import util
+
+
+## Store of a single process.
+#
+# Operations are applied as soon as they are requested, and recorded in
+# message log if there is one.
+#
+class LocalStore(base.Base):
+
+    ## Constructor.
+    # @param rooms (dict) revision and last messages by room name, as
+    # restored from message log
+    # @param log (MessageLog) message log to record operations in
+    #
+    def __init__(self, rooms=None, log=None):
+        super(LocalStore, self).__init__()
+        self._users = {}
+        self._rooms = {}
+        self._log = log
+        for name, (revision, messages) in (rooms or {}).items():
+            self._rooms[name] = self._new_room(
+                history.RoomHistory(messages=messages, revision=revision)
+            )
+        self._presence = presence.Presence()
+        self._operations = {
+            'user': self._add_user,
+            'room': self._add_room,
+            'post': self._post,
+            'touch': self._touch,
+        }
+
+    ## Retrieve users, maps user id to user name.
+    @property
+    def users(self):
+        return self._users
+
+    ## Retrieve chat rooms by name.
+    @property
+    def rooms(self):
+        return self._rooms
+
+    ## Retrieve presence of users in rooms.
+    @property
+    def presence(self):
+        return self._presence
+
+    ## Expose amount of rooms, users and messages held as metrics.
+    # @param registry (Registry) metrics registry
+    #
+    def add_metrics(self, registry):
+        registry.gauge(
+            'chat_rooms',
+            'Chat rooms.',
+            lambda: len(self._rooms),
+        )
+        registry.gauge(
+            'chat_users',
+            'Registered users.',
+            lambda: len(self._users),
+        )
+        registry.gauge(
+            'chat_messages',
+            'Messages held in room histories.',
+            lambda: sum(len(room['history']) for room in self._rooms.values()),
+        )
+        registry.counter(
+            'chat_snapshot_hits_total',
+            'Message responses served from room snapshot caches.',
+            func=lambda: sum(
+                room['snapshots'].hits for room in self._rooms.values()
+            ),
+        )
+        registry.counter(
+            'chat_snapshot_misses_total',
+            'Message responses serialized for room snapshot caches.',
+            func=lambda: sum(
+                room['snapshots'].misses for room in self._rooms.values()
+            ),
+        )
+
+    ## Register user.
+    # @param uid (str) user id
+    # @param name (str) user name
+    # @param done (callable) called once applied
+    #
+    def add_user(self, uid, name, done=None):
+        self.request(['user', uid, name], done)
+
+    ## Create chat room, unless a room of same name exists.
+    # @param name (str) room name
+    # @param done (callable) called once applied
+    #
+    def add_room(self, name, done=None):
+        self.request(['room', name], done)
+
+    ## Post messages to room.
+    # @param room (str) room name
+    # @param username (str) user name
+    # @param texts (list) message texts
+    # @param done (callable) called once applied
+    #
+    def post(self, room, username, texts, done=None):
+        self.request(
+            [
+                'post',
+                room,
+                username,
+                ['%s: %s' % (username, text) for text in texts],
+            ],
+            done,
+        )
+
+    ## Mark user as active in room.
+    # @param room (str) room name
+    # @param username (str) user name
+    #
+    def touch(self, room, username):
+        self.request(['touch', room, username])
+
+    ## Request operation.
+    # @param operation (list) operation name followed by its arguments
+    # @param done (callable) called once applied
+    #
+    def request(self, operation, done=None):
+        if self._log is not None:
+            self._log.record(operation)
+        self.apply(operation)
+        if done is not None:
+            done()
+
+    ## Apply operation to state.
+    # @param operation (list) operation name followed by its arguments
+    #
+    def apply(self, operation):
+        self._operations[operation[0]](*operation[1:])
+
+    ## Apply user registration.
+    def _add_user(self, uid, name):
+        self._users[uid] = name
+
+    ## Build chat room.
+    # @param room_history (RoomHistory) room history
+    # @returns (dict) chat room
+    #
+    def _new_room(self, room_history):
+        return {
+            'users': {},
+            'users_version': 0,
+            'history': room_history,
+            'snapshots': snapshots.SnapshotCache(),
+            'waiters': {},
+        }
+
+    ## Apply room creation.
+    #
+    # Existing room is kept along with its history, which is logged.
+    #
+    def _add_room(self, name):
+        if name in self._rooms:
+            return
+        self._rooms[name] = self._new_room(history.RoomHistory())
+        self.logger.info('Created new room: %s', name)
+
+    ## Apply messages posted, waking everyone waiting on room.
+    def _post(self, room, username, messages):
+        room = self._rooms.get(room)
+        if room is None:
+            return
+        room['history'].append(messages)
+        self._presence.touch(room, username)
+        util.wake_waiters(room)
+
+    ## Apply presence of user in room.
+    def _touch(self, room, username):
+        room = self._rooms.get(room)
+        if room is not None:
+            self._presence.touch(room, username)
+
+
+## Store replica of a worker process.
+#
+# Operations are sent to the parent process, which relays them to every
+# worker in a single order, including the one requesting them. Each worker
+# applies them once relayed, so all replicas go through the same states.
+# A change shows only a moment later, services requesting one respond once
+# it is applied by their own worker. Presence of a user already present is
+# relayed at most once every @ref constants.TOUCH_PERIOD seconds.
+#
+# Operations are sent prefixed by id of the requesting process, so it can
+# tell its own operations apart and call their callbacks, in order.
+#
+class ReplicatedStore(LocalStore):
+
+    ## Constructor.
+    # @param socket (object) socket connected to parent process
+    # @param poller (object) related poller
+    # @param rooms (dict) revision and last messages by room name, as
+    # restored from message log
+    #
+    # Operations are recorded by parent process, see @ref StoreHub.
+    #
+    def __init__(self, socket, poller, rooms=None):
+        super(ReplicatedStore, self).__init__(rooms)
+        self._poller = poller
+        self._origin = os.getpid()
+        self._pending = collections.deque()
+        self._link = pollable.StoreLink(
+            socket,
+            poller,
+            self._receive,
+            self._closed,
+        )
+        poller.register(self._link)
+
+    ## @copydoc LocalStore#touch
+    def touch(self, room, username):
+        seen = self._rooms.get(room, {'users': {}})['users'].get(username)
+        if seen is None or time.time() - seen >= constants.TOUCH_PERIOD:
+            super(ReplicatedStore, self).touch(room, username)
+
+    ## @copydoc LocalStore#request
+    def request(self, operation, done=None):
+        self._pending.append(done)
+        self._link.send(
+            formats.ENCODER.encode([self._origin] + operation) +
+            pollable.StoreLink.NEWLINE
+        )
+
+    ## Apply operations relayed by parent process.
+    # @param link (StoreLink) link to parent process
+    # @param data (str) lines of encoded operations
+    #
+    def _receive(self, link, data):
+        for line in data.splitlines():
+            operation = json.loads(line)
+            self.apply(operation[1:])
+            if operation[0] == self._origin:
+                done = self._pending.popleft()
+                if done is not None:
+                    done()
+
+    ## Stop worker once parent process is gone.
+    # @param link (StoreLink) link to parent process
+    #
+    def _closed(self, link):
+        self._poller.close_server()
+
+
+## Relay of operations between worker processes.
+#
+# Runs in the parent process. Whole lines received from any worker are sent
+# to all of them as is, and recorded in message log if there is one.
+#
+class StoreHub(base.Base):
+
+    ## Constructor.
+    # @param sockets (list) sockets connected to workers
+    # @param poller (object) related poller
+    # @param log (MessageLog) message log to record operations in
+    #
+    def __init__(self, sockets, poller, log=None):
+        super(StoreHub, self).__init__()
+        self._log = log
+        self._links = []
+        for s in sockets:
+            link = pollable.StoreLink(
+                s,
+                poller,
+                self._receive,
+                self._closed,
+            )
+            self._links.append(link)
+            poller.register(link)
+
+    ## Relay operations to every worker.
+    # @param link (StoreLink) link operations came from
+    # @param data (str) lines of encoded operations
+    #
+    def _receive(self, link, data):
+        if self._log is not None:
+            for line in data.splitlines():
+                self._log.record(json.loads(line)[1:])
+        for other in self._links:
+            other.send(data)
+
+    ## Forget worker that exited.
+    # @param link (StoreLink) link to worker
+    #
+    def _closed(self, link):
+        self.logger.info('closed link %s to worker', link.getfd())
+        self._links.remove(link)
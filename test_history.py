@@ -0,0 +1,101 @@
+## @package HTTP--Chat.test_history Room history tests.
+## @file test_history.py Tests of @ref HTTP--Chat.history
+#
+# Messages are their own sequence numbers, so every test checks exactly
+# which messages a client got.
+#
+
+import history
+import random
+import unittest
+
+
+## Tests of @ref history.RoomHistory.
+#
+class RoomHistoryTest(unittest.TestCase):
+
+    ## Clients fetching since their revision get every message once.
+    def test_since_follows_appends(self):
+        rand = random.Random(0)
+        room = history.RoomHistory(size=5)
+        fetch = 0
+        received = []
+        for i in range(1000):
+            batch = range(
+                room.revision + 1,
+                room.revision + 1 + rand.randint(0, 3),
+            )
+            self.assertEqual(room.append(batch), room.revision)
+            if rand.random() < 0.5:
+                expected = range(max(fetch + 1, room.first), room.revision + 1)
+                self.assertEqual(room.newer(fetch), bool(expected))
+                messages = room.since(fetch)
+                self.assertEqual(messages, expected)
+                received.extend(messages)
+                fetch = room.revision
+        self.assertEqual(received, sorted(set(received)))
+
+    ## Client behind oldest message kept gets all messages kept.
+    def test_trim_past_fetch(self):
+        room = history.RoomHistory(size=3)
+        room.append(range(1, 11))
+        self.assertEqual(len(room), 3)
+        self.assertEqual(room.first, 8)
+        self.assertEqual(room.since(2), [8, 9, 10])
+        self.assertEqual(room.since(7), [8, 9, 10])
+        self.assertEqual(room.since(8), [9, 10])
+        self.assertTrue(room.newer(2))
+
+    ## Restored history continues from its revision.
+    def test_restored(self):
+        room = history.RoomHistory(size=5, messages=[6, 7, 8], revision=8)
+        self.assertEqual(room.first, 6)
+        self.assertEqual(room.since(0), [6, 7, 8])
+        self.assertEqual(room.since(7), [8])
+        self.assertFalse(room.newer(8))
+        self.assertTrue(room.newer(7))
+        self.assertEqual(room.append([9, 10, 11]), 11)
+        self.assertEqual(room.first, 7)
+        self.assertEqual(room.since(8), [9, 10, 11])
+
+    ## Client ahead of history, since before a restart, gets all kept.
+    def test_fetch_ahead(self):
+        room = history.RoomHistory(size=5, messages=[1, 2, 3], revision=3)
+        self.assertTrue(room.newer(10))
+        self.assertEqual(room.since(10), [1, 2, 3])
+        self.assertFalse(room.newer(3))
+        self.assertEqual(room.since(3), [])
+
+    ## Empty history has nothing newer for any revision.
+    def test_empty(self):
+        room = history.RoomHistory(size=5)
+        self.assertEqual(room.first, 1)
+        self.assertFalse(room.newer(0))
+        self.assertFalse(room.newer(10))
+        self.assertEqual(room.since(0), [])
+        self.assertEqual(room.since(10), [])
+        self.assertEqual(room.between(1, 10), [])
+
+    ## Pages of older messages cover history kept without gaps or repeats.
+    def test_between_pages(self):
+        room = history.RoomHistory(
+            size=10,
+            messages=range(11, 21),
+            revision=20,
+        )
+        self.assertEqual(room.between(1, 10), [])
+        self.assertEqual(room.between(21, 30), [])
+        self.assertEqual(room.between(15, 14), [])
+        self.assertEqual(room.between(5, 12), [11, 12])
+        self.assertEqual(room.between(19, 30), [19, 20])
+        for size in range(1, 12):
+            pages = []
+            last = room.revision
+            while last >= room.first:
+                pages[:0] = room.between(last - size + 1, last)
+                last -= size
+            self.assertEqual(pages, range(11, 21))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,285 @@
+## @package HTTP--Chat.test_httpparser HTTP request parser tests.
+## @file test_httpparser.py Tests of @ref HTTP--Chat.httpparser
+#
+# Requests are fed in every possible split, parser has to give the same
+# result, or the same rejection, no matter how the data arrived.
+#
+
+import buffers
+import constants
+import httpparser
+import unittest
+
+## Request head, followed by content parser leaves in buffer.
+REQUEST = (
+    'POST /get-messages?wait=30&room=r1 HTTP/1.1\r\n'
+    'Host: localhost:8080\r\n'
+    'Content-Type: application/json\r\n'
+    'cookie: uid=abc\r\n'
+    'Content-Length: 7\r\n'
+    'X-Empty:\r\n'
+    '\r\n'
+    '{"a":1}'
+)
+
+
+## Feed data to parser in chunks.
+# @param parser (RequestParser) parser
+# @param chunks (list) data received by every read
+# @returns (tuple) requests parsed and buffer left
+#
+def feed(parser, chunks):
+    buf = buffers.RecvBuffer()
+    requests = []
+    for chunk in chunks:
+        buf.extend(chunk)
+        request = parser.parse(buf)
+        if request is not None:
+            requests.append(request)
+    return requests, buf
+
+
+## Split data at every position.
+# @param data (str) data
+# @returns (generator) chunk lists, data split in two and byte by byte
+#
+def splits(data):
+    for i in range(len(data) + 1):
+        yield [data[:i], data[i:]]
+    yield list(data)
+
+
+## Tests of @ref httpparser.RequestParser.
+#
+class RequestParserTest(unittest.TestCase):
+
+    ## Check parsed @ref REQUEST.
+    # @param request (Request) parsed request
+    # @param buf (RecvBuffer) buffer left after parse
+    #
+    def check_request(self, request, buf):
+        self.assertEqual(request.method, 'POST')
+        self.assertEqual(request.uri, '/get-messages?wait=30&room=r1')
+        self.assertEqual(request.path, '/get-messages')
+        self.assertEqual(request.params, {'wait': ['30'], 'room': ['r1']})
+        self.assertEqual(request.headers['HOST'], 'localhost:8080')
+        self.assertEqual(request.headers['content-type'], 'application/json')
+        self.assertEqual(request.headers['Content-Length'], 7)
+        self.assertEqual(request.headers['X-Empty'], '')
+        self.assertEqual(request.cookies['uid'].value, 'abc')
+        self.assertEqual(buf[:len(buf)], '{"a":1}')
+
+    ## Request split anywhere parses once whole head arrived.
+    def test_split(self):
+        head = REQUEST.index('\r\n\r\n') + 4
+        for chunks in splits(REQUEST):
+            parser = httpparser.RequestParser()
+            buf = buffers.RecvBuffer()
+            requests = []
+            received = 0
+            for chunk in chunks:
+                buf.extend(chunk)
+                received += len(chunk)
+                request = parser.parse(buf)
+                if request is not None:
+                    self.assertGreaterEqual(received, head)
+                    requests.append(request)
+                elif received >= head:
+                    self.assertEqual(len(requests), 1)
+            self.assertEqual(len(requests), 1)
+            self.check_request(requests[0], buf)
+
+    ## Parser is ready for next request once it returned one.
+    def test_pipelined(self):
+        for chunks in splits(REQUEST + '\r\n' + REQUEST):
+            parser = httpparser.RequestParser()
+            buf = buffers.RecvBuffer()
+            requests = []
+            content = 0
+            for chunk in chunks:
+                buf.extend(chunk)
+                while True:
+                    content -= len(buf.take(content))
+                    if content:
+                        break
+                    request = parser.parse(buf)
+                    if request is None:
+                        break
+                    requests.append(request)
+                    content = request.headers['Content-Length']
+            self.assertEqual(len(requests), 2)
+            self.assertEqual(requests[1].uri, requests[0].uri)
+            self.assertEqual(content, 0)
+            self.assertEqual(len(buf), 0)
+
+    ## Request without headers.
+    def test_no_headers(self):
+        for chunks in splits('GET / HTTP/1.1\r\n\r\n'):
+            requests, buf = feed(httpparser.RequestParser(), chunks)
+            self.assertEqual(len(requests), 1)
+            request = requests[0]
+            self.assertEqual(request.path, '/')
+            self.assertEqual(request.headers, {})
+            self.assertEqual(len(buf), 0)
+
+    ## Check that parser rejects data however it is split.
+    # @param data (str) data to reject
+    # @param message (str) expected error message
+    # @param kwargs (dict) parser limits
+    #
+    def check_rejected(self, data, message, **kwargs):
+        for chunks in splits(data):
+            parser = httpparser.RequestParser(**kwargs)
+            with self.assertRaises(RuntimeError) as context:
+                feed(parser, chunks)
+            self.assertEqual(str(context.exception), message)
+
+    ## Check that parser accepts data however it is split.
+    # @param data (str) request head
+    # @param kwargs (dict) parser limits
+    # @returns (Request) request parsed last
+    #
+    def check_accepted(self, data, **kwargs):
+        for chunks in splits(data):
+            requests, buf = feed(httpparser.RequestParser(**kwargs), chunks)
+            self.assertEqual(len(requests), 1)
+            self.assertEqual(len(buf), 0)
+        return requests[0]
+
+    ## Request line up to its limit is accepted, longer one is not.
+    def test_request_line_limit(self):
+        line = 'GET /%s HTTP/1.1'
+        fill = 32 - len(line % '')
+        self.check_accepted(
+            (line % ('a' * fill)) + '\r\nHost: x\r\n\r\n',
+            max_line=32,
+        )
+        self.check_rejected(
+            (line % ('a' * (fill + 1))) + '\r\nHost: x\r\n\r\n',
+            'Header too long',
+            max_line=32,
+        )
+
+    ## Oversized request line is rejected before its end is received.
+    def test_request_line_incomplete(self):
+        self.check_rejected(
+            'GET /' + 'a' * 40,
+            'Header too long',
+            max_line=32,
+        )
+
+    ## Header up to its limit is accepted, longer one is not.
+    def test_header_limit(self):
+        header = 'Cookie: %s'
+        fill = 16 - len(header % '')
+        request = self.check_accepted(
+            'GET / HTTP/1.1\r\n' + (header % ('a' * fill)) + '\r\n\r\n',
+            max_header=16,
+        )
+        self.assertEqual(request.headers['Cookie'], 'a' * fill)
+        self.check_rejected(
+            'GET / HTTP/1.1\r\n' + (header % ('a' * (fill + 1))) + '\r\n\r\n',
+            'Header too long',
+            max_header=16,
+        )
+
+    ## Oversized header is rejected before its end is received.
+    def test_header_incomplete(self):
+        self.check_rejected(
+            'GET / HTTP/1.1\r\nCookie: ' + 'a' * 40,
+            'Header too long',
+            max_header=16,
+        )
+
+    ## Request line may be longer than headers may.
+    def test_line_limits_apart(self):
+        self.check_accepted(
+            'GET /' + 'a' * 40 + ' HTTP/1.1\r\nHost: x\r\n\r\n',
+            max_line=64,
+            max_header=16,
+        )
+        self.check_rejected(
+            'GET / HTTP/1.1\r\nHost: ' + 'a' * 40 + '\r\n\r\n',
+            'Header too long',
+            max_line=64,
+            max_header=16,
+        )
+
+    ## Server limits apply by default.
+    def test_default_limits(self):
+        self.check_rejected(
+            'GET /%s HTTP/1.1\r\n\r\n' % (
+                'a' * constants.MAX_REQUEST_LINE_LEN
+            ),
+            'Header too long',
+        )
+        self.check_rejected(
+            'GET / HTTP/1.1\r\nCookie: %s\r\n\r\n' % (
+                'a' * constants.MAX_HEADER_LEN
+            ),
+            'Header too long',
+        )
+        self.check_rejected(
+            'GET / HTTP/1.1\r\n%s\r\n' % (
+                'H: x\r\n' * (constants.MAX_HEADER_AMOUNT + 1)
+            ),
+            'Too many headers',
+        )
+
+    ## Head up to its limit is accepted, longer one is not.
+    def test_head_limit(self):
+        head = 'GET / HTTP/1.1\r\n' + 'H: x\r\n' * 10 + 'H: x'
+        fill = 100 - len(head)
+        self.check_accepted(head + 'x' * fill + '\r\n\r\n', max_head=100)
+        self.check_rejected(
+            head + 'x' * (fill + 1) + '\r\n\r\n',
+            'Request head too long',
+            max_head=100,
+        )
+
+    ## Oversized head is rejected before its end is received.
+    def test_head_incomplete(self):
+        self.check_rejected(
+            'GET / HTTP/1.1\r\n' + 'H: x\r\n' * 20,
+            'Request head too long',
+            max_head=100,
+        )
+
+    ## Headers up to their maximum amount are accepted, more are not.
+    def test_header_amount(self):
+        headers = ''.join('H%d: x\r\n' % i for i in range(4))
+        request = self.check_accepted(
+            'GET / HTTP/1.1\r\n' + headers + '\r\n',
+            max_amount=4,
+        )
+        self.assertEqual(len(request.headers), 4)
+        self.check_rejected(
+            'GET / HTTP/1.1\r\n' + headers + 'H4: x\r\n\r\n',
+            'Too many headers',
+            max_amount=4,
+        )
+
+    ## Too many headers are rejected before end of head is received.
+    def test_header_amount_incomplete(self):
+        self.check_rejected(
+            'GET / HTTP/1.1\r\n' + 'H: x\r\n' * 6,
+            'Too many headers',
+            max_amount=4,
+        )
+
+    ## Malformed heads are rejected.
+    def test_malformed(self):
+        for data, message in (
+            ('GET /\r\n\r\n', 'Incomplete HTTP protocol'),
+            ('GET / HTTP/1.0\r\n\r\n', 'Not HTTP protocol'),
+            ('GET / HTTP/1.1\r\nHost\r\n\r\n', 'Invalid Header'),
+            (
+                'GET / HTTP/1.1\r\nContent-Length: x\r\n\r\n',
+                'Invalid Content-Length',
+            ),
+        ):
+            self.check_rejected(data, message)
+
+
+if __name__ == '__main__':
+    unittest.main()
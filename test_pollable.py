@@ -0,0 +1,129 @@
+## @package HTTP--Chat.test_pollable Connection handler tests.
+## @file test_pollable.py Tests of @ref HTTP--Chat.pollable
+#
+
+import constants
+import errno
+import os
+import pollable
+import select
+import server
+import socket
+import time
+import unittest
+
+from events import CommonEvents
+
+
+## Tests of @ref pollable.HttpSocket.
+#
+class HttpSocketTest(unittest.TestCase):
+
+    ## Send request to a connection handler and wait for its answer.
+    # @param request (str) request sent by client
+    # @returns (str) data received by client, empty if connection closed
+    # @throws socket.error If connection neither answered nor closed
+    #
+    def exchange(self, request):
+        connection, client = socket.socketpair()
+        connection.setblocking(False)
+        loop = server.Server(100)
+        loop.register(pollable.HttpSocket(
+            connection,
+            loop,
+            {'metrics': loop.metrics},
+        ))
+        received = []
+
+        def check():
+            if select.select([client], [], [], 0)[0]:
+                received.append(client.recv(constants.BLOCK_SIZE))
+                loop.close_server()
+
+        loop.call_every(0.01, check)
+        loop.call_later(constants.REQUEST_TIMEOUT / 2.0, loop.close_server)
+        client.sendall(request)
+        loop.run()
+        if not received:
+            # loop also ends once connection closed
+            client.settimeout(0)
+            received.append(client.recv(constants.BLOCK_SIZE))
+        client.close()
+        return received[0]
+
+    ## Head longer than a block is read whole.
+    def test_head_over_block_size(self):
+        headers = ''.join(
+            'X-Fill-%d: %s\r\n' % (i, 'a' * 4000) for i in range(3)
+        )
+        self.assertGreater(len(headers), constants.BLOCK_SIZE)
+        start = time.time()
+        response = self.exchange(
+            'GET /stats HTTP/1.1\r\n' + headers + '\r\n'
+        )
+        self.assertTrue(response.startswith('HTTP/1.1 200 OK\r\n'))
+        self.assertLess(time.time() - start, 1)
+
+    ## Head longer than limit is rejected without waiting for its end.
+    def test_head_over_limit(self):
+        headers = 'X-Fill: %s\r\n' % ('a' * 4000)
+        amount = constants.MAX_HEAD_LEN // len(headers) + 1
+        self.assertLess(amount, constants.MAX_HEADER_AMOUNT)
+        start = time.time()
+        response = self.exchange('GET /stats HTTP/1.1\r\n' + headers * amount)
+        self.assertEqual(response, '')
+        self.assertLess(time.time() - start, 1)
+
+
+## Listening socket out of file descriptors.
+#
+class ExhaustedSocket(object):
+
+    ## Constructor.
+    def __init__(self):
+        self._socket = socket.socket()
+        self.accepts = 0
+
+    ## Retrieve fd.
+    def fileno(self):
+        return self._socket.fileno()
+
+    ## Fail like accept does once process has no fd left.
+    def accept(self):
+        self.accepts += 1
+        raise socket.error(errno.EMFILE, os.strerror(errno.EMFILE))
+
+    ## Close socket.
+    def close(self):
+        self._socket.close()
+
+
+## Tests of @ref pollable.SocketListen.
+#
+class SocketListenTest(unittest.TestCase):
+
+    ## Accepting pauses once out of file descriptors, then resumes.
+    def test_backoff(self):
+        loop = server.Server(100)
+        listen = pollable.SocketListen(
+            ExhaustedSocket(),
+            pollable.HttpSocket,
+            loop,
+            {'metrics': loop.metrics},
+        )
+        loop.register(listen)
+        listen.onread()
+        self.assertEqual(listen.socket.accepts, 1)
+        self.assertFalse(listen.getevents() & CommonEvents.POLLIN)
+        time.sleep(constants.ACCEPT_BACKOFF)
+        loop._run_timers()
+        self.assertTrue(listen.getevents() & CommonEvents.POLLIN)
+        listen.onread()
+        timer = listen._backoff
+        self.assertFalse(timer.cancelled)
+        listen.onerror()
+        self.assertTrue(timer.cancelled)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+## @package HTTP--Chat.test_server Server loop tests.
+## @file test_server.py Tests of @ref HTTP--Chat.server
+#
+
+# pollable first, server imports it while pollable needs server loaded
+import pollable
+import server
+import time
+import unittest
+
+
+## Tests of timers of @ref server.Server.
+#
+class TimerTest(unittest.TestCase):
+
+    ## Create server.
+    def setUp(self):
+        self.server = server.Server(1000)
+        self.ran = []
+
+    ## Delays that are not finite numbers are rejected.
+    def test_rejected(self):
+        for delay in (float('nan'), float('inf'), float('-inf')):
+            with self.assertRaises(ValueError):
+                self.server.call_later(delay, self.ran.append, 'x')
+            with self.assertRaises(ValueError):
+                self.server.call_every(delay, self.ran.append, 'x')
+        self.assertEqual(self.server._next_timeout(time.time()), 1000)
+
+    ## Timers run by order of deadline around a rejected one.
+    def test_order(self):
+        self.server.call_later(0.02, self.ran.append, 'b')
+        self.server.call_later(0.01, self.ran.append, 'a')
+        with self.assertRaises(ValueError):
+            self.server.call_later(float('nan'), self.ran.append, 'x')
+        self.server.call_later(0.03, self.ran.append, 'c')
+        time.sleep(0.05)
+        self.server._run_timers()
+        self.assertEqual(self.ran, ['a', 'b', 'c'])
+
+    ## Poll timeout is bound by poll timeout and next deadline.
+    def test_next_timeout(self):
+        now = time.time()
+        self.assertEqual(self.server._next_timeout(now), 1000)
+        timer = self.server.call_later(5, self.ran.append, 'x')
+        self.assertEqual(self.server._next_timeout(now), 1000)
+        self.server.call_later(0.25, self.ran.append, 'x')
+        self.assertTrue(0 < self.server._next_timeout(now) <= 251)
+        self.assertEqual(self.server._next_timeout(now + 1), 0)
+        timer.cancel()
+
+    ## Deadline that is not a number does not stop polling.
+    def test_next_timeout_nan(self):
+        self.server._timers.append((float('nan'), 0, server.Timer(
+            float('nan'),
+            self.ran.append,
+            ('x',),
+        )))
+        self.assertEqual(self.server._next_timeout(time.time()), 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+## @package HTTP--Chat.test_util Utility tests.
+## @file test_util.py Tests of @ref HTTP--Chat.util
+#
+
+import unittest
+import util
+
+
+## Tests of @ref util.parse_period.
+#
+class ParsePeriodTest(unittest.TestCase):
+
+    ## Periods within range are kept.
+    def test_valid(self):
+        self.assertEqual(util.parse_period('0', 30), 0)
+        self.assertEqual(util.parse_period('2.5', 30), 2.5)
+        self.assertEqual(util.parse_period('30', 30), 30)
+
+    ## Periods out of range are clamped.
+    def test_clamped(self):
+        self.assertEqual(util.parse_period('-1', 30), 0)
+        self.assertEqual(util.parse_period('-1e300', 30), 0)
+        self.assertEqual(util.parse_period('1e300', 30), 30)
+
+    ## Values that are not finite numbers are rejected.
+    def test_rejected(self):
+        for value in ('nan', 'NaN', '-nan', 'inf', '-inf', 'Infinity', 'x'):
+            with self.assertRaises(RuntimeError):
+                util.parse_period(value, 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
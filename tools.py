@@ -0,0 +1,33 @@
+## @package HTTP--Chat.tools Tool support module.
+## @file tools.py Implementation of @ref HTTP--Chat.tools
+#
+# Helpers shared by @ref HTTP--Chat.bench and @ref HTTP--Chat.loadgen, which
+# run servers of their own to measure.
+#
+
+import socket
+import subprocess
+import sys
+import time
+
+
+## Start server and wait until it accepts connections.
+# @param port (int) port to listen on
+# @param options (list) additional server arguments
+# @returns (object) server process
+#
+def start_server(port, options):
+    process = subprocess.Popen([
+        sys.executable,
+        'server.py',
+        '--new', '127.0.0.1:%d' % port,
+        '--log-level', 'ERROR',
+    ] + options)
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return process
+        except socket.error:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError('Server did not start')
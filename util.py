@@ -4,28 +4,11 @@
 
 import base64
 import constants
+import itertools
+import math
 import os
-import time
-
-
-## Get room revision since the last one.
-# @param room (dict) chat room.
-# @param index (int) previous revision index.
-# @returns (list) all messages since last revision.
-#
-def get_revision(room, index):
-
-    list = room['messages']
-    baseI = room['base_index']
-    messages = []
-    if len(list) == 0:
-        return []
-    if len(list) < index:
-        index = index - baseI
-    for batch in list[index:]:
-        for message in batch:
-            messages.append(message)
-    return messages
+import socket
+import zlib
 
 
 ## Generate unique random value.
@@ -40,12 +23,203 @@ def generate_unique(excluded):
             return val
 
 
-## Clear all inactive users from room.
-# @param users (dict) room's users storage.
+## Create pair of connected sockets.
+# @returns (tuple) connected sockets.
+#
+# Platforms lacking socketpair get a pair connected over loopback.
+#
+def socketpair():
+
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        server, addr = listener.accept()
+    finally:
+        listener.close()
+    return server, client
+
+
+## Get name of user sending request.
+# @param dialogue (dict) request dialogue.
+# @returns (str) user name.
+#
+def get_user(dialogue):
+
+    return dialogue['request']['context']['users'][
+        dialogue['request']['parsed'].cookies['uid'].value]
+
+
+## Keys of registered waiters.
+#
+# Waiters are kept by key rather than compared, as bound methods of
+# different services compare equal, see @ref base.Base.
+#
+_waiter_keys = itertools.count()
+
+
+## Wait for changes in room.
+# @param room (dict) chat room.
+# @param waiter (callable) called once room changes.
+# @returns (tuple) token to pass to @ref cancel_waiter.
+#
+def add_waiter(room, waiter):
+
+    key = next(_waiter_keys)
+    room['waiters'][key] = waiter
+    return room, key
+
+
+## Stop waiting for changes in room.
+# @param token (tuple) token returned by @ref add_waiter, None if none.
+#
+# Waiters that were already called are ignored.
+#
+def cancel_waiter(token):
+
+    if token is not None:
+        room, key = token
+        room['waiters'].pop(key, None)
+
+
+## Wake everyone waiting for changes in room.
+# @param room (dict) chat room.
+#
+# Waiters are called once, those still interested register again.
+#
+def wake_waiters(room):
+
+    waiters, room['waiters'] = room['waiters'], {}
+    for key in sorted(waiters):
+        waiters[key]()
+
+
+## Parse time period sent by client.
+# @param value (str) time in seconds.
+# @param maximum (float) longest period allowed.
+# @returns (float) period, clamped to range 0 to maximum.
+# @throws RuntimeError If value is not a finite number.
+#
+def parse_period(value, maximum):
+
+    try:
+        period = float(value)
+    except ValueError:
+        raise RuntimeError('Invalid period: %s' % value)
+    if math.isnan(period) or math.isinf(period):
+        raise RuntimeError('Invalid period: %s' % value)
+    return min(max(period, 0), maximum)
+
+
+## Parse quality values of an Accept style request header.
+# @param accept (str) request header.
+# @returns (dict) quality of every listed value.
+#
+def parse_qualities(accept):
+
+    qualities = {}
+    for part in accept.split(','):
+        fields = part.split(';')
+        quality = 1.0
+        for param in fields[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[fields[0].strip().lower()] = quality
+    return qualities
+
+
+## Choose content coding acceptable by client.
+# @param accept (str) Accept-Encoding request header.
+# @param supported (tuple) supported codings by order of preference.
+# @returns (str) chosen coding, None if identity should be used.
+#
+def choose_encoding(accept, supported=('gzip', 'deflate')):
+
+    qualities = parse_qualities(accept)
+    for coding in supported:
+        if qualities.get(coding, qualities.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+## Choose media type preferred by client.
+# @param accept (str) Accept request header.
+# @param supported (tuple) supported media types by order of preference.
+# @returns (str) chosen media type, first supported one if client has no
+# preference.
+#
+def choose_type(accept, supported):
+
+    if not accept:
+        return supported[0]
+    qualities = parse_qualities(accept)
+    best, best_quality = supported[0], 0.0
+    for media_type in supported:
+        quality = qualities.get(
+            media_type,
+            qualities.get(
+                '%s/*' % media_type.split('/')[0],
+                qualities.get('*/*', 0.0),
+            ),
+        )
+        if quality > best_quality:
+            best, best_quality = media_type, quality
+    return best
+
+
+## Compress data with content coding.
+# @param data (str) data to compress.
+# @param coding (str) either gzip or deflate.
+# @returns (str) compressed data.
+#
+def compress(data, coding):
+
+    c = zlib.compressobj(
+        constants.COMPRESS_LEVEL,
+        zlib.DEFLATED,
+        16 + zlib.MAX_WBITS if coding == 'gzip' else zlib.MAX_WBITS,
+    )
+    return c.compress(data) + c.flush()
+
+
+## Add request header response depends on to Vary response header.
+# @param dialogue (dict) application context.
+# @param header (str) request header name.
+#
+def add_vary(dialogue, header):
+
+    vary = dialogue['response']['headers'].get('Vary')
+    if vary:
+        header = '%s, %s' % (vary, header)
+    dialogue['response']['headers']['Vary'] = header
+
+
+## Compress response content if large enough and accepted by client.
+# @param content (str) response content.
+# @param dialogue (dict) application context.
+# @param variants (dict) content codings compressed before, updated with
+# the one compressed now.
+# @returns (str) content to send, response headers are updated accordingly.
 #
-def clear_outdated_users(users):
+def compress_response(content, dialogue, variants=None):
 
-    now = time.time()
-    for user, timestamp in users.items():
-        if (now - timestamp) > constants.EXPIRED_PERIOD:
-            del users[user]
+    if len(content) < constants.COMPRESS_MIN_SIZE:
+        return content
+    coding = choose_encoding(
+        dialogue['request']['headers'].get('Accept-Encoding', ''))
+    add_vary(dialogue, 'Accept-Encoding')
+    if coding is None:
+        return content
+    dialogue['response']['headers']['Content-Encoding'] = coding
+    if variants is None:
+        return compress(content, coding)
+    if coding not in variants:
+        variants[coding] = compress(content, coding)
+    return variants[coding]
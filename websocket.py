@@ -0,0 +1,94 @@
+## @package HTTP--Chat.websocket WebSocket protocol module.
+## @file websocket.py Implementation of @ref HTTP--Chat.websocket
+#
+# Handshake and framing as defined by RFC 6455.
+#
+
+import base64
+import hashlib
+import struct
+
+## Magic string appended to client key during handshake.
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+## Supported protocol version.
+VERSION = '13'
+
+## Frame opcodes.
+(CONTINUATION, TEXT, BINARY, CLOSE, PING, PONG) = (0x0, 0x1, 0x2, 0x8, 0x9, 0xA)
+
+## Close status codes.
+(CLOSE_NORMAL, CLOSE_PROTOCOL_ERROR, CLOSE_TOO_BIG) = (1000, 1002, 1009)
+
+
+## Compute handshake accept value.
+# @param key (str) Sec-WebSocket-Key sent by client.
+# @returns (str) Sec-WebSocket-Accept to send back.
+#
+def accept_key(key):
+
+    return base64.b64encode(hashlib.sha1(key.strip() + GUID).digest())
+
+
+## Build a single unmasked server frame.
+# @param opcode (int) frame opcode.
+# @param payload (str) frame payload.
+# @returns (str) encoded frame.
+#
+def encode_frame(opcode, payload=''):
+
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < (1 << 16):
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+## Build a close frame.
+# @param code (int) close status code.
+# @returns (str) encoded frame.
+#
+def encode_close(code=CLOSE_NORMAL):
+
+    return encode_frame(CLOSE, struct.pack('!H', code))
+
+
+## Decode a single client frame.
+# @param buf (str) received data, or any object supporting len and slicing.
+# @param max_size (int) maximum payload size.
+# @returns (tuple) fin, opcode, payload and amount of data consumed, or None
+# if frame is incomplete.
+# @throws RuntimeError If frame is not masked or payload is too big.
+#
+def decode_frame(buf, max_size):
+
+    if len(buf) < 2:
+        return None
+    b1, b2 = struct.unpack('!BB', buf[:2])
+    offset = 2
+    length = b2 & 0x7F
+    if length == 126:
+        if len(buf) < offset + 2:
+            return None
+        length, = struct.unpack('!H', buf[offset:offset + 2])
+        offset += 2
+    elif length == 127:
+        if len(buf) < offset + 8:
+            return None
+        length, = struct.unpack('!Q', buf[offset:offset + 8])
+        offset += 8
+    if not b2 & 0x80:
+        raise RuntimeError('Unmasked client frame')
+    if length > max_size:
+        raise RuntimeError('Frame too big')
+    if len(buf) < offset + 4 + length:
+        return None
+    mask = bytearray(buf[offset:offset + 4])
+    offset += 4
+    payload = bytearray(buf[offset:offset + length])
+    for i in range(length):
+        payload[i] ^= mask[i % 4]
+    return bool(b1 & 0x80), b1 & 0x0F, str(payload), offset + length